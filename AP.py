@@ -0,0 +1,296 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from evaluator import box_iou_matrix, greedy_match
+
+
+def load_yolo_array(file_path):
+    """
+    加载YOLO格式文件为数组，每行为 [class_id, x_center, y_center, width, height, confidence]
+    没有置信度的行（真实标签）置信度记为1.0
+    """
+    rows = []
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) < 5:
+                        continue
+                    values = [float(v) for v in parts[:6]]
+                    if len(values) == 5:
+                        values.append(1.0)
+                    rows.append(values)
+        except Exception as e:
+            print(f"警告: 读取文件 {file_path} 时出错: {e}")
+    if not rows:
+        return np.zeros((0, 6), dtype=np.float64)
+    return np.asarray(rows, dtype=np.float64)
+
+
+def match_video(gt_video_path, pred_video_path, iou_threshold):
+    """
+    逐帧匹配一个视频的预测框和真实框（规则与 DetectionEvaluator.match_boxes 相同）
+    帧按文件名对应，缺少预测文件的帧视为没有预测，缺少标签文件的帧视为没有真实目标
+    返回所有预测框的类别、置信度、是否为TP，以及各类别真实目标数
+    """
+    gt_frames = {f for f in os.listdir(gt_video_path) if f.lower().endswith('.txt')} if os.path.isdir(gt_video_path) else set()
+    pred_frames = {f for f in os.listdir(pred_video_path) if f.lower().endswith('.txt')} if os.path.isdir(pred_video_path) else set()
+
+    classes, scores, tps, gt_classes = [], [], [], []
+    for frame in sorted(gt_frames | pred_frames):
+        gt = load_yolo_array(os.path.join(gt_video_path, frame))
+        pred = load_yolo_array(os.path.join(pred_video_path, frame))
+        gt_cls = gt[:, 0].astype(np.int64)
+        pred_cls = pred[:, 0].astype(np.int64)
+
+        iou = box_iou_matrix(pred[:, 1:5], gt[:, 1:5])
+        iou = np.where(pred_cls[:, None] == gt_cls[None, :], iou, 0.0)
+        order = np.argsort(-pred[:, 5], kind='stable')
+        matched = greedy_match(iou, order, iou_threshold)
+
+        classes.append(pred_cls)
+        scores.append(pred[:, 5])
+        tps.append(matched >= 0)
+        gt_classes.append(gt_cls)
+
+    def cat(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+    return {
+        'frames': len(gt_frames | pred_frames),
+        'classes': cat(classes, np.int64),
+        'scores': cat(scores, np.float64),
+        'tp': cat(tps, bool),
+        'gt_classes': cat(gt_classes, np.int64),
+    }
+
+
+def pr_curve(scores, tp, num_gt):
+    """
+    一次排序、累加TP/FP得到完整的PR曲线
+    相同置信度的预测框作为同一个阈值点，返回每个候选阈值下的 precision / recall / f1
+    （阈值 t 表示保留置信度 >= t 的预测框）
+    """
+    order = np.argsort(-scores, kind='stable')
+    sorted_scores = scores[order]
+    tp_cum = np.cumsum(tp[order])
+    fp_cum = np.cumsum(~tp[order])
+
+    # 每组相同置信度只保留最后一个位置
+    keep = np.r_[sorted_scores[1:] != sorted_scores[:-1], True] if len(sorted_scores) else np.zeros(0, dtype=bool)
+    tp_cum = tp_cum[keep]
+    fp_cum = fp_cum[keep]
+
+    precision = tp_cum / np.maximum(tp_cum + fp_cum, 1)
+    recall = tp_cum / num_gt if num_gt > 0 else np.zeros(len(tp_cum))
+    denom = precision + recall
+    f1 = np.where(denom > 0, 2 * precision * recall / np.where(denom > 0, denom, 1), 0.0)
+    return {
+        'thresholds': sorted_scores[keep],
+        'tp': tp_cum,
+        'fp': fp_cum,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
+
+
+def average_precision(recall, precision, method='all_point'):
+    """
+    由PR曲线计算AP
+    method: 'all_point'（VOC2010+ 全点插值）、'voc11'（VOC2007 11点插值）、'coco101'（COCO 101点插值）
+    """
+    if len(recall) == 0:
+        return 0.0
+    # 精确率包络：每个召回率位置取其右侧的最大精确率
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+
+    if method == 'all_point':
+        mrec = np.r_[0.0, recall]
+        return float(np.sum((mrec[1:] - mrec[:-1]) * envelope))
+
+    if method == 'voc11':
+        points = np.linspace(0, 1, 11)
+    elif method == 'coco101':
+        points = np.linspace(0, 1, 101)
+    else:
+        raise ValueError(f"未知的AP插值方法: {method}")
+    idx = np.searchsorted(recall, points, side='left')
+    values = np.where(idx < len(recall), envelope[np.minimum(idx, len(recall) - 1)], 0.0)
+    return float(values.mean())
+
+
+def metrics_at_thresholds(curve, thresholds):
+    """查询任意置信度阈值下的 precision / recall / f1（保留置信度 >= 阈值的预测框）"""
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    # curve['thresholds'] 为降序，找到最后一个 >= 阈值的位置
+    idx = np.searchsorted(-curve['thresholds'], -thresholds, side='right') - 1
+    valid = idx >= 0
+    idx = np.maximum(idx, 0)
+    results = {}
+    for key in ('precision', 'recall', 'f1'):
+        values = curve[key][idx] if len(curve[key]) else np.zeros(len(thresholds))
+        results[key] = np.where(valid, values, 0.0)
+    return results
+
+
+def class_ap_results(match, class_names=None, return_curves=False):
+    """按类别计算AP及最佳F1工作点，返回 (results, curves)"""
+    num_gt = np.bincount(match['gt_classes'], minlength=1)
+    all_classes = sorted(set(np.unique(match['classes']).tolist()) | set(np.nonzero(num_gt)[0].tolist()))
+
+    results = {}
+    curves = {}
+    class_aps = []
+    for class_id in all_classes:
+        mask = match['classes'] == class_id
+        gt_count = int(num_gt[class_id]) if class_id < len(num_gt) else 0
+        curve = pr_curve(match['scores'][mask], match['tp'][mask], gt_count)
+        class_name = class_names[class_id] if class_names and class_id < len(class_names) else f"Class_{class_id}"
+
+        r = {
+            'class_name': class_name,
+            'total_gt': gt_count,
+            'total_pred': int(mask.sum()),
+            'ap': average_precision(curve['recall'], curve['precision'], 'all_point'),
+            'ap_voc11': average_precision(curve['recall'], curve['precision'], 'voc11'),
+            'ap_coco101': average_precision(curve['recall'], curve['precision'], 'coco101'),
+        }
+        if len(curve['f1']):
+            best = int(np.argmax(curve['f1']))
+            r.update({
+                'best_f1': float(curve['f1'][best]),
+                'best_threshold': float(curve['thresholds'][best]),
+                'precision_at_best': float(curve['precision'][best]),
+                'recall_at_best': float(curve['recall'][best]),
+            })
+        results[class_id] = r
+        if return_curves:
+            curves[class_name] = curve
+
+        # 只有存在真实目标的类别参与mAP
+        if gt_count > 0:
+            class_aps.append(r)
+
+    results['overall'] = {
+        'mAP': float(np.mean([r['ap'] for r in class_aps])) if class_aps else 0.0,
+        'mAP_voc11': float(np.mean([r['ap_voc11'] for r in class_aps])) if class_aps else 0.0,
+        'mAP_coco101': float(np.mean([r['ap_coco101'] for r in class_aps])) if class_aps else 0.0,
+        'valid_classes_count': len(class_aps),
+        'total_gt': int(num_gt.sum()),
+        'total_pred': int(len(match['classes'])),
+    }
+    return results, curves
+
+
+def _match_video_job(job):
+    video_name, gt_video_path, pred_video_path, iou_threshold = job
+    return video_name, match_video(gt_video_path, pred_video_path, iou_threshold)
+
+
+def evaluate_ap(gt_root, pred_root, iou_threshold=0.5, class_names=None, num_workers=None,
+                output_file=None, curves_file=None):
+    """
+    计算YOLO格式视频目录树上的AP
+    gt_root / pred_root 下每个视频一个子文件夹，视频之间并行匹配
+    返回 {'video_results': ..., 'overall_results': ...}，overall 由所有视频的预测框合并后计算
+    """
+    if not os.path.isdir(gt_root) or not os.path.isdir(pred_root):
+        print(f"错误: 目录不存在: {gt_root} 或 {pred_root}")
+        return None
+
+    videos = sorted(set(d for d in os.listdir(gt_root) if os.path.isdir(os.path.join(gt_root, d))) &
+                    set(d for d in os.listdir(pred_root) if os.path.isdir(os.path.join(pred_root, d))))
+    if not videos:
+        print("错误: 没有找到共同的视频目录")
+        return None
+
+    print(f"开始计算AP，共 {len(videos)} 个视频，IoU阈值: {iou_threshold}")
+    jobs = [(v, os.path.join(gt_root, v), os.path.join(pred_root, v), iou_threshold) for v in videos]
+    if num_workers == 0:
+        matches = dict(map(_match_video_job, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            matches = dict(executor.map(_match_video_job, jobs))
+
+    video_results = {}
+    for video_name in videos:
+        metrics, _ = class_ap_results(matches[video_name], class_names)
+        video_results[video_name] = {
+            'frames_processed': matches[video_name]['frames'],
+            'metrics': {str(k): v for k, v in metrics.items()},
+        }
+        r = metrics['overall']
+        print(f"视频 {video_name}: mAP={r['mAP']:.4f} (VOC11={r['mAP_voc11']:.4f}, COCO101={r['mAP_coco101']:.4f})")
+
+    merged = {key: np.concatenate([matches[v][key] for v in videos])
+              for key in ('classes', 'scores', 'tp', 'gt_classes')}
+    overall, curves = class_ap_results(merged, class_names, return_curves=True)
+
+    print("-" * 80)
+    print(f"{'类别':<12} {'AP':<8} {'AP_VOC11':<10} {'AP_COCO101':<12} {'最佳F1':<8} {'阈值':<8}")
+    for class_id in sorted(k for k in overall.keys() if k != 'overall'):
+        r = overall[class_id]
+        print(f"{r['class_name']:<12} {r['ap']:<8.4f} {r['ap_voc11']:<10.4f} {r['ap_coco101']:<12.4f} "
+              f"{r.get('best_f1', 0.0):<8.4f} {r.get('best_threshold', 0.0):<8.4f}")
+    r = overall['overall']
+    print(f"{'mAP':<12} {r['mAP']:<8.4f} {r['mAP_voc11']:<10.4f} {r['mAP_coco101']:<12.4f}")
+
+    results = {
+        'evaluation_config': {
+            'gt_root': gt_root,
+            'pred_root': pred_root,
+            'iou_threshold': iou_threshold,
+            'class_names': class_names,
+        },
+        'video_results': video_results,
+        'overall_results': {str(k): v for k, v in overall.items()},
+    }
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n详细结果已保存到: {output_file}")
+    if curves_file:
+        # 每个类别的完整PR曲线（每个候选阈值一个点）
+        np.savez_compressed(curves_file, **{f"{name}/{key}": value
+                                            for name, curve in curves.items()
+                                            for key, value in curve.items()})
+        print(f"PR曲线已保存到: {curves_file}")
+    return results
+
+
+def main():
+    # ==================== 配置区域 ====================
+    config = {
+        # 真实标签根目录 (每个视频一个子文件夹)
+        'gt_root': 'data/tzb/Data/comp/labels',
+
+        # 预测结果根目录 (每个视频一个子文件夹)
+        'pred_root': 'data/tzb/Data/comp/predictions',
+
+        # IoU阈值
+        'iou_threshold': 0.3,
+
+        # 类别名称列表
+        'class_names': ['drone', 'car', 'ship', 'bus', 'pedestrian', 'cyclist'],
+
+        # 并行进程数 (None 为CPU核数，0 为不使用多进程)
+        'num_workers': None,
+
+        # 结果保存文件名
+        'output_file': 'ap_results.json',
+
+        # PR曲线保存文件名 (设置为 None 则不保存)
+        'curves_file': 'ap_pr_curves.npz',
+    }
+    # ================================================
+
+    evaluate_ap(**config)
+
+
+if __name__ == "__main__":
+    main()
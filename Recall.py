@@ -2,6 +2,13 @@ import os
 import torch
 import json
 import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from AP import load_yolo_array
+from evaluator import box_iou_matrix, greedy_match
+from label_store import LabelStore
 
 def calculate_iou(box1, box2):
     """
@@ -36,12 +43,17 @@ def calculate_iou(box1, box2):
     iou = inter_area / union_area if union_area > 0 else 0
     return iou
 
-def load_labels_from_yolo_txt(filepath):
+def load_labels_from_yolo_txt(filepath, label_store=None):
     """
     从YOLO格式的txt文件中加载标签。
     格式: [[class_id, x_center, y_center, width, height], ...]
     不假设有置信度，直接加载前5个元素。
+    如果提供 label_store 且该文件在标签库中，则直接从标签库读取。
     """
+    if label_store is not None:
+        rows = label_store.lookup(filepath)
+        if rows is not None:
+            return rows.tolist()
     labels = []
     if not os.path.exists(filepath):
         return labels
@@ -88,13 +100,16 @@ def calculate_recall(
     predictions_root_dir,
     labels_root_dir,
     iou_threshold=0.3, # 保持默认 IoU 阈值
-    classes_path=None
+    classes_path=None,
+    use_label_store=False
 ):
     """
     计算给定目录下所有视频帧的Recall率。
     以predictions目录为基准遍历，预测框无需再进行置信度过滤。
+    use_label_store: 是否通过 label_store.LabelStore 读取真实标签。
     """
     print(f"\n--- 开始计算 Recall (IoU >= {iou_threshold}) ---")
+    label_store = LabelStore(labels_root_dir) if use_label_store else None
 
     total_true_positives = 0
     total_false_negatives = 0
@@ -126,7 +141,7 @@ def calculate_recall(
             gt_filepath = os.path.join(current_label_dir, f"{base_name}.txt") # 对应的真实标签文件
 
             preds = load_labels_from_yolo_txt(pred_filepath)
-            gts = load_labels_from_yolo_txt(gt_filepath)
+            gts = load_labels_from_yolo_txt(gt_filepath, label_store)
 
             # True Positives (TP) 和 False Negatives (FN) 计数
             gt_matched = [False] * len(gts) # 标记每个真实框是否已被匹配
@@ -187,6 +202,132 @@ def calculate_recall(
     return overall_recall, class_recall_results
 
 
+def sweep_video_recall(current_pred_dir, current_label_dir, iou_thresholds, score_thresholds, num_classes, label_store=None):
+    """
+    统计一个视频在所有 (IoU阈值, 置信度阈值) 组合下的逐类别TP和真实目标数
+    每帧只读取一次并只计算一次IoU矩阵，匹配规则与 calculate_recall 相同（以真实框为主的贪心匹配）
+    返回 tp: shape (len(iou_thresholds), len(score_thresholds), num_classes)，gt_count: shape (num_classes,)
+    """
+    tp = np.zeros((len(iou_thresholds), len(score_thresholds), num_classes), dtype=np.int64)
+    gt_count = np.zeros(num_classes, dtype=np.int64)
+
+    pred_files = sorted(f for f in os.listdir(current_pred_dir) if f.lower().endswith('.txt'))
+    for pred_file in pred_files:
+        base_name = os.path.splitext(pred_file)[0]
+        preds = load_yolo_array(os.path.join(current_pred_dir, pred_file))
+        gt_filepath = os.path.join(current_label_dir, f"{base_name}.txt")
+        gts = label_store.lookup(gt_filepath) if label_store is not None else None
+        if gts is None:
+            gts = load_yolo_array(gt_filepath)
+        if len(gts) == 0:
+            continue
+
+        gt_cls = gts[:, 0].astype(np.int64)
+        pred_cls = preds[:, 0].astype(np.int64)
+        gt_count += np.bincount(gt_cls, minlength=num_classes)[:num_classes]
+
+        # 行为真实框，列为预测框，不同类别的IoU置0
+        iou = box_iou_matrix(gts[:, 1:5], preds[:, 1:5])
+        iou = np.where(gt_cls[:, None] == pred_cls[None, :], iou, 0.0)
+        gt_order = np.arange(len(gts))
+
+        for j, score_threshold in enumerate(score_thresholds):
+            keep = preds[:, 5] >= score_threshold
+            iou_kept = iou[:, keep]
+            for i, iou_threshold in enumerate(iou_thresholds):
+                matched = greedy_match(iou_kept, gt_order, iou_threshold) >= 0
+                tp[i, j] += np.bincount(gt_cls[matched], minlength=num_classes)[:num_classes]
+
+    return tp, gt_count
+
+
+def _sweep_video_job(job):
+    return sweep_video_recall(*job)
+
+
+def calculate_recall_sweep(
+    predictions_root_dir,
+    labels_root_dir,
+    iou_thresholds=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9),
+    score_thresholds=(0.0,),
+    classes_path=None,
+    num_classes=6,
+    num_workers=None,
+    output_file=None,
+    use_label_store=False
+):
+    """
+    一次遍历计算多个IoU阈值和置信度阈值下的Recall率
+    视频之间并行处理，返回按视频和按类别的召回率表：
+    {
+        'iou_thresholds': [...], 'score_thresholds': [...],
+        'overall': [[recall]]                    # [iou][score]
+        'classes': {class_name: [[recall]]},     # [iou][score]
+        'videos': {video: {'overall': [[recall]], 'classes': {...}}}
+    }
+    """
+    iou_thresholds = [float(t) for t in iou_thresholds]
+    score_thresholds = [float(t) for t in score_thresholds]
+    print(f"\n--- 开始计算 Recall 扫描 (IoU: {iou_thresholds}, 置信度: {score_thresholds}) ---")
+
+    class_names = load_class_names(classes_path)
+    num_classes = max(num_classes, len(class_names))
+
+    video_folders = [f for f in os.listdir(predictions_root_dir) if os.path.isdir(os.path.join(predictions_root_dir, f)) and f.startswith('video')]
+    video_folders.sort()
+
+    if not video_folders:
+        print(f"在 {predictions_root_dir} 中没有找到任何'video'开头的子文件夹。请检查路径和目录结构。")
+        return {}
+
+    label_store = LabelStore(labels_root_dir) if use_label_store else None
+    jobs = [(os.path.join(predictions_root_dir, v), os.path.join(labels_root_dir, v),
+             iou_thresholds, score_thresholds, num_classes, label_store) for v in video_folders]
+    if num_workers == 0:
+        video_stats = list(map(_sweep_video_job, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            video_stats = list(executor.map(_sweep_video_job, jobs))
+
+    def recall_table(tp, gt_count):
+        total_gt = gt_count.sum()
+        overall = tp.sum(axis=2) / total_gt if total_gt > 0 else np.zeros(tp.shape[:2])
+        classes = {}
+        for class_id in np.nonzero(gt_count)[0]:
+            class_name = class_names[class_id] if class_id < len(class_names) else f"Class {class_id}"
+            classes[class_name] = (tp[:, :, class_id] / gt_count[class_id]).tolist()
+        return {'overall': overall.tolist(), 'classes': classes}
+
+    results = {
+        'iou_thresholds': iou_thresholds,
+        'score_thresholds': score_thresholds,
+        'videos': {}
+    }
+    for video_folder, (tp, gt_count) in zip(video_folders, video_stats):
+        results['videos'][video_folder] = recall_table(tp, gt_count)
+
+    total_tp = sum(tp for tp, _ in video_stats)
+    total_gt = sum(gt_count for _, gt_count in video_stats)
+    results.update(recall_table(total_tp, total_gt))
+
+    print(f"\n--- 计算结果 (总真实目标数: {int(total_gt.sum())}) ---")
+    for j, score_threshold in enumerate(score_thresholds):
+        print(f"\n置信度 >= {score_threshold:.2f}:")
+        header = f"{'类别':<12}" + "".join(f"{'IoU=' + format(t, '.2f'):<10}" for t in iou_thresholds)
+        print(header)
+        for class_name, table in results['classes'].items():
+            print(f"{class_name:<12}" + "".join(f"{table[i][j]:<10.4f}" for i in range(len(iou_thresholds))))
+        print(f"{'总体':<12}" + "".join(f"{results['overall'][i][j]:<10.4f}" for i in range(len(iou_thresholds))))
+
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n召回率表已保存到: {output_file}")
+
+    print("\n--- 计算完毕 ---")
+    return results
+
+
 if __name__ == "__main__":
     # --- 配置您的路径和参数 ---
     # **请修改为您的实际数据集根目录**
@@ -205,10 +346,27 @@ if __name__ == "__main__":
     # **IoU 阈值设置为 0.3，如你所要求**
     IOU_THRESHOLD = 0.3
 
-    # 运行召回率计算
-    overall_recall, class_recall_results = calculate_recall(
-        predictions_root,
-        labels_root,
-        iou_threshold=IOU_THRESHOLD,
-        classes_path=classes_file_path
-    )
\ No newline at end of file
+    # 是否一次计算多个 IoU / 置信度阈值下的召回率表
+    SWEEP = False
+    SWEEP_IOU_THRESHOLDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+    SWEEP_SCORE_THRESHOLDS = [0.1, 0.3, 0.5]
+
+    if SWEEP:
+        calculate_recall_sweep(
+            predictions_root,
+            labels_root,
+            iou_thresholds=SWEEP_IOU_THRESHOLDS,
+            score_thresholds=SWEEP_SCORE_THRESHOLDS,
+            classes_path=classes_file_path,
+            output_file="recall_sweep_results.json",
+            use_label_store=False
+        )
+    else:
+        # 运行召回率计算
+        overall_recall, class_recall_results = calculate_recall(
+            predictions_root,
+            labels_root,
+            iou_threshold=IOU_THRESHOLD,
+            classes_path=classes_file_path,
+            use_label_store=False
+        )
\ No newline at end of file
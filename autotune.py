@@ -0,0 +1,154 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Pick batch_size / num_ref_frames / num_queries / checkpointing for a device.
+
+Every candidate configuration runs a few synthetic training steps through
+engine_multi.train_one_epoch (forward, criterion, backward, optimizer step)
+while its peak memory is recorded: the CUDA allocator peak, or the process
+RSS high-water mark on CPU. On CPU the RSS also holds memory the allocator
+kept from earlier probes, so the CPU numbers are conservative. Batch sizes
+are tried in increasing order and the search stops at the first one over
+the memory budget. The fastest configuration (training samples/s) within
+the budget is written to ``autotune.json`` in the output dir.
+
+The multi-frame model fuses exactly one clip per forward (TDAM), so for
+the multi-frame datasets the batch size is pinned to 1 and only the other
+settings are searched.
+"""
+import copy
+import gc
+import io
+import itertools
+import json
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import torch
+
+import util.misc_multi as utils
+from datasets.tzb_multi import RESIZE_SCALES, RESIZE_MAX_SIZE
+from engine_multi import train_one_epoch
+from models import build_model
+from util.memory import available_memory_mb, peak_memory_mb, reset_peak_memory
+
+
+def synthetic_batches(batch_size, num_ref_frames, frame_size, num_batches, num_objects=5, seed=0):
+    """Collated training batches of random clips with random boxes."""
+    g = torch.Generator().manual_seed(seed)
+    h, w = frame_size
+    batch = []
+    for i in range(batch_size):
+        centers = torch.rand(num_objects, 2, generator=g) * 0.8 + 0.1
+        sizes = torch.rand(num_objects, 2, generator=g) * 0.05 + 0.01
+        target = {
+            'boxes': torch.cat([centers, sizes], dim=1),
+            'labels': torch.randint(1, 7, (num_objects,), generator=g),
+            'image_id': torch.tensor([i]),
+            'orig_size': torch.tensor([h, w]),
+            'size': torch.tensor([h, w]),
+        }
+        batch.append((torch.randn(num_ref_frames + 1, h, w, generator=g), target))
+    collated = utils.collate_fn(batch)
+    return [collated] * num_batches
+
+
+def is_out_of_memory(e):
+    return isinstance(e, MemoryError) or 'out of memory' in str(e)
+
+
+def probe(args, config, device, frame_size, num_steps):
+    """Samples/s and peak memory (MB) of a few training steps of ``config``."""
+    probe_args = copy.deepcopy(args)
+    probe_args.batch_size = config['batch_size']
+    probe_args.num_ref_frames = config['num_ref_frames']
+    probe_args.num_queries = config['num_queries']
+    probe_args.checkpoint = config['checkpoint']
+    probe_args.pretrained = None
+    probe_args.wavelet_pretrained = None
+
+    model = criterion = optimizer = None
+    try:
+        reset_peak_memory(device)
+        model, criterion, _ = build_model(probe_args)
+        model.to(device)
+        optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                      lr=args.lr, weight_decay=args.weight_decay)
+        warmup = synthetic_batches(config['batch_size'], config['num_ref_frames'], frame_size, 1)
+        batches = synthetic_batches(config['batch_size'], config['num_ref_frames'], frame_size, num_steps)
+        with redirect_stdout(io.StringIO()):
+            train_one_epoch(model, criterion, warmup, optimizer, device, 0, args.clip_max_norm)
+            start = time.perf_counter()
+            train_one_epoch(model, criterion, batches, optimizer, device, 0, args.clip_max_norm)
+            elapsed = time.perf_counter() - start
+        return {'samples_per_s': num_steps * config['batch_size'] / elapsed,
+                'peak_memory_mb': peak_memory_mb(device)}
+    except Exception as e:
+        if is_out_of_memory(e):
+            return {'error': 'out of memory'}
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    finally:
+        del model, criterion, optimizer
+        gc.collect()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+MULTI_DATASETS = ('tzb_multi', 'vid_multi')
+
+
+def autotune(args):
+    device = torch.device(args.device)
+    batch_sizes = sorted(args.autotune_batch_sizes)
+    note = None
+    if args.dataset_file in MULTI_DATASETS and batch_sizes != [1]:
+        # TDAM fuses the frames of exactly one clip per forward
+        batch_sizes = [1]
+        note = 'batch size pinned to 1: the multi-frame model takes one clip per forward'
+        print('Autotune: ' + note)
+    frame_size = tuple(args.autotune_frame_size or (max(RESIZE_SCALES), RESIZE_MAX_SIZE))
+    budget = args.autotune_memory_mb
+    if budget is None:
+        reset_peak_memory(device)
+        baseline = 0 if device.type == 'cuda' else peak_memory_mb(device)
+        budget = 0.9 * (available_memory_mb(device) + baseline)
+    print('Autotune: memory budget {:.0f} MB, frame size {}x{}'.format(budget, *frame_size))
+
+    results = []
+    for num_ref_frames, num_queries, checkpoint in itertools.product(
+            args.autotune_ref_frames or [args.num_ref_frames],
+            args.autotune_queries or [args.num_queries],
+            [False, True]):
+        for batch_size in batch_sizes:
+            config = {'batch_size': batch_size, 'num_ref_frames': num_ref_frames,
+                      'num_queries': num_queries, 'checkpoint': checkpoint}
+            result = probe(args, config, device, frame_size, args.autotune_steps)
+            result.update(config)
+            result['fits'] = 'error' not in result and result['peak_memory_mb'] <= budget
+            results.append(result)
+            print('  {}: {}'.format(config, result.get('error') or '{:.2f} samples/s, {:.0f} MB'.format(
+                result['samples_per_s'], result['peak_memory_mb'])))
+            if not result['fits']:
+                # larger batches only need more memory
+                break
+
+    fitting = [r for r in results if r['fits']]
+    best = max(fitting, key=lambda r: r['samples_per_s']) if fitting else None
+    report = {'memory_budget_mb': budget, 'frame_size': frame_size, 'device': args.device,
+              'batch_sizes': batch_sizes, 'note': note, 'best': best, 'probes': results}
+    if args.output_dir:
+        with (Path(args.output_dir) / 'autotune.json').open('w') as f:
+            json.dump(report, f, indent=2)
+    if best is None:
+        print('Autotune: no configuration fits in {:.0f} MB'.format(budget))
+    else:
+        print('Autotune: best {:.2f} samples/s at {:.0f} MB with --batch_size {} --num_ref_frames {} '
+              '--num_queries {}{}'.format(best['samples_per_s'], best['peak_memory_mb'], best['batch_size'],
+                                          best['num_ref_frames'], best['num_queries'],
+                                          ' --checkpoint' if best['checkpoint'] else ''))
+    return report
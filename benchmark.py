@@ -9,63 +9,216 @@
 # ------------------------------------------------------------------------
 
 """
-Benchmark inference speed of Deformable DETR.
+Benchmark inference of the single-frame and multi-frame models.
+
+Sweeps model, backbone variant, input resolution, num_ref_frames,
+num_queries and batch size on CPU or GPU. Inputs are random frames, or the
+first val sample with --use_dataset (the dataset transforms then decide the
+resolution). For every configuration the report has latency percentiles,
+throughput, peak memory (CUDA allocator, or process RSS on CPU) and, with
+--stage_breakdown, the per-stage times of util/stage_profiler measured in a
+separate pass. Results are written as JSON; with --baseline they are
+compared to a stored run and regressions make the script exit with status 1.
+
+Unknown arguments are passed to the main.py parser, e.g. --hidden_dim.
 """
+import argparse
+import copy
+import itertools
+import json
 import os
+import sys
 import time
-import argparse
 
+import numpy as np
 import torch
 
 from main import get_args_parser as get_main_args_parser
 from models import build_model
 from datasets import build_dataset
-from util.misc import nested_tensor_from_tensor_list
+from util import misc, misc_multi, stage_profiler
+from util.checkpoint import load_checkpoint
+from util.memory import peak_memory_mb, reset_peak_memory
+
+MODEL_DATASETS = {'multi': 'tzb_multi', 'single': 'tzb_single'}
 
 
 def get_benckmark_arg_parser():
     parser = argparse.ArgumentParser('Benchmark inference speed of Deformable DETR.')
-    parser.add_argument('--num_iters', type=int, default=300, help='total iters to benchmark speed')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--models', default=['multi'], nargs='+', choices=sorted(MODEL_DATASETS))
+    parser.add_argument('--backbones', default=['swin_t_p4w7'], nargs='+')
+    parser.add_argument('--resolutions', default=[600], type=int, nargs='+', help='square input sizes')
+    parser.add_argument('--num_ref_frames', default=[3], type=int, nargs='+')
+    parser.add_argument('--num_queries', default=None, type=int, nargs='+',
+                        help='defaults to the main.py value')
+    parser.add_argument('--batch_sizes', default=[1], type=int, nargs='+')
+    parser.add_argument('--num_iters', type=int, default=50, help='total iters to benchmark speed')
     parser.add_argument('--warm_iters', type=int, default=5, help='ignore first several iters that are very slow')
-    parser.add_argument('--batch_size', type=int, default=1, help='batch size in inference')
     parser.add_argument('--resume', type=str, help='load the pre-trained checkpoint')
+    parser.add_argument('--use_dataset', action='store_true', help='use the first val sample instead of random frames')
+    parser.add_argument('--stage_breakdown', action='store_true', help='add per-stage times (extra pass)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON report')
+    parser.add_argument('--baseline', default=None, help='JSON report of an earlier run to compare against')
+    parser.add_argument('--update_baseline', action='store_true', help='write this run to --baseline')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative slowdown / memory growth reported as a regression')
     return parser
 
 
+def config_key(config):
+    return '{model}|{backbone}|{resolution}|ref{num_ref_frames}|q{num_queries}|bs{batch_size}|{device}'.format(**config)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def make_inputs(config, device, dataset=None):
+    """Batch for one forward: ``batch_size`` frames (single) or one clip of ``num_ref_frames + 1`` frames (multi)."""
+    num_frames = config['num_ref_frames'] + 1 if config['model'] == 'multi' else 1
+    if dataset is not None:
+        sample = dataset[0][0][:num_frames]
+    else:
+        size = config['resolution']
+        sample = torch.rand(num_frames, size, size)
+    if config['model'] == 'multi':
+        # frames of a clip are split into the batch by nested_tensor_from_tensor_list
+        return misc_multi.nested_tensor_from_tensor_list([sample.to(device)])
+    return misc.nested_tensor_from_tensor_list([sample.to(device) for _ in range(config['batch_size'])])
+
+
 @torch.no_grad()
-def measure_average_inference_time(model, inputs, num_iters=100, warm_iters=5):
+def measure(model, inputs, device, num_iters, warm_iters):
     ts = []
     for iter_ in range(num_iters):
-        torch.cuda.synchronize()
+        synchronize(device)
         t_ = time.perf_counter()
         model(inputs)
-        torch.cuda.synchronize()
+        synchronize(device)
         t = time.perf_counter() - t_
         if iter_ >= warm_iters:
-          ts.append(t)
-    print(ts)
-    return sum(ts) / len(ts)
+            ts.append(t)
+    return np.asarray(ts)
+
+
+@torch.no_grad()
+def measure_stages(model, inputs, device, num_iters):
+    profiler = stage_profiler.StageProfiler(device)
+    stage_profiler.enable(profiler)
+    try:
+        for _ in range(num_iters):
+            profiler.push('model')
+            model(inputs)
+            profiler.pop()
+            profiler.step()
+    finally:
+        stage_profiler.disable()
+    return profiler.summary()
+
+
+def run_config(config, main_args, args, device):
+    model_args = copy.deepcopy(main_args)
+    model_args.device = config['device']
+    model_args.dataset_file = MODEL_DATASETS[config['model']]
+    model_args.backbone = config['backbone']
+    model_args.num_ref_frames = config['num_ref_frames']
+    model_args.num_queries = config['num_queries']
+    model_args.batch_size = config['batch_size']
+    if model_args.wavelet_pretrained and not os.path.exists(model_args.wavelet_pretrained):
+        model_args.wavelet_pretrained = None
+
+    if config['model'] == 'multi' and config['batch_size'] != 1:
+        # TDAM fuses the frames of exactly one clip per forward
+        return {'skipped': 'the multi-frame model takes one clip per forward'}
+
+    dataset = build_dataset('val', model_args) if args.use_dataset else None
+    model, _, _ = build_model(model_args)
+    model.to(device)
+    model.eval()
+    if args.resume is not None:
+        model.load_state_dict(load_checkpoint(args.resume)['model'], strict=False)
+    inputs = make_inputs(config, device, dataset)
+    frames_per_iter = config['batch_size']
+
+    reset_peak_memory(device)
+    ts = measure(model, inputs, device, args.num_iters, args.warm_iters)
+    result = {
+        'latency_ms': {'mean': ts.mean() * 1000, 'p50': np.percentile(ts, 50) * 1000,
+                       'p90': np.percentile(ts, 90) * 1000, 'p99': np.percentile(ts, 99) * 1000},
+        'throughput_fps': frames_per_iter / ts.mean(),
+        'peak_memory_mb': peak_memory_mb(device),
+        'input_shape': list(inputs.tensors.shape),
+    }
+    if args.stage_breakdown:
+        result['stages_s'] = measure_stages(model, inputs, device, max(args.num_iters - args.warm_iters, 1))
+    del model, inputs
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Configurations that got slower or use more memory than ``baseline`` by more than ``tolerance``."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or 'skipped' in result or 'skipped' in base:
+            continue
+        for metric, value, base_value in (
+                ('latency_p50_ms', result['latency_ms']['p50'], base['latency_ms']['p50']),
+                ('peak_memory_mb', result['peak_memory_mb'], base['peak_memory_mb'])):
+            if value > base_value * (1 + tolerance):
+                regressions.append({'config': key, 'metric': metric, 'baseline': base_value, 'current': value,
+                                    'change': value / base_value - 1})
+    return regressions
 
 
 def benchmark():
     args, _ = get_benckmark_arg_parser().parse_known_args()
     main_args = get_main_args_parser().parse_args(_)
     assert args.warm_iters < args.num_iters and args.num_iters > 0 and args.warm_iters >= 0
-    assert args.batch_size > 0
+    assert min(args.batch_sizes) > 0
     assert args.resume is None or os.path.exists(args.resume)
-    dataset = build_dataset('val', main_args)
-    model, _, _ = build_model(main_args)
-    model.cuda()
-    model.eval()
-    if args.resume is not None:
-        ckpt = torch.load(args.resume, map_location=lambda storage, loc: storage)
-        model.load_state_dict(ckpt['model'])
-    inputs = nested_tensor_from_tensor_list([dataset.__getitem__(0)[0].cuda() for _ in range(args.batch_size)])
-    t = measure_average_inference_time(model, inputs, args.num_iters, args.warm_iters)
-    return 1.0 / t * args.batch_size
+    device = torch.device(args.device)
+    main_args.pretrained = None
 
+    results = {}
+    for model_name, backbone, resolution, num_ref_frames, num_queries, batch_size in itertools.product(
+            args.models, args.backbones, args.resolutions, args.num_ref_frames,
+            args.num_queries or [main_args.num_queries], args.batch_sizes):
+        config = {'model': model_name, 'backbone': backbone, 'resolution': resolution,
+                  'num_ref_frames': num_ref_frames if model_name == 'multi' else 0,
+                  'num_queries': num_queries, 'batch_size': batch_size, 'device': args.device}
+        key = config_key(config)
+        if key in results:
+            continue
+        print('Benchmarking {}'.format(key))
+        result = run_config(config, main_args, args, device)
+        result['config'] = config
+        results[key] = result
+        if 'skipped' in result:
+            print('  skipped: {}'.format(result['skipped']))
+        else:
+            print('  p50 {:.1f} ms, p90 {:.1f} ms, {:.1f} FPS, peak memory {:.0f} MB'.format(
+                result['latency_ms']['p50'], result['latency_ms']['p90'],
+                result['throughput_fps'], result['peak_memory_mb']))
+
+    report = {'results': results, 'regressions': []}
+    if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f)['results'], args.tolerance)
+        for r in report['regressions']:
+            print('REGRESSION {config}: {metric} {baseline:.1f} -> {current:.1f} ({change:+.1%})'.format(**r))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
 
-if __name__ == '__main__':
-    fps = benchmark()
-    print(f'Inference Speed: {fps:.1f} FPS')
 
+if __name__ == '__main__':
+    report = benchmark()
+    sys.exit(1 if report['regressions'] else 0)
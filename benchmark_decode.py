@@ -0,0 +1,82 @@
+"""
+Benchmark frame decode throughput of the multi-frame data loader.
+
+Compares the full-resolution decode used by default with the reduced-size
+JPEG decode enabled by --reduced_decode, both followed by the exact resize to
+the training resolution. Uses the frames under --image_dir, or writes synthetic
+high-resolution JPEGs when no directory is given.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from datasets.transforms_multi import get_size_with_aspect_ratio
+from datasets.tzb_multi import RESIZE_SCALES, RESIZE_MAX_SIZE
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark frame decode throughput.')
+    parser.add_argument('--image_dir', default=None, type=str, help='directory of JPEG frames to decode')
+    parser.add_argument('--num_images', default=50, type=int, help='number of synthetic frames to write')
+    parser.add_argument('--width', default=3840, type=int, help='width of the synthetic frames')
+    parser.add_argument('--height', default=2160, type=int, help='height of the synthetic frames')
+    parser.add_argument('--repeats', default=3, type=int, help='passes over the frames per mode')
+    return parser
+
+
+def write_synthetic_frames(out_dir, num_images, width, height):
+    rng = np.random.RandomState(0)
+    paths = []
+    # smooth background plus noise, closer to real footage than pure noise
+    yy, xx = np.mgrid[0:height, 0:width]
+    base = (127 + 60 * np.sin(xx / 97.0) * np.cos(yy / 61.0)).astype(np.float32)
+    for i in range(num_images):
+        frame = base + rng.normal(0, 8, size=base.shape)
+        img = Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8), mode='L')
+        path = os.path.join(out_dir, '{:06d}.jpg'.format(i))
+        img.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def decode(path, reduced):
+    img = Image.open(path)
+    oh, ow = get_size_with_aspect_ratio(img.size, max(RESIZE_SCALES), RESIZE_MAX_SIZE)
+    if reduced:
+        img.draft('L', (ow, oh))
+    img = img.convert('L')
+    return img.resize((ow, oh), Image.BILINEAR)
+
+
+def measure(paths, reduced, repeats):
+    decode(paths[0], reduced)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for path in paths:
+            decode(path, reduced)
+    return len(paths) * repeats / (time.perf_counter() - t0)
+
+
+def benchmark(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.image_dir is not None:
+            paths = sorted(os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+                           if f.lower().endswith(('.jpg', '.jpeg')))
+        else:
+            paths = write_synthetic_frames(tmp_dir, args.num_images, args.width, args.height)
+        assert len(paths) > 0, 'no JPEG frames found'
+        source_size = Image.open(paths[0]).size
+        full = measure(paths, False, args.repeats)
+        reduced = measure(paths, True, args.repeats)
+    print(f'frames: {len(paths)}, source size: {source_size}')
+    print(f'full decode:    {full:.1f} frames/s')
+    print(f'reduced decode: {reduced:.1f} frames/s ({reduced / full:.2f}x)')
+    return full, reduced
+
+
+if __name__ == '__main__':
+    benchmark(get_args_parser().parse_args())
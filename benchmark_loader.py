@@ -0,0 +1,174 @@
+"""
+Benchmark throughput of the multi-frame training data pipeline.
+
+Builds datasets/tzb_multi for every combination of --num_ref_frames and
+--cache_mode and measures samples/s of the DataLoader (with the main.py
+collate_fn) for every --num_workers. A separate in-process pass splits the
+per-sample time into I/O, decode, reference sampling, target preparation,
+transforms and collate. Without --tzb_path a synthetic dataset is written
+to a temporary directory (see synthetic_tzb.py), so the benchmark runs
+without the real data.
+
+Unknown arguments are passed to the main.py parser, e.g. --reduced_decode.
+"""
+import argparse
+import copy
+import io
+import itertools
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+import util.misc_multi as utils
+from datasets.tzb_multi import build
+from main import get_args_parser as get_main_args_parser
+from synthetic_tzb import generate_dataset, parse_resolution
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark the multi-frame data pipeline.')
+    parser.add_argument('--tzb_path', default=None, type=str, help='dataset root; synthetic data when omitted')
+    parser.add_argument('--image_set', default='train_tzb', choices=['train_tzb', 'val'])
+    parser.add_argument('--num_workers', default=[0, 2, 4], type=int, nargs='+')
+    parser.add_argument('--cache_mode', default=[0], type=int, nargs='+', choices=[0, 1])
+    parser.add_argument('--num_ref_frames', default=[3], type=int, nargs='+')
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--num_batches', default=50, type=int, help='batches per throughput measurement')
+    parser.add_argument('--num_stage_samples', default=20, type=int, help='samples of the per-stage pass')
+    parser.add_argument('--synthetic_videos', default=4, type=int)
+    parser.add_argument('--synthetic_frames', default=60, type=int)
+    parser.add_argument('--synthetic_resolution', default='1280x720', type=str)
+    parser.add_argument('--output', default=None, type=str, help='write the results as JSON')
+    return parser
+
+
+class StageTimer(object):
+    """Instruments a tzb_multi CocoDetection in place and accumulates time per stage."""
+
+    def __init__(self, dataset):
+        self.times = defaultdict(float)
+        self.dataset = dataset
+        dataset.get_image = self._get_image
+        dataset.sample_train_ref_ids = self._timed('ref_sampling', dataset.sample_train_ref_ids)
+        dataset.cocovid.get_img_ids_from_vid = self._timed('ref_sampling', dataset.cocovid.get_img_ids_from_vid)
+        dataset.prepare = self._timed('prepare', dataset.prepare)
+        dataset._transforms = self._timed('transforms', dataset._transforms)
+
+    def _timed(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.times[stage] += time.perf_counter() - start
+        return wrapper
+
+    def _get_image(self, path, draft_size=None):
+        # same steps as TvCocoDetection.get_image, split into reading and decoding
+        start = time.perf_counter()
+        dataset = self.dataset
+        if dataset.cache_mode:
+            if path not in dataset.cache.keys():
+                with open(os.path.join(dataset.root, path), 'rb') as f:
+                    dataset.cache[path] = f.read()
+            data = dataset.cache[path]
+        else:
+            with open(os.path.join(dataset.root, path), 'rb') as f:
+                data = f.read()
+        decode_start = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        if draft_size is not None:
+            img.draft('L', draft_size)
+        img = img.convert('L')
+        self.times['io'] += decode_start - start
+        self.times['decode'] += time.perf_counter() - decode_start
+        return img
+
+
+def build_dataset(main_args, image_set, num_ref_frames, cache_mode):
+    args = copy.deepcopy(main_args)
+    args.num_ref_frames = num_ref_frames
+    args.cache_mode = bool(cache_mode)
+    args.eval = image_set == 'val'
+    return build(image_set, args)
+
+
+def measure_throughput(dataset, batch_size, num_workers, num_batches):
+    loader = DataLoader(dataset, batch_size, shuffle=True, drop_last=True, collate_fn=utils.collate_fn,
+                        num_workers=num_workers)
+    num_batches = min(num_batches, len(loader))
+    it = iter(loader)
+    next(it)  # worker start-up and first batch are not timed
+    start = time.perf_counter()
+    for _ in range(num_batches - 1):
+        next(it)
+    elapsed = time.perf_counter() - start
+    del it
+    return (num_batches - 1) * batch_size / max(elapsed, 1e-9)
+
+
+def measure_stages(dataset, batch_size, num_samples):
+    timer = StageTimer(dataset)
+    g = torch.Generator().manual_seed(0)
+    indices = torch.randperm(len(dataset), generator=g)[:num_samples].tolist()
+    total_start = time.perf_counter()
+    for start in range(0, len(indices), batch_size):
+        batch = [dataset[i] for i in indices[start:start + batch_size]]
+        collate_start = time.perf_counter()
+        utils.collate_fn(batch)
+        timer.times['collate'] += time.perf_counter() - collate_start
+    total = time.perf_counter() - total_start
+    stages = {k: v / len(indices) * 1000 for k, v in sorted(timer.times.items())}
+    stages['total'] = total / len(indices) * 1000
+    return stages
+
+
+def benchmark():
+    args, rest = get_args_parser().parse_known_args()
+    main_args = get_main_args_parser().parse_args(rest)
+    assert args.num_batches > 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tzb_path is None:
+            print('Writing synthetic dataset to {}'.format(tmp_dir))
+            generate_dataset(tmp_dir, num_videos=args.synthetic_videos, min_frames=args.synthetic_frames,
+                             max_frames=args.synthetic_frames,
+                             resolutions=[parse_resolution(args.synthetic_resolution)],
+                             val_videos=min(1, args.synthetic_videos - 1))
+            main_args.tzb_path = tmp_dir
+        else:
+            main_args.tzb_path = args.tzb_path
+
+        results = []
+        for num_ref_frames, cache_mode in itertools.product(args.num_ref_frames, args.cache_mode):
+            dataset = build_dataset(main_args, args.image_set, num_ref_frames, cache_mode)
+            result = {'num_ref_frames': num_ref_frames, 'cache_mode': cache_mode,
+                      'stages_ms_per_sample': measure_stages(dataset, args.batch_size, args.num_stage_samples),
+                      'samples_per_s': {}}
+            for num_workers in args.num_workers:
+                # fresh dataset: the stage pass replaced some of its methods
+                dataset = build_dataset(main_args, args.image_set, num_ref_frames, cache_mode)
+                result['samples_per_s'][num_workers] = measure_throughput(
+                    dataset, args.batch_size, num_workers, args.num_batches)
+            results.append(result)
+
+            stages = ', '.join('{} {:.1f}'.format(k, v) for k, v in result['stages_ms_per_sample'].items())
+            print('num_ref_frames={} cache_mode={}'.format(num_ref_frames, cache_mode))
+            print('  ms/sample: {}'.format(stages))
+            for num_workers, rate in result['samples_per_s'].items():
+                print('  num_workers={:<3d} {:.1f} samples/s'.format(num_workers, rate))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,91 @@
+"""
+Benchmark the cost of per-step metric synchronization in the training loop.
+
+Runs a synthetic training step (an MLP forward/backward producing a loss dict
+shaped like the SetCriterion output) with the logging of
+engine_multi.train_one_epoch, once with a .item() / host sync on every logged
+value per step and once with --deferred_metrics (values stay on the device
+and are flushed every print_freq steps). The gap is the per-step stall the
+deferred path removes; it is largest on GPU with small steps.
+"""
+import argparse
+import io
+import time
+from contextlib import redirect_stdout
+
+import torch
+
+import util.misc_multi as utils
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark per-step metric synchronization.')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', default=200, type=int)
+    parser.add_argument('--width', default=1024, type=int, help='hidden size of the synthetic model')
+    parser.add_argument('--num_losses', default=30, type=int, help='entries of the synthetic loss dict')
+    parser.add_argument('--print_freq', default=10, type=int)
+    return parser
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(args, deferred):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(*[torch.nn.Linear(args.width, args.width) for _ in range(4)]).to(args.device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    x = torch.randn(64, args.width, device=args.device)
+    weight_dict = {'loss_{}'.format(i): 1.0 for i in range(args.num_losses)}
+
+    metric_logger = utils.MetricLogger(delimiter="  ", reduce=deferred)
+    watchdog = utils.NonFiniteWatchdog() if deferred else None
+    synchronize(args.device)
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for step, _ in enumerate(metric_logger.log_every(range(args.steps), args.print_freq)):
+            out = model(x)
+            loss_dict = {k: (out[:, i::args.num_losses] ** 2).mean() for i, k in enumerate(weight_dict)}
+            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict)
+            if deferred:
+                loss_dict_reduced = {k: v.detach() for k, v in loss_dict.items()}
+            else:
+                loss_dict_reduced = utils.reduce_dict(loss_dict)
+            loss_dict_reduced_scaled = {k: v * weight_dict[k] for k, v in loss_dict_reduced.items()}
+            loss_value = sum(loss_dict_reduced_scaled.values())
+            if deferred:
+                watchdog.update(loss_value, step)
+                if step % args.print_freq == args.print_freq - 1:
+                    watchdog.check()
+            else:
+                loss_value = loss_value.item()
+
+            optimizer.zero_grad()
+            losses.backward()
+            grad_norm = utils.get_total_grad_norm(model.parameters())
+            optimizer.step()
+
+            values = dict(loss_dict_reduced_scaled, grad_norm=grad_norm, loss=loss_value)
+            if not deferred:
+                # what MetricLogger.update did before deferral: one host sync per value
+                values = {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in values.items()}
+            metric_logger.update(**values)
+        metric_logger.synchronize_between_processes()
+    synchronize(args.device)
+    return args.steps / (time.perf_counter() - start)
+
+
+def benchmark(args):
+    run(args, deferred=True)  # warm-up
+    eager = run(args, deferred=False)
+    deferred = run(args, deferred=True)
+    print(f'device: {args.device}, steps: {args.steps}, logged values per step: {args.num_losses + 2}')
+    print(f'per-step sync:    {eager:.1f} steps/s')
+    print(f'deferred metrics: {deferred:.1f} steps/s ({deferred / eager:.2f}x)')
+    return eager, deferred
+
+
+if __name__ == '__main__':
+    benchmark(get_args_parser().parse_args())
@@ -4,78 +4,151 @@
 # Licensed under the Apache License, Version 2.0 [see LICENSE for details]
 # ------------------------------------------------------------------------
 
+import queue
+import threading
+import time
+
 import torch
 
-# def to_cuda(samples, targets, device):
-#     samples = samples.to(device, non_blocking=True)
-#     targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
-#     return samples, targets
 
-def to_cuda(samples, ref_samples, targets, device):
-    ref_samples = [ref_sample.to(device, non_blocking=True) for ref_sample in ref_samples]
+def to_device(samples, targets, device):
+    # targets is the PackedTargets built by util.misc_multi.collate_fn
     samples = samples.to(device, non_blocking=True)
-    targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
-    return samples, ref_samples, targets
+    targets = targets.to(device, non_blocking=True)
+    return samples, targets
+
 
 class data_prefetcher():
-    def __init__(self, loader, device, prefetch=True):
+    """Fetch the next (samples, targets) batch while the current one is being processed.
+
+    On a CUDA device the next batch is copied on a side stream, so the pinned
+    host-to-device copy overlaps with compute on the current stream. Without a
+    device stream a background thread keeps up to ``depth`` batches ready in a
+    queue. ``prefetch=False`` loads and copies synchronously.
+
+    The prefetcher is iterable and has the loader's length, so it can be passed
+    to ``MetricLogger.log_every`` in place of the loader. ``stats()`` reports how
+    long the loop was stalled waiting for data and how much of the loop time
+    was overlapped with loading.
+    """
+    def __init__(self, loader, device, prefetch=True, depth=2):
+        self.length = len(loader)
         self.loader = iter(loader)
+        self.device = torch.device(device)
         self.prefetch = prefetch
-        self.device = device
-        if prefetch:     
+        self.use_stream = prefetch and self.device.type == 'cuda' and torch.cuda.is_available()
+        self.use_thread = prefetch and not self.use_stream
+
+        self.wait_time = 0.0
+        self.busy_time = 0.0
+        self.num_batches = 0
+        self._last_return = None
+        self._copy_events = []
+
+        if self.use_stream:
             self.stream = torch.cuda.Stream()
             self.preload()
+        elif self.use_thread:
+            self._queue = queue.Queue(maxsize=max(depth, 1))
+            self._stop = threading.Event()
+            self._exhausted = False
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def _worker(self):
+        try:
+            for samples, targets in self.loader:
+                if self._stop.is_set():
+                    return
+                self._queue.put(to_device(samples, targets, self.device))
+            self._queue.put(None)
+        except Exception as e:
+            self._queue.put(e)
 
     def preload(self):
         try:
-            self.next_samples, self.next_ref_samples, self.next_targets = next(self.loader)
+            self.next_samples, self.next_targets = next(self.loader)
         except StopIteration:
             self.next_samples = None
             self.next_targets = None
-            self.next_ref_samples =None
             return
-        # if record_stream() doesn't work, another option is to make sure device inputs are created
-        # on the main stream.
-        # self.next_input_gpu = torch.empty_like(self.next_input, device='cuda')
-        # self.next_target_gpu = torch.empty_like(self.next_target, device='cuda')
-        # Need to make sure the memory allocated for next_* is not still in use by the main stream
-        # at the time we start copying to next_*:
-        # self.stream.wait_stream(torch.cuda.current_stream())
+        # the loader pins host memory, so the copy issued on the side stream
+        # runs asynchronously with whatever the current stream is computing
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
         with torch.cuda.stream(self.stream):
-            self.next_samples, self.next_ref_samples, self.next_targets = to_cuda(self.next_samples, self.next_ref_samples, self.next_targets, self.device)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-            # With Amp, it isn't necessary to manually convert data to half.
-            # if args.fp16:
-            #     self.next_input = self.next_input.half()
-            # else:
+            start.record(self.stream)
+            self.next_samples, self.next_targets = to_device(self.next_samples, self.next_targets, self.device)
+            end.record(self.stream)
+        self._copy_events.append((start, end))
 
     def next(self):
-        if self.prefetch:
+        t0 = time.time()
+        if self._last_return is not None:
+            self.busy_time += t0 - self._last_return
+
+        if self.use_stream:
             torch.cuda.current_stream().wait_stream(self.stream)
             samples = self.next_samples
             targets = self.next_targets
             if samples is not None:
                 samples.record_stream(torch.cuda.current_stream())
-            if targets is not None:
-                for t in targets:
-                    for k, v in t.items():
-                        v.record_stream(torch.cuda.current_stream())
+                targets.record_stream(torch.cuda.current_stream())
             self.preload()
+        elif self.use_thread:
+            item = self._queue.get() if not self._exhausted else None
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                self._exhausted = True
+                samples, targets = None, None
+            else:
+                samples, targets = item
         else:
             try:
-                # nested tensor, list[tensor]
-                samples, ref_samples, targets = next(self.loader)
-                assert ref_samples is None, [type(ref_samples[0]), type(ref_samples), type(samples), len(ref_samples), "ref_samples", ref_samples]
-                samples, ref_samples, targets = to_cuda(samples, ref_samples, targets, self.device)
+                samples, targets = next(self.loader)
+                samples, targets = to_device(samples, targets, self.device)
             except StopIteration:
                 samples = None
                 targets = None
-                ref_samples = None
-                assert True, "wwww"
+
+        end = time.time()
+        self.wait_time += end - t0
+        self._last_return = end
+        if samples is not None:
+            self.num_batches += 1
         return samples, targets
+
+    def close(self):
+        if self.use_thread and not self._exhausted:
+            self._stop.set()
+            # unblock the worker if it is waiting on a full queue
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    def stats(self):
+        total = self.wait_time + self.busy_time
+        stats = {
+            'prefetch_mode': 'stream' if self.use_stream else ('thread' if self.use_thread else 'sync'),
+            'data_wait_time': self.wait_time,
+            'compute_time': self.busy_time,
+            'data_overlap': self.busy_time / total if total > 0 else 0.0,
+        }
+        if self.use_stream:
+            torch.cuda.synchronize()
+            copy_ms = sum(s.elapsed_time(e) for s, e in self._copy_events)
+            stats['hidden_copy_time'] = copy_ms / 1000.0
+        return stats
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        try:
+            while True:
+                samples, targets = self.next()
+                if samples is None:
+                    return
+                yield samples, targets
+        finally:
+            self.close()
@@ -137,3 +137,134 @@ class NodeDistributedSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+def compute_bucket_ids(dataset, granularity=32):
+    """Assign every sample of ``dataset`` to a bucket of similar post-resize (h, w).
+
+    The dataset must provide ``get_resized_size(idx)``. Sizes are rounded up to
+    multiples of ``granularity`` so clips that pad to the same shape share a bucket.
+    """
+    buckets = {}
+    bucket_ids = []
+    for idx in range(len(dataset)):
+        h, w = dataset.get_resized_size(idx)
+        key = (int(math.ceil(h / granularity)), int(math.ceil(w / granularity)))
+        if key not in buckets:
+            buckets[key] = len(buckets)
+        bucket_ids.append(buckets[key])
+    return bucket_ids
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that only batches together samples of the same size bucket.
+
+    Wraps any index sampler (RandomSampler, DistributedSampler, ...), so the
+    shuffling and per-rank split of that sampler are kept. Indices are buffered
+    per bucket and a batch is emitted as soon as a bucket is full. The leftovers
+    of every bucket are batched at the end of the epoch, ordered by bucket, so
+    every index the wrapped sampler yields is still covered and each rank emits
+    the same number of batches as a plain BatchSampler would.
+    Arguments:
+        sampler: index sampler to wrap.
+        bucket_ids: bucket id of every dataset index, see compute_bucket_ids.
+        batch_size: size of the batches.
+        drop_last: drop the final incomplete batch.
+    """
+
+    def __init__(self, sampler, bucket_ids, batch_size, drop_last=True):
+        self.sampler = sampler
+        self.bucket_ids = bucket_ids
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        buffers = {}
+        for idx in self.sampler:
+            bucket = buffers.setdefault(self.bucket_ids[idx], [])
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                yield bucket
+                buffers[self.bucket_ids[idx]] = []
+
+        leftovers = [idx for b in sorted(buffers.keys()) for idx in buffers[b]]
+        for i in range(0, len(leftovers), self.batch_size):
+            batch = leftovers[i: i + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                return
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+def stratified_order(dataset, seed=0):
+    """Order the indices of a COCO-style ``dataset`` so that every prefix is class-stratified.
+
+    Each frame is assigned to the rarest category it contains (frames without
+    annotations form their own stratum). Every stratum is shuffled with
+    ``seed`` and its i-th frame is placed at relative position
+    (i + 0.5) / len(stratum), so the first k indices hold roughly
+    k * len(stratum) / len(dataset) frames of every stratum.
+    """
+    coco = dataset.coco
+    cat_counts = {}
+    for ann in coco.dataset['annotations']:
+        cat_counts[ann['category_id']] = cat_counts.get(ann['category_id'], 0) + 1
+
+    strata = {}
+    for idx, img_id in enumerate(dataset.ids):
+        cats = set(ann['category_id'] for ann in coco.imgToAnns[img_id])
+        key = min(cats, key=lambda c: (cat_counts[c], c)) if cats else -1
+        strata.setdefault(key, []).append(idx)
+
+    g = torch.Generator()
+    g.manual_seed(seed)
+    positions = []
+    for key in sorted(strata.keys()):
+        members = strata[key]
+        perm = torch.randperm(len(members), generator=g).tolist()
+        for i, j in enumerate(perm):
+            positions.append(((i + 0.5) / len(members), key, members[j]))
+    return [idx for _, _, idx in sorted(positions)]
+
+
+class SubsetSampler(Sampler):
+    """Sampler over the first ``num_samples`` entries of a fixed index order.
+
+    Used for subsampled validation with ``stratified_order``. The sampler runs
+    in the main process, so ``set_num_samples`` can resize the subset between
+    passes without restarting persistent DataLoader workers. Indices are split
+    across ranks and padded like DistributedSampler so every rank runs the
+    same number of steps.
+    Arguments:
+        indices: index order, every prefix of which is a valid subset.
+        num_samples: size of the subset taken from the front of ``indices``.
+        num_replicas (optional): Number of processes participating in
+            distributed evaluation.
+        rank (optional): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, indices, num_samples, num_replicas=1, rank=0):
+        self.indices = list(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.set_num_samples(num_samples)
+
+    def set_num_samples(self, num_samples):
+        self.num_samples = max(min(int(num_samples), len(self.indices)), 1)
+
+    def __iter__(self):
+        indices = self.indices[:self.num_samples]
+        per_rank = int(math.ceil(len(indices) * 1.0 / self.num_replicas))
+        indices += indices[: (per_rank * self.num_replicas - len(indices))]
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return int(math.ceil(self.num_samples * 1.0 / self.num_replicas))
@@ -53,13 +53,24 @@ class CocoDetection(VisionDataset):
                 self.cache[path] = f.read()
 
     #open image as grayscale
-    def get_image(self, path):
+    def get_image(self, path, draft_size=None):
+        """
+        Args:
+            path (string): image path relative to root.
+            draft_size (tuple, optional): (w, h) the image is about to be resized to. JPEGs are then
+                decoded with DCT-domain scaling to the smallest 1/2, 1/4 or 1/8 scale that is still
+                at least that large, instead of at full resolution.
+        """
         if self.cache_mode:
             if path not in self.cache.keys():
                 with open(os.path.join(self.root, path), 'rb') as f:
                     self.cache[path] = f.read()
-            return Image.open(BytesIO(self.cache[path])).convert('L')
-        return Image.open(os.path.join(self.root, path)).convert('L')
+            img = Image.open(BytesIO(self.cache[path]))
+        else:
+            img = Image.open(os.path.join(self.root, path))
+        if draft_size is not None:
+            img.draft('L', draft_size)
+        return img.convert('L')
 
     def __getitem__(self, index):
         """
@@ -114,28 +114,30 @@ def vflip(image,target):
 
     return flipped_image, target
 
-def resize(clip, target, size, max_size=None):
-    # size can be min_size (scalar) or (w, h) tuple
+def get_size_with_aspect_ratio(image_size, size, max_size=None):
+    # image_size is (w, h), returns the (h, w) the shorter side is resized to
+    w, h = image_size
+    if max_size is not None:
+        min_original_size = float(min((w, h)))
+        max_original_size = float(max((w, h)))
+        if max_original_size / min_original_size * size > max_size:
+            size = int(round(max_size * min_original_size / max_original_size))
 
-    def get_size_with_aspect_ratio(image_size, size, max_size=None):
-        w, h = image_size
-        if max_size is not None:
-            min_original_size = float(min((w, h)))
-            max_original_size = float(max((w, h)))
-            if max_original_size / min_original_size * size > max_size:
-                size = int(round(max_size * min_original_size / max_original_size))
+    if (w <= h and w == size) or (h <= w and h == size):
+        return (h, w)
 
-        if (w <= h and w == size) or (h <= w and h == size):
-            return (h, w)
+    if w < h:
+        ow = size
+        oh = int(size * h / w)
+    else:
+        oh = size
+        ow = int(size * w / h)
 
-        if w < h:
-            ow = size
-            oh = int(size * h / w)
-        else:
-            oh = size
-            ow = int(size * w / h)
+    return (oh, ow)
 
-        return (oh, ow)
+
+def resize(clip, target, size, max_size=None):
+    # size can be min_size (scalar) or (w, h) tuple
 
     def get_size(image_size, size, max_size=None):
         if isinstance(size, (list, tuple)):
@@ -23,11 +23,53 @@ from .torchvision_datasets import CocoDetection as TvCocoDetection
 from util.misc import get_local_rank, get_local_size
 import datasets.transforms_multi as T
 from torch.utils.data.dataset import ConcatDataset
+import math
 import random
 
+# shorter-side scales and long-side cap of the resize applied by make_coco_transforms
+RESIZE_SCALES = [600]
+RESIZE_MAX_SIZE = 1000
+
+
+def sample_val_ref_ids(img_id, img_ids, num_ref_frames, filter_key_img=True):
+    """Deterministic reference frames of key frame ``img_id`` among the (contiguous) ``img_ids`` of its video."""
+    ref_img_ids = []
+    Len = len(img_ids)
+    interval  = max(int(Len // 16), 1)
+
+    if num_ref_frames < 8:
+        left_indexs = int((img_id - img_ids[0]) // interval)
+        right_indexs = int((img_ids[-1] - img_id) // interval)
+        if left_indexs < num_ref_frames:
+            for i in range(num_ref_frames):
+                ref_img_ids.append(min(img_id + (i+1)*interval, img_ids[-1]))
+        else:
+            for i in range(num_ref_frames):
+                ref_img_ids.append(max(img_id - (i+1)* interval, img_ids[0]))
+
+    sample_range = []
+    if num_ref_frames >= 8:
+        left_indexs = int((img_ids[0] - img_id) // interval)
+        right_indexs = int((img_ids[-1] - img_id) // interval)
+        for i in range(left_indexs, right_indexs):
+            if i < 0:
+                index = max(img_id + i*interval, img_ids[0])
+                sample_range.append(index)
+            elif i > 0:
+                index = min(img_id + i * interval, img_ids[-1])
+                sample_range.append(index)
+        if filter_key_img and img_id in sample_range:
+            sample_range.remove(img_id)
+        while len(sample_range) < num_ref_frames:
+            print("sample_range", sample_range)
+            sample_range.extend(sample_range)
+        ref_img_ids = sample_range[:num_ref_frames]
+    return ref_img_ids
+
+
 class CocoDetection(TvCocoDetection):
     def __init__(self, img_folder, ann_file, transforms, return_masks, interval1, interval2, num_ref_frames= 3,
-        is_train = True,  filter_key_img=True,  cache_mode=False, local_rank=0, local_size=1):
+        is_train = True,  filter_key_img=True,  cache_mode=False, local_rank=0, local_size=1, reduced_decode=False):
         super(CocoDetection, self).__init__(img_folder, ann_file,
                                             cache_mode=cache_mode, local_rank=local_rank, local_size=local_size)
         self._transforms = transforms
@@ -38,9 +80,33 @@ class CocoDetection(TvCocoDetection):
         self.cocovid = CocoVID(self.ann_file)
         self.is_train = is_train
         self.filter_key_img = filter_key_img
+        # decode JPEGs at a reduced DCT scale close to the resize target, see TvCocoDetection.get_image
+        self.reduced_decode = reduced_decode and not return_masks
         self.interval1 = interval1
         self.interval2 = interval2
 
+    def get_resized_size(self, idx):
+        """(h, w) the key frame of sample ``idx`` has after the largest resize scale."""
+        img_info = self.coco.loadImgs(self.ids[idx])[0]
+        return T.get_size_with_aspect_ratio((img_info['width'], img_info['height']),
+                                            max(RESIZE_SCALES), RESIZE_MAX_SIZE)
+
+    def sample_train_ref_ids(self, img_id, img_ids):
+        """Randomly pick the reference frames of key frame ``img_id`` among the (contiguous) ``img_ids``."""
+        interval = self.num_ref_frames + 2 # *20
+        left = max(img_ids[0], img_id - interval)
+        right = min(img_ids[-1], img_id + interval)
+        sample_range = list(range(left, right+1))
+        if self.num_ref_frames >= 10:
+            sample_range = list(img_ids)
+
+        if self.filter_key_img and img_id in sample_range:
+            sample_range.remove(img_id)
+        while len(sample_range) < self.num_ref_frames:
+            # print("sample_range", sample_range)
+            sample_range.extend(sample_range)
+        return random.sample(sample_range, self.num_ref_frames)
+
     def __getitem__(self, idx):
         """
         Args:
@@ -58,12 +124,16 @@ class CocoDetection(TvCocoDetection):
         img_info = coco.loadImgs(img_id)[0]
         path = img_info['file_name']
         video_id = img_info['video_id']
-        img = self.get_image(path)
+        draft_size = None
+        if self.reduced_decode:
+            h, w = self.get_resized_size(idx)
+            draft_size = (w, h)
+        img = self.get_image(path, draft_size)
 
         # import pdb; pdb.set_trace()
   
         target = {'image_id': img_id, 'annotations': target}
-        img, target = self.prepare(img, target)
+        img, target = self.prepare(img, target, orig_size=(img_info['width'], img_info['height']) if draft_size else None)
         imgs.append(img)
         if video_id == -1:
             for i in range(self.num_ref_frames):
@@ -73,58 +143,16 @@ class CocoDetection(TvCocoDetection):
 
             ref_img_ids = []
             if self.is_train:
-                interval = self.num_ref_frames + 2 # *20
-                left = max(img_ids[0], img_id - interval)
-                right = min(img_ids[-1], img_id + interval)
-                sample_range = list(range(left, right+1))
-                if self.num_ref_frames >= 10:
-                    sample_range=img_ids
-
-                if self.filter_key_img and img_id in sample_range:
-                    sample_range.remove(img_id) 
-                while len(sample_range) < self.num_ref_frames:
-                    # print("sample_range", sample_range)
-                    sample_range.extend(sample_range)
-                ref_img_ids = random.sample(sample_range, self.num_ref_frames)
+                ref_img_ids = self.sample_train_ref_ids(img_id, img_ids)
 
             else:
-                ref_img_ids = []
-                Len = len(img_ids)
-                interval  = max(int(Len // 16), 1)
-
-                if self.num_ref_frames < 8:
-                    left_indexs = int((img_id - img_ids[0]) // interval)
-                    right_indexs = int((img_ids[-1] - img_id) // interval)
-                    if left_indexs < self.num_ref_frames:
-                        for i in range(self.num_ref_frames):
-                            ref_img_ids.append(min(img_id + (i+1)*interval, img_ids[-1]))
-                    else:
-                        for i in range(self.num_ref_frames):
-                            ref_img_ids.append(max(img_id - (i+1)* interval, img_ids[0]))
-
-                sample_range = []
-                if self.num_ref_frames >= 8:
-                    left_indexs = int((img_ids[0] - img_id) // interval)
-                    right_indexs = int((img_ids[-1] - img_id) // interval)
-                    for i in range(left_indexs, right_indexs):
-                        if i < 0:
-                            index = max(img_id + i*interval, img_ids[0])
-                            sample_range.append(index)
-                        elif i > 0:
-                            index = min(img_id + i * interval, img_ids[-1])
-                            sample_range.append(index)
-                    if self.filter_key_img and img_id in sample_range:
-                        sample_range.remove(img_id)
-                    while len(sample_range) < self.num_ref_frames:
-                        print("sample_range", sample_range)
-                        sample_range.extend(sample_range)
-                    ref_img_ids = sample_range[:self.num_ref_frames]
+                ref_img_ids = sample_val_ref_ids(img_id, img_ids, self.num_ref_frames, self.filter_key_img)
 
             for ref_img_id in ref_img_ids:
                 ref_ann_ids = coco.getAnnIds(imgIds=ref_img_id)
                 ref_img_info = coco.loadImgs(ref_img_id)[0]
                 ref_img_path = ref_img_info['file_name']
-                ref_img = self.get_image(ref_img_path)
+                ref_img = self.get_image(ref_img_path, draft_size)
                 imgs.append(ref_img)
         if self._transforms is not None:
             imgs, target = self._transforms(imgs, target) 
@@ -133,6 +161,119 @@ class CocoDetection(TvCocoDetection):
         return  torch.cat(imgs, dim=0),  target
 
 
+class WindowClipDataset(torch.utils.data.IterableDataset):
+    """Training clips drawn from resident windows of consecutive frames.
+
+    Every video of ``dataset`` is cut into windows of ``window_size`` consecutive
+    frames. A window is decoded once and then yields ``samples_per_window``
+    training samples, each with a different key frame and references sampled by
+    ``CocoDetection.sample_train_ref_ids`` restricted to the window, so decode and
+    I/O are shared by all samples of the window. ``open_windows`` windows are
+    resident at a time and samples are drawn from a random one of them, which
+    acts as a shuffle buffer across videos.
+
+    Windows are shuffled per epoch (see ``set_epoch``) and split across
+    distributed ranks and DataLoader workers.
+    """
+
+    def __init__(self, dataset, window_size=32, samples_per_window=8, open_windows=4,
+                 rank=0, world_size=1, seed=0):
+        assert dataset.is_train, 'window loading only supports training'
+        self.dataset = dataset
+        self.window_size = window_size
+        self.samples_per_window = samples_per_window
+        self.open_windows = max(open_windows, 1)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+        self.windows = []
+        cocovid = dataset.cocovid
+        for video_id in sorted(cocovid.get_vid_ids()):
+            img_ids = sorted(cocovid.get_img_ids_from_vid(video_id))
+            for start in range(0, len(img_ids), window_size):
+                self.windows.append(img_ids[start: start + window_size])
+        self.num_samples = sum(min(len(w), samples_per_window) for w in self.windows)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return int(math.ceil(self.num_samples / self.world_size))
+
+    def _assigned_windows(self):
+        """(window, number of key frames) pairs of this rank and worker.
+
+        Windows hold different numbers of samples, so like DistributedSampler
+        every rank's share is padded by repeating windows, or truncated, to
+        exactly ``len(self)`` samples; otherwise ranks would run a different
+        number of steps and the gradient all-reduce would hang.
+        """
+        g = random.Random(self.seed + self.epoch)
+        windows = list(self.windows)
+        g.shuffle(windows)
+        own = windows[self.rank::self.world_size] or windows
+        remaining = len(self)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            # every worker gets the same quota on all ranks, so drop_last drops the same batches
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            remaining = remaining // num_workers + int(worker_id < remaining % num_workers)
+            own = own[worker_id::num_workers] or own
+        assigned = []
+        i = 0
+        while remaining > 0:
+            window = own[i % len(own)]
+            count = min(len(window), self.samples_per_window, remaining)
+            assigned.append((window, count))
+            remaining -= count
+            i += 1
+        return assigned
+
+    def _open(self, window, count):
+        coco = self.dataset.coco
+        draft_size = None
+        if self.dataset.reduced_decode:
+            img_info = coco.loadImgs(window[0])[0]
+            h, w = T.get_size_with_aspect_ratio((img_info['width'], img_info['height']),
+                                                max(RESIZE_SCALES), RESIZE_MAX_SIZE)
+            draft_size = (w, h)
+        frames = {img_id: self.dataset.get_image(coco.loadImgs(img_id)[0]['file_name'], draft_size)
+                  for img_id in window}
+        key_ids = random.sample(window, count)
+        return {'img_ids': window, 'frames': frames, 'key_ids': key_ids, 'draft_size': draft_size}
+
+    def _make_sample(self, window, img_id):
+        coco = self.dataset.coco
+        img_info = coco.loadImgs(img_id)[0]
+        target = {'image_id': img_id, 'annotations': coco.loadAnns(coco.getAnnIds(imgIds=img_id))}
+        orig_size = (img_info['width'], img_info['height']) if window['draft_size'] else None
+        img, target = self.dataset.prepare(window['frames'][img_id], target, orig_size=orig_size)
+        ref_img_ids = self.dataset.sample_train_ref_ids(img_id, window['img_ids'])
+        imgs = [img] + [window['frames'][ref_img_id] for ref_img_id in ref_img_ids]
+        if self.dataset._transforms is not None:
+            imgs, target = self.dataset._transforms(imgs, target)
+        return torch.cat(imgs, dim=0), target
+
+    def __iter__(self):
+        pending = iter(self._assigned_windows())
+        resident = []
+        while True:
+            while len(resident) < self.open_windows:
+                window = next(pending, None)
+                if window is None:
+                    break
+                resident.append(self._open(*window))
+            if not resident:
+                return
+            window = random.choice(resident)
+            img_id = window['key_ids'].pop()
+            if not window['key_ids']:
+                resident.remove(window)
+            yield self._make_sample(window, img_id)
+
+
 def convert_coco_poly_to_mask(segmentations, height, width):
     masks = []
     for polygons in segmentations:
@@ -154,8 +295,9 @@ class ConvertCocoPolysToMask(object):
     def __init__(self, return_masks=False):
         self.return_masks = return_masks
 
-    def __call__(self, image, target):
-        w, h = image.size
+    def __call__(self, image, target, orig_size=None):
+        # orig_size (w, h) is given when the image was decoded below its original resolution
+        w, h = image.size if orig_size is None else orig_size
 
         image_id = target["image_id"]
         image_id = torch.tensor([image_id])
@@ -211,6 +353,14 @@ class ConvertCocoPolysToMask(object):
 
         target["orig_size"] = torch.as_tensor([int(h), int(w)])
         target["size"] = torch.as_tensor([int(h), int(w)])
+
+        decoded_w, decoded_h = image.size
+        if (decoded_w, decoded_h) != (w, h):
+            # bring the annotations to the resolution the image was actually decoded at
+            ratio_width, ratio_height = decoded_w / w, decoded_h / h
+            target["boxes"] = target["boxes"] * torch.as_tensor([ratio_width, ratio_height, ratio_width, ratio_height])
+            target["area"] = target["area"] * (ratio_width * ratio_height)
+            target["size"] = torch.as_tensor([int(decoded_h), int(decoded_w)])
         
         return image, target
 
@@ -227,31 +377,36 @@ def make_coco_transforms(image_set):
     if image_set == 'train_vid' or image_set == "train_det" or image_set == "train_joint" or image_set == "train_tzb":
         return T.Compose([
             T.RandomHorizontalFlip(),
-            T.RandomResize([600], max_size=1000),
+            T.RandomResize(RESIZE_SCALES, max_size=RESIZE_MAX_SIZE),
             normalize,
         ])
 
     if image_set == 'val':
         return T.Compose([
-            T.RandomResize([600], max_size=1000),
+            T.RandomResize(RESIZE_SCALES, max_size=RESIZE_MAX_SIZE),
             normalize,
         ])
 
     raise ValueError(f'unknown {image_set}')
 
 
+def get_paths(root):
+    """(image folder, annotation file) pairs of every image set under dataset root ``root``."""
+    return {
+        "train_tzb": [(root / "Data" , root / "annotations" / 'tzb_train_pure.json')],
+        "val": [(root / "Data" , root / "annotations" / 'tzb_test.json')],
+    }
+
+
 def build(image_set, args):
     root = Path(args.tzb_path)
     assert root.exists(), f'provided COCO path {root} does not exist'
     mode = 'instances'
-    PATHS = {
-        "train_tzb": [(root / "Data" , root / "annotations" / 'tzb_train_pure.json')],
-        "val": [(root / "Data" , root / "annotations" / 'tzb_test.json')],
-    }
+    PATHS = get_paths(root)
     datasets = []
     for (img_folder, ann_file) in PATHS[image_set]:
         dataset = CocoDetection(img_folder, ann_file, transforms=make_coco_transforms(image_set), is_train =(not args.eval), interval1=args.interval1,
-                                interval2=args.interval2, num_ref_frames = args.num_ref_frames, return_masks=args.masks, cache_mode=args.cache_mode, 
+                                interval2=args.interval2, num_ref_frames = args.num_ref_frames, return_masks=args.masks, cache_mode=args.cache_mode, reduced_decode=args.reduced_decode, 
                                 local_rank=get_local_rank(), local_size=get_local_size())
         datasets.append(dataset)
     if len(datasets) == 1:
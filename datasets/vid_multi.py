@@ -25,9 +25,14 @@ import datasets.transforms_multi as T
 from torch.utils.data.dataset import ConcatDataset
 import random
 
+# shorter-side scales and long-side cap of the resize applied by make_coco_transforms
+RESIZE_SCALES = [600]
+RESIZE_MAX_SIZE = 1000
+
+
 class CocoDetection(TvCocoDetection):
     def __init__(self, img_folder, ann_file, transforms, return_masks, interval1, interval2, num_ref_frames= 3,
-        is_train = True,  filter_key_img=True,  cache_mode=False, local_rank=0, local_size=1):
+        is_train = True,  filter_key_img=True,  cache_mode=False, local_rank=0, local_size=1, reduced_decode=False):
         super(CocoDetection, self).__init__(img_folder, ann_file,
                                             cache_mode=cache_mode, local_rank=local_rank, local_size=local_size)
         self._transforms = transforms
@@ -38,9 +43,17 @@ class CocoDetection(TvCocoDetection):
         self.cocovid = CocoVID(self.ann_file)
         self.is_train = is_train
         self.filter_key_img = filter_key_img
+        # decode JPEGs at a reduced DCT scale close to the resize target, see TvCocoDetection.get_image
+        self.reduced_decode = reduced_decode and not return_masks
         self.interval1 = interval1
         self.interval2 = interval2
 
+    def get_resized_size(self, idx):
+        """(h, w) the key frame of sample ``idx`` has after the largest resize scale."""
+        img_info = self.coco.loadImgs(self.ids[idx])[0]
+        return T.get_size_with_aspect_ratio((img_info['width'], img_info['height']),
+                                            max(RESIZE_SCALES), RESIZE_MAX_SIZE)
+
     def __getitem__(self, idx):
         """
         Args:
@@ -57,10 +70,14 @@ class CocoDetection(TvCocoDetection):
         img_info = coco.loadImgs(img_id)[0]
         path = img_info['file_name']
         video_id = img_info['video_id']
-        img = self.get_image(path)
+        draft_size = None
+        if self.reduced_decode:
+            h, w = self.get_resized_size(idx)
+            draft_size = (w, h)
+        img = self.get_image(path, draft_size)
   
         target = {'image_id': img_id, 'annotations': target}
-        img, target = self.prepare(img, target)
+        img, target = self.prepare(img, target, orig_size=(img_info['width'], img_info['height']) if draft_size else None)
         imgs.append(img)
         if video_id == -1:
             for i in range(self.num_ref_frames):
@@ -121,7 +138,7 @@ class CocoDetection(TvCocoDetection):
                 ref_ann_ids = coco.getAnnIds(imgIds=ref_img_id)
                 ref_img_info = coco.loadImgs(ref_img_id)[0]
                 ref_img_path = ref_img_info['file_name']
-                ref_img = self.get_image(ref_img_path)
+                ref_img = self.get_image(ref_img_path, draft_size)
                 imgs.append(ref_img)
         if self._transforms is not None:
             imgs, target = self._transforms(imgs, target) 
@@ -150,8 +167,9 @@ class ConvertCocoPolysToMask(object):
     def __init__(self, return_masks=False):
         self.return_masks = return_masks
 
-    def __call__(self, image, target):
-        w, h = image.size
+    def __call__(self, image, target, orig_size=None):
+        # orig_size (w, h) is given when the image was decoded below its original resolution
+        w, h = image.size if orig_size is None else orig_size
 
         image_id = target["image_id"]
         image_id = torch.tensor([image_id])
@@ -207,6 +225,14 @@ class ConvertCocoPolysToMask(object):
 
         target["orig_size"] = torch.as_tensor([int(h), int(w)])
         target["size"] = torch.as_tensor([int(h), int(w)])
+
+        decoded_w, decoded_h = image.size
+        if (decoded_w, decoded_h) != (w, h):
+            # bring the annotations to the resolution the image was actually decoded at
+            ratio_width, ratio_height = decoded_w / w, decoded_h / h
+            target["boxes"] = target["boxes"] * torch.as_tensor([ratio_width, ratio_height, ratio_width, ratio_height])
+            target["area"] = target["area"] * (ratio_width * ratio_height)
+            target["size"] = torch.as_tensor([int(decoded_h), int(decoded_w)])
         
         return image, target
 
@@ -223,13 +249,13 @@ def make_coco_transforms(image_set):
     if image_set == 'train_vid' or image_set == "train_det" or image_set == "train_joint":
         return T.Compose([
             T.RandomHorizontalFlip(),
-            T.RandomResize([600], max_size=1000),
+            T.RandomResize(RESIZE_SCALES, max_size=RESIZE_MAX_SIZE),
             normalize,
         ])
 
     if image_set == 'val':
         return T.Compose([
-            T.RandomResize([600], max_size=1000),
+            T.RandomResize(RESIZE_SCALES, max_size=RESIZE_MAX_SIZE),
             normalize,
         ])
 
@@ -249,7 +275,7 @@ def build(image_set, args):
     datasets = []
     for (img_folder, ann_file) in PATHS[image_set]:
         dataset = CocoDetection(img_folder, ann_file, transforms=make_coco_transforms(image_set), is_train =(not args.eval), interval1=args.interval1,
-                                interval2=args.interval2, num_ref_frames = args.num_ref_frames, return_masks=args.masks, cache_mode=args.cache_mode, 
+                                interval2=args.interval2, num_ref_frames = args.num_ref_frames, return_masks=args.masks, cache_mode=args.cache_mode, reduced_decode=args.reduced_decode, 
                                 local_rank=get_local_rank(), local_size=get_local_size())
         datasets.append(dataset)
     if len(datasets) == 1:
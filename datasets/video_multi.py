@@ -0,0 +1,194 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Multi-frame clips read directly from video files (MP4, AVI, ...).
+
+Every video is decoded by a background thread (OpenCV) into grayscale
+frames that feed a bounded queue, so no frames are extracted to disk. A
+frame's image id is ``video_id << 32 | frame_id``: consecutive inside a
+video and unique across videos without knowing any video's length up front,
+which containers often get wrong. Key frames come out in order, with the
+reference frames of datasets/tzb_multi's val sampling applied to a window
+of ``ref_window`` frames centred on the key frame instead of the whole
+video. Only that window is kept decoded, so memory stays at about
+``ref_window + queue_size`` frames per video however long it is, where
+sampling over the whole video would keep a fixed fraction of it.
+"""
+import queue
+import threading
+from pathlib import Path
+
+import cv2
+import torch
+import torch.utils.data
+from PIL import Image
+
+from .tzb_multi import make_coco_transforms, sample_val_ref_ids
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def list_videos(path):
+    """``path`` if it is a video file, else the video files directly in directory ``path``."""
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    return sorted(p for p in path.iterdir() if p.suffix.lower() in VIDEO_EXTENSIONS)
+
+
+def estimate_frames(path):
+    """Frame count the container reports, 0 when it does not know.
+
+    Only an estimate: MKV, variable frame rate or streamed files often report
+    0 or -1, and others are off by a few frames.
+    """
+    cap = cv2.VideoCapture(str(path))
+    assert cap.isOpened(), f'cannot open video {path}'
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return max(num_frames, 0)
+
+
+class VideoDecoder(threading.Thread):
+    """Decodes a video into grayscale PIL images on ``frames``, then puts ``None``.
+
+    ``frames`` is bounded, so the decoder runs at most ``queue_size`` frames
+    ahead of the consumer; ``stop`` ends it early.
+    """
+
+    def __init__(self, path, queue_size=16):
+        super().__init__(daemon=True)
+        self.path = path
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.error = None
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        cap = cv2.VideoCapture(str(self.path))
+        try:
+            while not self.stop_event.is_set():
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                if frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                if not self._put(Image.fromarray(frame, mode='L')):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            cap.release()
+        self._put(None)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class VideoClipDataset(torch.utils.data.IterableDataset):
+    """Key frame + reference clips of every frame of ``video_paths``, in frame order.
+
+    Targets hold ``image_id``, ``video_id`` (index into ``video_paths``),
+    ``frame_id``, ``orig_size`` and ``size``, so the usual collate_fn and
+    PostProcess apply. Videos are split across DataLoader workers.
+
+    Every video is read until its decoder runs out; ``len()`` sums the frame
+    counts the containers report and is only an estimate for progress logs.
+    """
+
+    def __init__(self, video_paths, transforms, num_ref_frames=3, filter_key_img=True, queue_size=16,
+                 ref_window=64):
+        assert ref_window >= 3, 'the reference window needs at least 3 frames'
+        self.video_paths = [Path(p) for p in video_paths]
+        self._transforms = transforms
+        self.num_ref_frames = num_ref_frames
+        self.filter_key_img = filter_key_img
+        self.queue_size = queue_size
+        self.ref_window = ref_window
+        self.estimated_frames = [estimate_frames(p) for p in self.video_paths]
+
+    def __len__(self):
+        return sum(self.estimated_frames)
+
+    def video_name(self, video_id):
+        return self.video_paths[video_id].stem
+
+    def _assigned_videos(self):
+        video_ids = list(range(len(self.video_paths)))
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            video_ids = video_ids[worker_info.id::worker_info.num_workers]
+        return video_ids
+
+    def _ref_ids(self, img_id, window_ids):
+        if self.num_ref_frames == 0:
+            return []
+        return sample_val_ref_ids(img_id, window_ids, self.num_ref_frames, self.filter_key_img)
+
+    def _video_clips(self, video_id):
+        # frame ids count from 0 inside the video; the image id puts the video id in the high bits
+        first = video_id << 32
+        half = self.ref_window // 2
+        decoder = VideoDecoder(self.video_paths[video_id], self.queue_size)
+        decoder.start()
+        frames = {}
+        last_id = first - 1
+        exhausted = False
+        img_id = first
+        try:
+            while True:
+                # decode up to the end of the key frame's window
+                while last_id < img_id + half and not exhausted:
+                    img = decoder.frames.get()
+                    if img is None:
+                        exhausted = True
+                        break
+                    last_id += 1
+                    frames[last_id] = img
+                if img_id > last_id:
+                    break
+                window_ids = list(range(max(first, img_id - half), min(img_id + half, last_id) + 1))
+                if len(window_ids) < 3:
+                    # single- or two-frame video: too short to sample references from
+                    ref_ids = [img_id] * self.num_ref_frames
+                else:
+                    ref_ids = self._ref_ids(img_id, window_ids)
+                clip = [frames[img_id]] + [frames[ref_id] for ref_id in ref_ids]
+                w, h = clip[0].size
+                target = {'image_id': torch.tensor([img_id]), 'video_id': torch.tensor([video_id]),
+                          'frame_id': torch.tensor([img_id - first]),
+                          'orig_size': torch.as_tensor([int(h), int(w)]), 'size': torch.as_tensor([int(h), int(w)])}
+                if self._transforms is not None:
+                    clip, target = self._transforms(clip, target)
+                yield torch.cat(clip, dim=0), target
+                # the next key frame's window starts one frame later
+                frames.pop(img_id - half, None)
+                img_id += 1
+        finally:
+            decoder.stop()
+            decoder.join()
+        if decoder.error is not None:
+            raise decoder.error
+
+    def __iter__(self):
+        for video_id in self._assigned_videos():
+            yield from self._video_clips(video_id)
+
+
+def build(video_path, args):
+    video_paths = list_videos(video_path)
+    assert video_paths, f'no video files in {video_path}'
+    return VideoClipDataset(video_paths, make_coco_transforms('val'), num_ref_frames=args.num_ref_frames,
+                            queue_size=args.video_queue_size, ref_window=args.video_ref_window)
@@ -1,9 +1,54 @@
 import cv2
 import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 import json
+import numpy as np
 
-def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_dir, classes_path=None):
+from label_store import LabelStore
+
+def load_class_names(classes_path):
+    """从.txt或.json文件加载类别名称，失败时返回空列表。"""
+    class_names = []
+    if classes_path and os.path.exists(classes_path):
+        try:
+            if classes_path.lower().endswith('.json'):
+                with open(classes_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    if isinstance(data, list): # 如果是简单的列表
+                        class_names = data
+                    elif isinstance(data, dict): # 如果是字典 (键为索引)
+                        # 确保按数字顺序排序键并取值
+                        class_names = [data[str(i)] for i in sorted([int(k) for k in data.keys()])]
+                    else:
+                        print(f"警告：JSON文件 {classes_path} 格式不支持。请确保是列表或键为数字的字典。")
+            elif classes_path.lower().endswith('.txt'):
+                with open(classes_path, 'r', encoding='utf-8') as f:
+                    class_names = [line.strip() for line in f.readlines()]
+            else:
+                print(f"警告：不支持的类别文件格式 {os.path.basename(classes_path)}。只支持 .json 或 .txt。")
+
+        except json.JSONDecodeError as e:
+            print(f"错误：解析JSON类别文件 {classes_path} 时发生错误：{e}")
+        except Exception as e:
+            print(f"加载类别文件 {classes_path} 时发生错误：{e}")
+    return class_names
+
+def load_font(size=15):
+    """加载标注文字使用的字体，加载失败则使用默认字体。"""
+    try:
+        # 尝试加载更常见的字体或指定完整路径
+        return ImageFont.truetype("arial.ttf", size)
+    except IOError:
+        try:
+            # 对于Linux系统，可能是'DejaVuSansMono.ttf'或其他
+            return ImageFont.truetype("DejaVuSansMono.ttf", size)
+        except IOError:
+            print("警告：找不到arial.ttf或DejaVuSansMono.ttf字体，使用默认字体。")
+            return ImageFont.load_default()
+
+def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_dir, classes_path=None, label_store=None,
+                    class_names=None, font=None):
     """
     在图像上绘制YOLO格式的真实标签和预测标签。
 
@@ -14,6 +59,9 @@ def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_
         output_dir (str): 保存可视化结果图像的目录。
         classes_path (str, optional): 包含类别名称的文件的路径，每行一个类别。
                                       如果提供，则会在边界框旁边显示类别名称。
+        label_store (LabelStore, optional): 已解析的真实标签库，提供时真实标签直接从标签库读取。
+        class_names (list, optional): 已加载的类别名称，提供时不再读取 classes_path。
+        font (ImageFont, optional): 已加载的字体，逐帧调用时应由调用方加载一次后传入。
     """
 
     # 创建输出目录（如果不存在）
@@ -36,85 +84,64 @@ def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_
     true_color = (0, 255, 0)  # 绿色 (R, G, B)
     pred_color = (0, 0, 255)  # 蓝色
 
-    # 尝试加载字体，如果加载失败则使用默认字体
-    try:
-        # 尝试加载更常见的字体或指定完整路径
-        font = ImageFont.truetype("arial.ttf", 15)
-    except IOError:
-        try:
-            # 对于Linux系统，可能是'DejaVuSansMono.ttf'或其他
-            font = ImageFont.truetype("DejaVuSansMono.ttf", 15)
-        except IOError:
-            print("警告：找不到arial.ttf或DejaVuSansMono.ttf字体，使用默认字体。")
-            font = ImageFont.load_default()
-
-    # 加载类别名称
-    if classes_path and os.path.exists(classes_path):
-        try:
-            if classes_path.lower().endswith('.json'):
-                with open(classes_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if isinstance(data, list): # 如果是简单的列表
-                        class_names = data
-                    elif isinstance(data, dict): # 如果是字典 (键为索引)
-                        # 确保按数字顺序排序键并取值
-                        class_names = [data[str(i)] for i in sorted([int(k) for k in data.keys()])]
-                    else:
-                        print(f"警告：JSON文件 {classes_path} 格式不支持。请确保是列表或键为数字的字典。")
-            elif classes_path.lower().endswith('.txt'):
-                with open(classes_path, 'r', encoding='utf-8') as f:
-                    class_names = [line.strip() for line in f.readlines()]
-            else:
-                print(f"警告：不支持的类别文件格式 {os.path.basename(classes_path)}。只支持 .json 或 .txt。")
-
-        except json.JSONDecodeError as e:
-            print(f"错误：解析JSON类别文件 {classes_path} 时发生错误：{e}")
-        except Exception as e:
-            print(f"加载类别文件 {classes_path} 时发生错误：{e}")
-
-    def draw_box(label_path, color, label_type):
+    # 未传入时才加载字体和类别名称
+    if font is None:
+        font = load_font()
+    if class_names is None:
+        class_names = load_class_names(classes_path)
+
+    def read_rows(label_path, store):
+        """读取YOLO标签行，标签库中有该文件时直接返回标签库中的数组"""
+        rows = store.lookup(label_path) if store is not None else None
+        if rows is not None:
+            return rows
+        rows = []
+        with open(label_path, 'r') as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) < 5:
+                    continue # 跳过格式不正确的行
+                rows.append([float(p) for p in parts[:5]])
+        return rows
+
+    def draw_box(label_path, color, label_type, store=None):
         """辅助函数：读取YOLO标签并绘制边界框"""
         try:
-            with open(label_path, 'r') as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) < 5:
-                        continue # 跳过格式不正确的行
-
-                    class_id = int(parts[0])
-                    x_center, y_center, width, height = map(float, parts[1:5])
-
-                    # 将YOLO归一化坐标转换为像素坐标
-                    x1 = int((x_center - width / 2) * img_width)
-                    y1 = int((y_center - height / 2) * img_height)
-                    x2 = int((x_center + width / 2) * img_width)
-                    y2 = int((y_center + height / 2) * img_height)
-
-                    # 绘制矩形框
-                    draw.rectangle([(x1, y1), (x2, y2)], outline=color, width=1)
-
-                    # 绘制类别名称（如果可用）
-                    if class_names and class_id < len(class_names):
-                        label_text = f"{label_type}: {class_names[class_id]}"
-                    else:
-                        label_text = f"{label_type}: Class {class_id}"
-
-                    # 确保文本在图像范围内，避免出界
-                    text_x = x1
-                    # 尝试在框上方显示文本，如果空间不足则在下方
-                    text_y = y1 - 18 if y1 - 18 > 0 else y1 + 2
-                    
-                    # 获取文本的实际宽度和高度
-                    bbox = draw.textbbox((0,0), label_text, font=font) # 使用 (0,0) 获取文本宽度和高度
-                    text_width = bbox[2] - bbox[0]
-                    text_height = bbox[3] - bbox[1]
-
-                    if text_x + text_width > img_width:
-                        text_x = img_width - text_width - 5 # 靠右对齐
-                    if text_y + text_height > img_height:
-                        text_y = img_height - text_height - 5 # 靠下对齐
-
-                    draw.text((text_x, text_y), label_text, fill=color, font=font)
+            for row in read_rows(label_path, store):
+                class_id = int(row[0])
+                x_center, y_center, width, height = map(float, row[1:5])
+
+                # 将YOLO归一化坐标转换为像素坐标
+                x1 = int((x_center - width / 2) * img_width)
+                y1 = int((y_center - height / 2) * img_height)
+                x2 = int((x_center + width / 2) * img_width)
+                y2 = int((y_center + height / 2) * img_height)
+
+                # 绘制矩形框
+                draw.rectangle([(x1, y1), (x2, y2)], outline=color, width=1)
+
+                # 绘制类别名称（如果可用）
+                if class_names and class_id < len(class_names):
+                    label_text = f"{label_type}: {class_names[class_id]}"
+                else:
+                    label_text = f"{label_type}: Class {class_id}"
+
+                # 确保文本在图像范围内，避免出界
+                text_x = x1
+                # 尝试在框上方显示文本，如果空间不足则在下方
+                text_y = y1 - 18 if y1 - 18 > 0 else y1 + 2
+                
+                # 获取文本的实际宽度和高度
+                bbox = draw.textbbox((0,0), label_text, font=font) # 使用 (0,0) 获取文本宽度和高度
+                text_width = bbox[2] - bbox[0]
+                text_height = bbox[3] - bbox[1]
+
+                if text_x + text_width > img_width:
+                    text_x = img_width - text_width - 5 # 靠右对齐
+                if text_y + text_height > img_height:
+                    text_y = img_height - text_height - 5 # 靠下对齐
+
+                draw.text((text_x, text_y), label_text, fill=color, font=font)
         except FileNotFoundError:
             print(f"警告：找不到 {label_type} 标签文件 {label_path}")
         except Exception as e:
@@ -122,7 +149,7 @@ def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_
 
 
     # 绘制真实标签
-    draw_box(true_labels_path, true_color, "True")
+    draw_box(true_labels_path, true_color, "True", label_store)
 
     # 绘制预测标签
     draw_box(predicted_labels_path, pred_color, "Pred")
@@ -133,7 +160,8 @@ def draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_
     img.save(output_path)
     # print(f"可视化结果已保存到：{output_path}") # 避免过多输出，只在最后汇总
 
-def process_single_video_frames(video_frames_dir, true_labels_dir, predicted_labels_dir, output_visualizations_dir, classes_path=None):
+def process_single_video_frames(video_frames_dir, true_labels_dir, predicted_labels_dir, output_visualizations_dir, classes_path=None, label_store=None,
+                                class_names=None, font=None):
     """
     处理单个视频目录下的所有视频帧及其对应的标签文件。
 
@@ -143,7 +171,16 @@ def process_single_video_frames(video_frames_dir, true_labels_dir, predicted_lab
         predicted_labels_dir (str): 存放预测标签文件的目录。
         output_visualizations_dir (str): 保存所有可视化结果的目录。
         classes_path (str, optional): 包含类别名称的文件的路径。
+        label_store (LabelStore, optional): 已解析的真实标签库。
+        class_names (list, optional): 已加载的类别名称。
+        font (ImageFont, optional): 已加载的字体。
     """
+    # 字体和类别名称对所有帧只加载一次
+    if font is None:
+        font = load_font()
+    if class_names is None:
+        class_names = load_class_names(classes_path)
+
     print(f"正在处理视频帧目录：{video_frames_dir}")
     frame_files = [f for f in os.listdir(video_frames_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))]
     frame_files.sort() # 确保按顺序处理
@@ -154,10 +191,11 @@ def process_single_video_frames(video_frames_dir, true_labels_dir, predicted_lab
         true_labels_path = os.path.join(true_labels_dir, f"{base_name}.txt")
         predicted_labels_path = os.path.join(predicted_labels_dir, f"{base_name}.txt")
 
-        draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_visualizations_dir, classes_path)
+        draw_yolo_boxes(image_path, true_labels_path, predicted_labels_path, output_visualizations_dir, classes_path, label_store,
+                        class_names=class_names, font=font)
     print(f"视频目录 {os.path.basename(video_frames_dir)} 处理完毕。")
 
-def process_all_videos_in_structure(images_root_dir, labels_root_dir, predictions_root_dir, output_base_dir, classes_path=None):
+def process_all_videos_in_structure(images_root_dir, labels_root_dir, predictions_root_dir, output_base_dir, classes_path=None, use_label_store=False):
     """
     遍历给定结构下的所有视频文件夹，并处理其中的帧和标签。
 
@@ -167,6 +205,7 @@ def process_all_videos_in_structure(images_root_dir, labels_root_dir, prediction
         predictions_root_dir (str): 'predictions' 目录的根路径。
         output_base_dir (str): 保存所有可视化结果的根目录。
         classes_path (str, optional): 包含类别名称的文件的路径。
+        use_label_store (bool, optional): 是否通过 label_store.LabelStore 读取真实标签。
     """
     print(f"开始处理数据集，图像根目录：{images_root_dir}")
 
@@ -178,6 +217,11 @@ def process_all_videos_in_structure(images_root_dir, labels_root_dir, prediction
         print(f"在 {images_root_dir} 中没有找到任何'video'开头的子文件夹。请检查路径和目录结构。")
         return
 
+    label_store = LabelStore(labels_root_dir) if use_label_store else None
+    # 字体和类别名称对所有视频只加载一次
+    class_names = load_class_names(classes_path)
+    font = load_font()
+
     for video_folder in video_folders:
         current_video_frames_dir = os.path.join(images_root_dir, video_folder)
         current_true_labels_dir = os.path.join(labels_root_dir, video_folder)
@@ -202,10 +246,119 @@ def process_all_videos_in_structure(images_root_dir, labels_root_dir, prediction
             current_true_labels_dir,
             current_predicted_labels_dir,
             current_output_vis_dir,
-            classes_path
+            classes_path,
+            label_store,
+            class_names=class_names,
+            font=font
         )
     print("所有视频处理完毕。可视化结果已保存到指定的输出目录。")
 
+def draw_box_array(img, boxes, color, label_type, class_names):
+    """
+    用OpenCV在BGR图像上绘制一组YOLO框（boxes: shape (n, 5)，[class_id, x, y, w, h]）
+    所有框的像素坐标一次性向量化计算，矩形用一次 polylines 调用绘制
+    """
+    if boxes is None or len(boxes) == 0:
+        return
+    img_height, img_width = img.shape[:2]
+    boxes = np.asarray(boxes, dtype=np.float64)
+    x1 = ((boxes[:, 1] - boxes[:, 3] / 2) * img_width).astype(np.int32)
+    y1 = ((boxes[:, 2] - boxes[:, 4] / 2) * img_height).astype(np.int32)
+    x2 = ((boxes[:, 1] + boxes[:, 3] / 2) * img_width).astype(np.int32)
+    y2 = ((boxes[:, 2] + boxes[:, 4] / 2) * img_height).astype(np.int32)
+    polygons = np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1),
+                         np.stack([x2, y2], 1), np.stack([x1, y2], 1)], axis=1)
+    cv2.polylines(img, list(polygons), True, color, 1)
+
+    for class_id, tx, ty in zip(boxes[:, 0].astype(np.int64), x1, y1):
+        if class_id < len(class_names):
+            label_text = f"{label_type}: {class_names[class_id]}"
+        else:
+            label_text = f"{label_type}: Class {class_id}"
+        # 尝试在框上方显示文本，如果空间不足则在下方
+        (text_width, text_height), _ = cv2.getTextSize(label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+        tx = min(int(tx), img_width - text_width - 5)
+        ty = int(ty) - 4 if ty - text_height - 4 > 0 else int(ty) + text_height + 2
+        cv2.putText(img, label_text, (tx, ty), cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1, cv2.LINE_AA)
+
+def render_video_to_mp4(job):
+    """
+    将一个视频的所有帧连同真实框/预测框编码为一个MP4文件（在子进程中运行）
+    job: (video_frames_dir, output_path, label_store, prediction_store, class_names, fps, frame_stride)
+    """
+    video_frames_dir, output_path, label_store, prediction_store, class_names, fps, frame_stride = job
+    video_name = os.path.basename(video_frames_dir)
+    frame_files = sorted(f for f in os.listdir(video_frames_dir)
+                         if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')))[::frame_stride]
+
+    true_color = (0, 255, 0)  # 绿色 (B, G, R)
+    pred_color = (255, 0, 0)  # 蓝色
+
+    writer = None
+    written = 0
+    for frame_file in frame_files:
+        img = cv2.imread(os.path.join(video_frames_dir, frame_file), cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"加载图像 {os.path.join(video_frames_dir, frame_file)} 时发生错误")
+            continue
+        if writer is None:
+            height, width = img.shape[:2]
+            writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        elif img.shape[:2] != (height, width):
+            img = cv2.resize(img, (width, height))
+
+        base_name = os.path.splitext(frame_file)[0]
+        if label_store is not None:
+            draw_box_array(img, label_store.get(video_name, base_name), true_color, "True", class_names)
+        if prediction_store is not None:
+            draw_box_array(img, prediction_store.get(video_name, base_name), pred_color, "Pred", class_names)
+        writer.write(img)
+        written += 1
+
+    if writer is not None:
+        writer.release()
+    return video_name, written
+
+def render_all_videos_to_mp4(images_root_dir, labels_root_dir, predictions_root_dir, output_base_dir, classes_path=None,
+                             fps=25, frame_stride=1, num_workers=None):
+    """
+    将所有视频渲染为MP4文件（每个视频一个 {video}.mp4），视频之间并行渲染。
+
+    Args:
+        images_root_dir (str): 'images' 目录的根路径。
+        labels_root_dir (str): 'labels' 目录的根路径。
+        predictions_root_dir (str): 'predictions' 目录的根路径。
+        output_base_dir (str): 保存MP4文件的目录。
+        classes_path (str, optional): 包含类别名称的文件的路径。
+        fps (int, optional): 输出视频帧率。
+        frame_stride (int, optional): 每隔多少帧渲染一帧。
+        num_workers (int, optional): 并行进程数，None 为CPU核数，0 为不使用多进程。
+    """
+    print(f"开始渲染视频，图像根目录：{images_root_dir}")
+    video_folders = sorted(f for f in os.listdir(images_root_dir)
+                           if os.path.isdir(os.path.join(images_root_dir, f)) and f.startswith('video'))
+    if not video_folders:
+        print(f"在 {images_root_dir} 中没有找到任何'video'开头的子文件夹。请检查路径和目录结构。")
+        return
+
+    # 类别名称和标签只加载/解析一次；标签和预测都通过标签库以数组形式读取
+    class_names = load_class_names(classes_path)
+    label_store = LabelStore(labels_root_dir) if os.path.exists(labels_root_dir) else None
+    prediction_store = LabelStore(predictions_root_dir) if os.path.exists(predictions_root_dir) else None
+    os.makedirs(output_base_dir, exist_ok=True)
+
+    jobs = [(os.path.join(images_root_dir, v), os.path.join(output_base_dir, f"{v}.mp4"),
+             label_store, prediction_store, class_names, fps, frame_stride) for v in video_folders]
+    if num_workers == 0:
+        results = map(render_video_to_mp4, jobs)
+        for video_name, written in results:
+            print(f"视频 {video_name} 渲染完毕，共 {written} 帧。")
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for video_name, written in executor.map(render_video_to_mp4, jobs):
+                print(f"视频 {video_name} 渲染完毕，共 {written} 帧。")
+    print(f"所有视频渲染完毕。MP4文件已保存到：{output_base_dir}")
+
 if __name__ == "__main__":
     # --- 配置您的路径 ---
     # 请根据您的实际目录结构修改以下变量
@@ -227,6 +380,11 @@ if __name__ == "__main__":
     # 如果没有，可以设置为 None，脚本将显示 "Class N"
     classes_file_path = "data/tzb/class.json" # <-- **请修改为您的类别文件路径或设置为 None**
 
+    # 是否将每个视频渲染为一个MP4文件（否则逐帧保存图片）
+    RENDER_MP4 = False
+    MP4_FPS = 25
+    MP4_FRAME_STRIDE = 1  # 每隔多少帧渲染一帧
+
     # 检查主目录是否存在
     if not os.path.exists(images_root):
         print(f"错误：图像根目录不存在：{images_root}")
@@ -234,11 +392,22 @@ if __name__ == "__main__":
         print(f"错误：真实标签根目录不存在：{labels_root}")
     elif not os.path.exists(predictions_root):
         print(f"错误：预测标签根目录不存在：{predictions_root}")
+    elif RENDER_MP4:
+        render_all_videos_to_mp4(
+            images_root,
+            labels_root,
+            predictions_root,
+            output_visualizations_base_dir,
+            classes_file_path,
+            fps=MP4_FPS,
+            frame_stride=MP4_FRAME_STRIDE
+        )
     else:
         process_all_videos_in_structure(
             images_root,
             labels_root,
             predictions_root,
             output_visualizations_base_dir,
-            classes_file_path
+            classes_file_path,
+            use_label_store=False
         )
\ No newline at end of file
@@ -17,86 +17,123 @@ import sys
 from typing import Iterable
 
 import torch
-import util.misc as utils
+import util.misc_multi as utils
+from util import stage_profiler as stages
 from datasets.coco_eval import CocoEvaluator
 from datasets.panoptic_eval import PanopticEvaluator
 from datasets.data_prefetcher_multi import data_prefetcher
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0):
+                    device: torch.device, epoch: int, max_norm: float = 0, prefetch_depth: int = 2,
+                    comm_timer=None, deferred_metrics=False, stage_profiler=None):
     model.train()
     criterion.train()
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    # deferred_metrics: logged values stay on the device and are averaged over
+    # processes every print_freq steps instead of a reduce_dict + .item() per step
+    metric_logger = utils.MetricLogger(delimiter="  ", reduce=deferred_metrics)
+    watchdog = utils.NonFiniteWatchdog() if deferred_metrics else None
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('class_error', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     metric_logger.add_meter('grad_norm', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
+    metric_logger.add_meter('pad_ratio', utils.SmoothedValue(window_size=1, fmt='{value:.3f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
 
-
-    # prefetcher = data_prefetcher(data_loader, device, prefetch=True)
-    # data_loader_iter = iter(data_loader)
-    # samples, targets = data_loader_iter.next()
-    # samples = samples.to(device)
-    # targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-    for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-    # for _ in metric_logger.log_every(range(len(data_loader)), print_freq, header):
-
-        # assert samples is None, samples
-        # outputs = model(samples)
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    prefetcher = data_prefetcher(data_loader, device, prefetch=True, depth=prefetch_depth)
+    if stage_profiler is not None:
+        # only the training step is profiled, not evaluation between epochs
+        stages.enable(stage_profiler)
+        data_start = stage_profiler.now()
+    for step, (samples, targets) in enumerate(metric_logger.log_every(prefetcher, print_freq, header)):
+        if stage_profiler is not None:
+            stage_profiler.add('data', data_start, stage_profiler.now())
+        targets = targets.unpack()
 
         # print(f"\n\n*********Shape of samples.tensors in train_one_epoch: {samples.tensors.shape}")
         # print("targets", targets)
         # print("input model", type(samples))
+        if comm_timer is not None:
+            comm_timer.start_step()
+        stages.range_push('model')
         outputs = model(samples)
+        stages.range_pop()
+        stages.range_push('criterion')
         loss_dict = criterion(outputs, targets)
+        stages.range_pop()
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
  
         # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
+        if deferred_metrics:
+            loss_dict_reduced = {k: v.detach() for k, v in loss_dict.items()}
+        else:
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
         loss_dict_reduced_unscaled = {f'{k}_unscaled': v
                                       for k, v in loss_dict_reduced.items()}
         loss_dict_reduced_scaled = {k: v * weight_dict[k]
                                     for k, v in loss_dict_reduced.items() if k in weight_dict}
         losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
 
-        loss_value = losses_reduced_scaled.item()
+        if deferred_metrics:
+            # checked every print_freq steps; the check is collective, so all
+            # processes stop at the same step
+            loss_value = losses_reduced_scaled
+            watchdog.update(loss_value, step)
+            if step % print_freq == print_freq - 1:
+                bad_step = watchdog.check()
+                if bad_step is not None:
+                    print("Loss is not finite at step {}, stopping training".format(bad_step))
+                    sys.exit(1)
+        else:
+            loss_value = losses_reduced_scaled.item()
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict_reduced)
+                sys.exit(1)
 
         optimizer.zero_grad()
         # import pdb; pdb.set_trace()
+        stages.range_push('backward')
         losses.backward()
+        stages.range_pop()
+        stages.range_push('optimizer')
         if max_norm > 0:
             grad_total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
         else:
             grad_total_norm = utils.get_total_grad_norm(model.parameters(), max_norm)
         optimizer.step()
+        stages.range_pop()
+        if comm_timer is not None:
+            metric_logger.update(**comm_timer.stop_step())
 
         metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
         metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(grad_norm=grad_total_norm)
-
-        # samples, ref_samples, targets = prefetcher.next()
-        # try: 
-        #     samples, targets = data_loader_iter.next()
-        # except StopIteration:
-        #     data_loader_iter = iter(data_loader)
-        #     samples,targets = data_loader_iter.next()
-        # samples = samples.to(device)
-        # targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        # fraction of the padded batch that is padding, see nested_tensor_from_tensor_list
+        metric_logger.update(pad_ratio=samples.mask.float().mean())
+        if stage_profiler is not None:
+            stage_profiler.step()
+            data_start = stage_profiler.now()
+
+    if watchdog is not None and watchdog.check() is not None:
+        print("Loss is not finite, stopping training")
+        sys.exit(1)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    prefetch_stats = prefetcher.stats()
+    print("Prefetch stats:", prefetch_stats)
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats.update(prefetch_stats)
+    if stage_profiler is not None:
+        stages.disable()
+        stage_stats = stage_profiler.summary()
+        print("Stage stats:", stage_stats)
+        stats.update(stage_stats)
+    return stats
 import time 
 import numpy as np 
 @torch.no_grad()
@@ -122,8 +159,8 @@ def evaluate1(model, criterion, postprocessors, data_loader, base_ds, device, ou
     
     time_list = []
     for samples, targets  in metric_logger.log_every(data_loader, 10, header):
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        samples = samples.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True).unpack()
         metric_logger.update(loss=0)
         metric_logger.update(class_error=0)
         start_time = time.time()
@@ -136,7 +173,8 @@ def evaluate1(model, criterion, postprocessors, data_loader, base_ds, device, ou
     print("Averaged stats:", metric_logger)
 
 @torch.no_grad()
-def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, output_dir):
+def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, output_dir, prefetch_depth=2,
+             online_evaluator=None):
     model.eval()
     criterion.eval()
 
@@ -161,9 +199,9 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
             output_dir=os.path.join(output_dir, "panoptic_eval"),
         )
 
-    for samples, targets  in metric_logger.log_every(data_loader, 10, header):
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    prefetcher = data_prefetcher(data_loader, device, prefetch=True, depth=prefetch_depth)
+    for samples, targets in metric_logger.log_every(prefetcher, 10, header):
+        targets = targets.unpack()
 
         # import ipdb; ipdb.set_trace()
         outputs = model(samples)
@@ -183,6 +221,8 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
         results = postprocessors['bbox'](outputs, orig_target_sizes)
+        if online_evaluator is not None:
+            online_evaluator.update(base_ds, targets, results)
 
         if 'segm' in postprocessors.keys():
             target_sizes = torch.stack([t["size"] for t in targets], dim=0)
@@ -204,6 +244,7 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
+    print("Prefetch stats:", prefetcher.stats())
     if coco_evaluator is not None:
         coco_evaluator.synchronize_between_processes()
     if panoptic_evaluator is not None:
@@ -226,12 +267,51 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         stats['PQ_all'] = panoptic_res["All"]
         stats['PQ_th'] = panoptic_res["Things"]
         stats['PQ_st'] = panoptic_res["Stuff"]
+    if online_evaluator is not None:
+        # evaluator.py style per-video precision / recall, computed on the main process
+        online_evaluator.synchronize_between_processes()
+        if utils.is_main_process():
+            online_evaluator.evaluate_all()
+            overall = online_evaluator.calculate_overall_metrics().get('overall', {})
+            for k in ('precision', 'recall', 'f1', 'false_alarm_rate', 'temporal_consistency'):
+                if k in overall:
+                    stats[k] = overall[k]
     
 
     return stats, coco_evaluator
 
+def yolo_lines(single_image_results, score_threshold=0.1):
+    """YOLO-style ``class cx cy w h score`` lines of one image's PostProcess result."""
+    # get the raw predictions data
+    scores = single_image_results['scores'].cpu().numpy()
+    boxes = single_image_results['boxes'].cpu().numpy()
+    labels = single_image_results['labels'].cpu().numpy()
+
+    # select by scores
+    keep_indices = np.where(scores > score_threshold)[0]
+    filtered_scores = scores[keep_indices]
+    filtered_boxes = boxes[keep_indices]
+    filtered_labels = labels[keep_indices]
+
+    return [f"{label-1} {' '.join(map(str, box))} {score:.6f}"
+            for box, label, score in zip(filtered_boxes, filtered_labels, filtered_scores)]
+
+
+def export_predictions_yolo(results, targets, output_dir, score_threshold=0.1):
+    """Write one ``output_{image_id}.txt`` per image with YOLO-style ``class cx cy w h score`` lines."""
+    for target, single_image_results in zip(targets, results):
+        idx = target['image_id'].item()
+
+        # build the output file path
+        output_file = os.path.join(output_dir, f"output_{idx}.txt")
+        with open(output_file, 'w') as f:
+            for line in yolo_lines(single_image_results, score_threshold):
+                f.write(line + "\n")
+
+
 @torch.no_grad()
-def test(model, criterion, postprocessors, data_loader, base_ds, device, output_dir):
+def test(model, criterion, postprocessors, data_loader, base_ds, device, output_dir, prefetch_depth=2,
+         online_evaluator=None, export_predictions=True, output_cache=None, score_threshold=0.1):
     model.eval()
     criterion.eval()
 
@@ -241,17 +321,20 @@ def test(model, criterion, postprocessors, data_loader, base_ds, device, output_
 
     iou_types = tuple(k for k in ('segm', 'bbox') if k in postprocessors.keys())
     coco_evaluator = CocoEvaluator(base_ds, iou_types)
+    if output_cache is not None:
+        output_cache.start()
 
-    for samples, targets  in metric_logger.log_every(data_loader, 10, header):
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    prefetcher = data_prefetcher(data_loader, device, prefetch=True, depth=prefetch_depth)
+    for samples, targets in metric_logger.log_every(prefetcher, 10, header):
+        targets = targets.unpack()
         # import ipdb; ipdb.set_trace()
         print(f"\n********* number of targets: {len(targets)}\n")
         for i, target in enumerate(targets):
             print(f"target {i} image_id: {target['image_id']}\n")
-        idx = targets[0]['image_id'].item()
         # call deformable_detr_multi.py DeformableDetr.forward()
         outputs = model(samples)
+        if output_cache is not None:
+            output_cache.add(outputs, targets)
         loss_dict = criterion(outputs, targets)
         weight_dict = criterion.weight_dict
 
@@ -268,27 +351,66 @@ def test(model, criterion, postprocessors, data_loader, base_ds, device, output_
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
         results = postprocessors['bbox'](outputs, orig_target_sizes)
-        
-        for single_image_results in results:
-            
-            # import ipdb; ipdb.set_trace()
-            # get the raw predictions data
-            scores = single_image_results['scores'].cpu().numpy()
-            boxes = single_image_results['boxes'].cpu().numpy()
-            labels = single_image_results['labels'].cpu().numpy()
-
-            # select by scores
-            keep_indices = np.where(scores > 0.1)[0]
-            filtered_scores = scores[keep_indices]
-            filtered_boxes = boxes[keep_indices]
-            filtered_labels = labels[keep_indices]
-
-            # build the output file path
-            output_file = os.path.join(output_dir, f"output_{idx}.txt")
-            with open(output_file, 'w') as f:
-                for box, label, score in zip(filtered_boxes, filtered_labels, filtered_scores):
-                    f.write(f"{label-1} {' '.join(map(str, box))} {score:.6f}\n")
+        if online_evaluator is not None:
+            online_evaluator.update(base_ds, targets, results)
+        if export_predictions:
+            export_predictions_yolo(results, targets, output_dir, score_threshold)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
+    print("Prefetch stats:", prefetcher.stats())
+
+    if output_cache is not None:
+        output_cache.finalize()
+        print("Model outputs cached in", output_cache.cache_dir)
+
+    if online_evaluator is not None:
+        online_evaluator.synchronize_between_processes()
+        if utils.is_main_process():
+            online_evaluator.run_evaluation()
+
+
+@torch.no_grad()
+def test_from_cache(postprocessors, output_cache, base_ds, device, output_dir, batch_size=1,
+                    online_evaluator=None, export_predictions=True, score_threshold=0.1):
+    """Re-run post-processing, export and online evaluation on cached model outputs."""
+    num_images = 0
+    for outputs, targets in output_cache.batches(batch_size, device):
+        num_images += len(targets)
+        orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
+        results = postprocessors['bbox'](outputs, orig_target_sizes)
+        if online_evaluator is not None:
+            online_evaluator.update(base_ds, targets, results)
+        if export_predictions:
+            export_predictions_yolo(results, targets, output_dir, score_threshold)
+    print("Post-processed {} cached images from {}".format(num_images, output_cache.cache_dir))
+
+    if online_evaluator is not None:
+        online_evaluator.synchronize_between_processes()
+        if utils.is_main_process():
+            online_evaluator.run_evaluation()
+
+
+@torch.no_grad()
+def test_videos(model, postprocessors, data_loader, device, output_dir, prefetch_depth=2, score_threshold=0.1):
+    """Write the YOLO-style lines of every frame of a video_multi loader to ``{output_dir}/{video}/output_{frame_id}.txt``."""
+    model.eval()
+    dataset = data_loader.dataset
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Test videos:'
+
+    prefetcher = data_prefetcher(data_loader, device, prefetch=True, depth=prefetch_depth)
+    for samples, targets in metric_logger.log_every(prefetcher, 10, header):
+        targets = targets.unpack()
+        outputs = model(samples)
+        orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
+        results = postprocessors['bbox'](outputs, orig_target_sizes)
+        for target, single_image_results in zip(targets, results):
+            video_dir = os.path.join(output_dir, dataset.video_name(target['video_id'].item()))
+            os.makedirs(video_dir, exist_ok=True)
+            output_file = os.path.join(video_dir, f"output_{target['frame_id'].item()}.txt")
+            with open(output_file, 'w') as f:
+                for line in yolo_lines(single_image_results, score_threshold):
+                    f.write(line + "\n")
+    print("Prefetch stats:", prefetcher.stats())
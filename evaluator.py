@@ -2,6 +2,9 @@ import os
 import numpy as np
 from collections import defaultdict
 import json
+import hashlib
+
+from label_store import LabelStore
 
 class DetectionEvaluator:
     def __init__(self, config):
@@ -15,6 +18,8 @@ class DetectionEvaluator:
         - output_file: 结果保存文件名（可选）
         - consistency_iou_threshold: 时序一致性IoU阈值（默认0.3）
         - stability_threshold: 时空稳定性阈值（默认0.8，即80%）
+        - use_label_store: 是否通过 label_store.LabelStore 读取真实标签（默认False）
+        - cache_dir: 逐视频评估结果缓存目录（可选），视频的标签/预测文件和评估参数都未变化时直接复用缓存
         """
         self.gt_root = config['gt_root']
         self.pred_root = config['pred_root']
@@ -26,6 +31,13 @@ class DetectionEvaluator:
         self.consistency_iou_threshold = config.get('consistency_iou_threshold', 0.3)
         self.stability_threshold = config.get('stability_threshold', 0.8)
         
+        # 已解析的真实标签库（避免每次重新解析标签文件）
+        self.label_store = LabelStore(self.gt_root) if config.get('use_label_store', False) else None
+        
+        # 逐视频评估结果缓存
+        self.cache_dir = config.get('cache_dir', None)
+        self.cache_hits = 0
+        
         # 总体统计信息
         self.total_tp = defaultdict(int)
         self.total_fp = defaultdict(int)
@@ -60,6 +72,18 @@ class DetectionEvaluator:
     
     def load_yolo_file(self, file_path):
         """加载YOLO格式文件"""
+        if self.label_store is not None:
+            rows = self.label_store.lookup(file_path)
+            if rows is not None:
+                return [{
+                    'class_id': int(row[0]),
+                    'x_center': float(row[1]),
+                    'y_center': float(row[2]),
+                    'width': float(row[3]),
+                    'height': float(row[4]),
+                    'confidence': 1.0
+                } for row in rows]
+        
         boxes = []
         if os.path.exists(file_path):
             try:
@@ -427,6 +451,14 @@ class DetectionEvaluator:
             print(f"警告: 视频 {video_name} 的预测结果目录中没有找到txt文件")
             return None
         
+        # 按内容哈希查找缓存，文件和评估参数都没有变化时直接复用统计数据
+        min_frames = min(len(gt_files), len(pred_files))
+        cache_key = self.video_cache_key(gt_files[:min_frames], pred_files[:min_frames]) if self.cache_dir else None
+        video_stats = self.load_cached_video_stats(video_name, cache_key) if cache_key else None
+        if video_stats is not None:
+            self.cache_hits += 1
+            return self.finish_video(video_name, video_stats, len(gt_files), len(pred_files))
+        
         # 初始化该视频的统计数据
         video_stats = {
             'tp': defaultdict(int),
@@ -456,6 +488,58 @@ class DetectionEvaluator:
             pred_file = pred_files[i]
             self.evaluate_frame_pair(gt_file, pred_file, video_stats)
         
+        if cache_key:
+            self.save_cached_video_stats(video_name, cache_key, video_stats)
+        
+        return self.finish_video(video_name, video_stats, len(gt_files), len(pred_files))
+    
+    def video_cache_key(self, gt_files, pred_files):
+        """根据参与比较的标签/预测文件内容和评估参数计算缓存键"""
+        h = hashlib.sha1()
+        h.update(json.dumps({
+            'iou_threshold': self.iou_threshold,
+            'consistency_iou_threshold': self.consistency_iou_threshold,
+            'class_names': self.class_names
+        }, sort_keys=True).encode('utf-8'))
+        for file_path in gt_files + pred_files:
+            h.update(os.path.basename(file_path).encode('utf-8'))
+            with open(file_path, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        return h.hexdigest()
+    
+    def load_cached_video_stats(self, video_name, cache_key):
+        """读取缓存的视频统计数据，缓存不存在或已过期时返回 None"""
+        cache_file = os.path.join(self.cache_dir, f"{video_name}.json")
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('cache_key') != cache_key:
+            return None
+        
+        video_stats = {}
+        for key, value in cached['video_stats'].items():
+            if isinstance(value, dict):
+                video_stats[key] = defaultdict(int, {int(k): v for k, v in value.items()})
+            else:
+                video_stats[key] = value
+        return video_stats
+    
+    def save_cached_video_stats(self, video_name, cache_key, video_stats):
+        """保存视频统计数据到缓存"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = os.path.join(self.cache_dir, f"{video_name}.json")
+        with open(cache_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'cache_key': cache_key, 'video_stats': video_stats}, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    
+    def finish_video(self, video_name, video_stats, frames_gt, frames_pred):
+        """根据视频统计数据计算指标并汇总到总体统计"""
+        min_frames = min(frames_gt, frames_pred)
+        
         # 计算该视频的指标（使用宏平均）
         video_metrics = self.calculate_metrics_for_stats(video_stats, use_macro_average=True)
         
@@ -470,8 +554,8 @@ class DetectionEvaluator:
         # 保存该视频的结果
         self.video_results[video_name] = {
             'frames_processed': min_frames,
-            'frames_gt': len(gt_files),
-            'frames_pred': len(pred_files),
+            'frames_gt': frames_gt,
+            'frames_pred': frames_pred,
             'metrics': video_metrics
         }
         
@@ -482,7 +566,7 @@ class DetectionEvaluator:
         frames_gt5 = video_metrics['overall']['frames_with_targets_gt5']
         consistent_gt5 = video_metrics['overall']['consistent_frames_gt5']
         
-        print(f"视频 {video_name}: 处理了 {min_frames} 帧 (GT: {len(gt_files)}, Pred: {len(pred_files)}) - 时序一致性: {temporal_consistency:.3f}")
+        print(f"视频 {video_name}: 处理了 {min_frames} 帧 (GT: {frames_gt}, Pred: {frames_pred}) - 时序一致性: {temporal_consistency:.3f}")
         print(f"  <=5目标帧: {consistent_le5}/{frames_le5}, >5目标帧: {consistent_gt5}/{frames_gt5}")
         return min_frames
     
@@ -539,6 +623,8 @@ class DetectionEvaluator:
         
         print("-" * 80)
         print(f"评估完成，总共处理了 {total_frames} 帧")
+        if self.cache_dir:
+            print(f"缓存命中 {self.cache_hits}/{len(common_videos)} 个视频 (缓存目录: {self.cache_dir})")
     
     def calculate_overall_metrics_direct_video_average(self):
         """直接基于视频总体指标进行平均"""
@@ -831,6 +917,259 @@ class DetectionEvaluator:
         return overall_metrics
 
 
+def box_iou_matrix(boxes1, boxes2):
+    """计算两组 [x_center, y_center, width, height] 框两两之间的IoU矩阵"""
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    b1_min = boxes1[:, None, :2] - boxes1[:, None, 2:] / 2
+    b1_max = boxes1[:, None, :2] + boxes1[:, None, 2:] / 2
+    b2_min = boxes2[None, :, :2] - boxes2[None, :, 2:] / 2
+    b2_max = boxes2[None, :, :2] + boxes2[None, :, 2:] / 2
+
+    inter = np.clip(np.minimum(b1_max, b2_max) - np.maximum(b1_min, b2_min), 0, None).prod(axis=2)
+    area1 = boxes1[:, 2] * boxes1[:, 3]
+    area2 = boxes2[:, 2] * boxes2[:, 3]
+    union = area1[:, None] + area2[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def greedy_match(iou, order, threshold):
+    """
+    按 order 顺序为每一行贪心地选择IoU最大且未被占用的列
+    与 DetectionEvaluator.match_boxes 的规则一致：只接受 IoU > 0 且 >= threshold 的匹配
+    返回每一行匹配到的列索引（未匹配为 -1）
+    """
+    matched_row = np.full(iou.shape[0], -1, dtype=np.int64)
+    if iou.shape[1] == 0:
+        return matched_row
+    used = np.zeros(iou.shape[1], dtype=bool)
+    for row in order:
+        candidates = np.where(used, 0.0, iou[row])
+        col = int(candidates.argmax())
+        best_iou = candidates[col]
+        if best_iou > 0 and best_iou >= threshold:
+            matched_row[row] = col
+            used[col] = True
+    return matched_row
+
+
+class StreamingDetectionEvaluator(DetectionEvaluator):
+    """
+    在线评估器：直接消费模型后处理结果和数据集标签，逐帧累计每个视频的统计量
+    不需要先把预测结果写成txt再重新读取，最终输出与 DetectionEvaluator.save_results 相同格式的JSON
+
+    每个视频的统计量保存在紧凑数组中：
+    - counts: shape (6, num_classes)，依次为 tp, fp, fn, total_gt, total_pred, recall_tp
+    - frames: shape (6,)，依次为 total_frames, consistency_frames, frames_with_targets_le5,
+      consistent_frames_le5, frames_with_targets_gt5, consistent_frames_gt5
+    recall_tp 按 Recall.py 的规则（以真实框为主的贪心匹配）统计
+    """
+    COUNT_FIELDS = ('tp', 'fp', 'fn', 'total_gt', 'total_pred', 'recall_tp')
+    FRAME_FIELDS = ('total_frames', 'consistency_frames',
+                    'frames_with_targets_le5', 'consistent_frames_le5',
+                    'frames_with_targets_gt5', 'consistent_frames_gt5')
+
+    def __init__(self, config):
+        """
+        在 DetectionEvaluator 配置的基础上增加：
+        - score_threshold: 预测框置信度过滤阈值（默认0.1，与 engine_multi.test 导出txt时一致）
+        - label_offset: 模型类别编号减去该值得到评估类别编号（默认1）
+        gt_root / pred_root 仅记录在结果JSON中，可以不提供
+        """
+        config = dict(config)
+        config.setdefault('gt_root', 'online')
+        config.setdefault('pred_root', 'online')
+        super().__init__(config)
+        self.score_threshold = config.get('score_threshold', 0.1)
+        self.label_offset = config.get('label_offset', 1)
+        self.num_classes = len(self.class_names) if self.class_names else 1
+        self.video_counts = {}
+        self.video_frames = {}
+
+    def _video_arrays(self, video_name, max_class_id):
+        if max_class_id >= self.num_classes:
+            grow = max_class_id + 1 - self.num_classes
+            for name in self.video_counts:
+                self.video_counts[name] = np.pad(self.video_counts[name], ((0, 0), (0, grow)))
+            self.num_classes = max_class_id + 1
+        if video_name not in self.video_counts:
+            self.video_counts[video_name] = np.zeros((len(self.COUNT_FIELDS), self.num_classes), dtype=np.int64)
+            self.video_frames[video_name] = np.zeros(len(self.FRAME_FIELDS), dtype=np.int64)
+        return self.video_counts[video_name], self.video_frames[video_name]
+
+    def update_frame(self, video_name, gt_classes, gt_boxes, pred_classes, pred_boxes, pred_scores):
+        """
+        累计一帧的统计量
+        框格式为归一化的 [x_center, y_center, width, height]，与YOLO标签一致
+        """
+        gt_classes = np.asarray(gt_classes, dtype=np.int64).reshape(-1)
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        pred_classes = np.asarray(pred_classes, dtype=np.int64).reshape(-1)
+        pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+        pred_scores = np.asarray(pred_scores, dtype=np.float64).reshape(-1)
+        # 减去 label_offset 后为负的类别（如背景类0）不参与统计
+        gt_valid = gt_classes >= 0
+        gt_classes, gt_boxes = gt_classes[gt_valid], gt_boxes[gt_valid]
+        pred_valid = pred_classes >= 0
+        pred_classes, pred_boxes, pred_scores = pred_classes[pred_valid], pred_boxes[pred_valid], pred_scores[pred_valid]
+        max_class_id = max(gt_classes.max(initial=0), pred_classes.max(initial=0))
+        counts, frames = self._video_arrays(video_name, int(max_class_id))
+
+        # 只计算一次IoU矩阵，不同类别之间的IoU置0
+        iou = box_iou_matrix(pred_boxes, gt_boxes)
+        iou = np.where(pred_classes[:, None] == gt_classes[None, :], iou, 0.0)
+        order = np.argsort(-pred_scores, kind='stable')
+
+        pred_match = greedy_match(iou, order, self.iou_threshold)
+        num_classes = counts.shape[1]
+        gt_count = np.bincount(gt_classes, minlength=num_classes)
+        pred_count = np.bincount(pred_classes, minlength=num_classes)
+        tp = np.bincount(pred_classes[pred_match >= 0], minlength=num_classes)
+        counts[0] += tp
+        counts[1] += pred_count - tp
+        counts[2] += gt_count - tp
+        counts[3] += gt_count
+        counts[4] += pred_count
+
+        recall_match = greedy_match(iou.T, np.arange(len(gt_classes)), self.iou_threshold)
+        counts[5] += np.bincount(gt_classes[recall_match >= 0], minlength=num_classes)
+
+        # 时序一致性（与 check_frame_consistency 规则相同）
+        num_gt = len(gt_classes)
+        if num_gt == 0:
+            is_consistent = True
+        else:
+            if self.consistency_iou_threshold == self.iou_threshold:
+                detected = int((pred_match >= 0).sum())
+            else:
+                detected = int((greedy_match(iou, order, self.consistency_iou_threshold) >= 0).sum())
+            required = num_gt if num_gt <= 5 else int(num_gt * 0.8)
+            is_consistent = detected >= required
+
+        frames[0] += 1
+        frames[1] += int(is_consistent)
+        if num_gt > 0:
+            offset = 2 if num_gt <= 5 else 4
+            frames[offset] += 1
+            frames[offset + 1] += int(is_consistent)
+
+    def update(self, base_ds, targets, results):
+        """
+        累计一个batch的结果
+        base_ds: COCO api对象，用 image_id 查找帧所属的视频目录
+        targets: 数据集标签（boxes 为归一化 cxcywh）
+        results: PostProcess 的输出（boxes 为归一化 cxcywh）
+        """
+        for target, result in zip(targets, results):
+            image_id = int(target['image_id'])
+            file_name = base_ds.imgs[image_id]['file_name']
+            video_name = os.path.basename(os.path.dirname(file_name))
+
+            scores = result['scores'].detach().cpu().numpy()
+            keep = scores > self.score_threshold
+            self.update_frame(
+                video_name,
+                target['labels'].cpu().numpy() - self.label_offset,
+                target['boxes'].cpu().numpy(),
+                result['labels'].detach().cpu().numpy()[keep] - self.label_offset,
+                result['boxes'].detach().cpu().numpy()[keep],
+                scores[keep])
+
+    def synchronize_between_processes(self):
+        """分布式评估时合并各进程的统计量（按视频对齐后 all_reduce 求和）"""
+        import torch
+        import torch.distributed as dist
+        import util.misc as utils
+
+        if not utils.is_dist_avail_and_initialized():
+            return
+        gathered = utils.all_gather((sorted(self.video_counts.keys()), self.num_classes))
+        video_names = sorted(set(name for names, _ in gathered for name in names))
+        num_classes = max(n for _, n in gathered)
+
+        counts = np.zeros((len(video_names), len(self.COUNT_FIELDS), num_classes), dtype=np.int64)
+        frames = np.zeros((len(video_names), len(self.FRAME_FIELDS)), dtype=np.int64)
+        for i, name in enumerate(video_names):
+            if name in self.video_counts:
+                counts[i, :, :self.num_classes] = self.video_counts[name]
+                frames[i] = self.video_frames[name]
+
+        # NCCL 只能规约 CUDA 张量，gloo 等后端使用 CPU 张量
+        merged = torch.from_numpy(np.concatenate([counts.reshape(-1), frames.reshape(-1)]))
+        if dist.get_backend() == 'nccl':
+            merged = merged.cuda()
+        dist.all_reduce(merged)
+        merged = merged.cpu().numpy()
+        counts = merged[:counts.size].reshape(counts.shape)
+        frames = merged[counts.size:].reshape(frames.shape)
+
+        self.num_classes = num_classes
+        self.video_counts = {name: counts[i] for i, name in enumerate(video_names)}
+        self.video_frames = {name: frames[i] for i, name in enumerate(video_names)}
+
+    def stats_for_video(self, video_name):
+        """把紧凑数组转换为 calculate_metrics_for_stats 使用的统计字典"""
+        counts = self.video_counts[video_name]
+        frames = self.video_frames[video_name]
+        video_stats = {field: defaultdict(int) for field in self.COUNT_FIELDS}
+        # 只保留该视频中出现过（真实或预测）的类别，与逐文件评估一致
+        for class_id in np.nonzero(counts[3] + counts[4])[0]:
+            for field, row in zip(self.COUNT_FIELDS, counts):
+                video_stats[field][int(class_id)] = int(row[class_id])
+        for field, value in zip(self.FRAME_FIELDS, frames):
+            video_stats[field] = int(value)
+        return video_stats
+
+    def evaluate_all(self):
+        """根据累计的统计量生成各视频的结果"""
+        print(f"在线评估，共 {len(self.video_counts)} 个视频")
+        print(f"IoU阈值: {self.iou_threshold}")
+        print(f"时序一致性IoU阈值: {self.consistency_iou_threshold}")
+        print("-" * 80)
+
+        for video_name in sorted(self.video_counts.keys()):
+            video_stats = self.stats_for_video(video_name)
+            video_metrics = self.calculate_metrics_for_stats(video_stats, use_macro_average=True)
+            for class_id in video_stats['tp'].keys():
+                self.total_tp[class_id] += video_stats['tp'][class_id]
+                self.total_fp[class_id] += video_stats['fp'][class_id]
+                self.total_fn[class_id] += video_stats['fn'][class_id]
+                self.total_gt_count[class_id] += video_stats['total_gt'][class_id]
+                self.total_pred_count[class_id] += video_stats['total_pred'][class_id]
+
+            frames_processed = video_stats['total_frames']
+            self.video_results[video_name] = {
+                'frames_processed': frames_processed,
+                'frames_gt': frames_processed,
+                'frames_pred': frames_processed,
+                'metrics': video_metrics
+            }
+
+    def recall_results(self):
+        """按 Recall.py 的规则汇总总体召回率和各类别召回率"""
+        counts = sum(self.video_counts.values())
+        if isinstance(counts, int):
+            return 0, {}
+        recall_tp = counts[5]
+        total_gt = counts[3]
+        overall_recall = recall_tp.sum() / total_gt.sum() if total_gt.sum() > 0 else 0
+        class_recall_results = {}
+        for class_id in np.nonzero(total_gt)[0]:
+            class_name = self.class_names[class_id] if self.class_names and class_id < len(self.class_names) else f"Class {class_id}"
+            class_recall_results[class_name] = float(recall_tp[class_id] / total_gt[class_id])
+        return float(overall_recall), class_recall_results
+
+    def run_evaluation(self):
+        """生成结果、打印并保存（输出与 DetectionEvaluator 相同）"""
+        overall_metrics = super().run_evaluation()
+        if self.video_results:
+            overall_recall, class_recall_results = self.recall_results()
+            print(f"\n总体召回率 (Recall.py 规则, IoU={self.iou_threshold}): {overall_recall:.4f}")
+            for class_name, class_recall in class_recall_results.items():
+                print(f"  - {class_name}: Recall={class_recall:.4f}")
+        return overall_metrics
+
+
 def main():
     # ==================== 配置区域 ====================
     config = {
@@ -851,6 +1190,12 @@ def main():
         # 结果保存文件名
         'output_file': 'detection_evaluation_results_simplified.json',
         
+        # 是否使用已解析的真实标签库 (见 label_store.py)
+        'use_label_store': False,
+        
+        # 逐视频评估结果缓存目录 (设置为 None 则每次重新评估所有视频)
+        'cache_dir': 'evaluation_cache',
+        
         # 时序一致性IoU阈值（默认0.3）
         'consistency_iou_threshold': 0.3,
         
@@ -0,0 +1,74 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Run the multi-frame model on video files without extracting their frames.
+
+--video_path is a video file or a directory of them (MP4, AVI, ...); frames
+are decoded by background threads (see datasets/video_multi.py) and the
+YOLO-style lines of every frame are written to
+{output_dir}/{video name}/output_{frame_id}.txt, frame ids counting from 0.
+
+    python infer_videos.py --video_path videos/ --resume ckpt.pth --output_dir out
+
+Unknown arguments are passed to the main.py parser, e.g. --num_ref_frames.
+"""
+import argparse
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc_multi as utils
+from datasets.video_multi import build as build_video_dataset
+from engine_multi import test_videos
+from main import get_args_parser as get_main_args_parser
+from models import build_model
+from util.checkpoint import load_checkpoint
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Detect objects in video files with the multi-frame model.')
+    parser.add_argument('--video_path', required=True, type=str, help='video file or directory of videos')
+    parser.add_argument('--video_queue_size', default=16, type=int,
+                        help='decoded frames a decoder thread may run ahead')
+    parser.add_argument('--video_ref_window', default=64, type=int,
+                        help='frames around the key frame its references are sampled from; '
+                             'about this many frames per video stay decoded')
+    return parser
+
+
+def main():
+    args, rest = get_args_parser().parse_known_args()
+    main_args = get_main_args_parser().parse_args(rest)
+    main_args.video_queue_size = args.video_queue_size
+    main_args.video_ref_window = args.video_ref_window
+    main_args.dataset_file = 'tzb_multi'
+    main_args.pretrained = None
+    assert main_args.resume, 'pass the checkpoint with --resume'
+    device = torch.device(main_args.device)
+
+    model, _, postprocessors = build_model(main_args)
+    missing_keys, unexpected_keys = model.load_state_dict(load_checkpoint(main_args.resume)['model'], strict=False)
+    if len(missing_keys) > 0:
+        print('Missing Keys: {}'.format(missing_keys))
+    if len(unexpected_keys) > 0:
+        print('Unexpected Keys: {}'.format(unexpected_keys))
+    model.to(device)
+
+    dataset = build_video_dataset(args.video_path, main_args)
+    print('{} videos, about {} frames'.format(len(dataset.video_paths), len(dataset)))
+    # TDAM fuses the frames of exactly one clip per forward
+    data_loader = DataLoader(dataset, 1, collate_fn=utils.collate_fn, num_workers=main_args.num_workers,
+                             pin_memory=True)
+    output_dir = main_args.output_dir or 'video_outputs'
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    test_videos(model, postprocessors, data_loader, device, output_dir,
+                prefetch_depth=main_args.prefetch_depth, score_threshold=main_args.test_score_threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def label_store_dir(labels_root):
+    """标签库默认保存在标签根目录旁边，例如 labels -> labels_store"""
+    return os.path.normpath(labels_root) + '_store'
+
+
+def video_signature(video_dir):
+    """根据视频标签目录中所有txt文件的文件名、大小和修改时间计算签名"""
+    entries = []
+    with os.scandir(video_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith('.txt'):
+                stat = entry.stat()
+                entries.append(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    entries.sort()
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+def parse_video_labels(video_dir):
+    """
+    解析一个视频目录下所有YOLO标签文件
+    返回 (frames, offsets, boxes)：
+    - frames: 帧名列表（不含 .txt，按文件名排序）
+    - offsets: shape (len(frames) + 1,)，第 i 帧的框为 boxes[offsets[i]:offsets[i + 1]]
+    - boxes: shape (N, 5)，每行 [class_id, x_center, y_center, width, height]
+    """
+    frames = sorted(os.path.splitext(f)[0] for f in os.listdir(video_dir) if f.lower().endswith('.txt'))
+    offsets = [0]
+    rows = []
+    for frame in frames:
+        try:
+            with open(os.path.join(video_dir, frame + '.txt'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 5:
+                        rows.append([float(v) for v in parts[:5]])
+        except Exception as e:
+            print(f"警告: 读取文件 {os.path.join(video_dir, frame + '.txt')} 时出错: {e}")
+        offsets.append(len(rows))
+    boxes = np.asarray(rows, dtype=np.float64).reshape(-1, 5)
+    return frames, np.asarray(offsets, dtype=np.int64), boxes
+
+
+class LabelStore:
+    """
+    解析后的真实标签库
+    每个视频的标签目录编译为一个紧凑数组文件 {video}.npy 和一个索引文件 {video}.json（帧名、逐帧偏移、签名）
+    打开时按文件大小/修改时间签名检查是否过期，只重建发生变化的视频
+    读取时数组以内存映射方式打开，每帧的框是数组切片（无需拷贝和重新解析）
+    """
+    def __init__(self, labels_root, store_dir=None, verbose=True):
+        self.labels_root = os.path.abspath(labels_root)
+        self.store_dir = store_dir or label_store_dir(labels_root)
+        self.verbose = verbose
+        self._videos = {}
+        self.build()
+
+    def _paths(self, video_name):
+        return (os.path.join(self.store_dir, video_name + '.npy'),
+                os.path.join(self.store_dir, video_name + '.json'))
+
+    def _load_index(self, video_name):
+        index_path = self._paths(video_name)[1]
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def build(self):
+        """检查所有视频的签名，增量重建发生变化的视频"""
+        if not os.path.isdir(self.labels_root):
+            print(f"警告: 真实标签根目录不存在: {self.labels_root}")
+            return
+        if not os.path.isdir(self.store_dir):
+            print(f"创建标签库目录: {self.store_dir}")
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        video_names = sorted(d for d in os.listdir(self.labels_root)
+                             if os.path.isdir(os.path.join(self.labels_root, d)))
+        rebuilt = 0
+        for video_name in video_names:
+            signature = video_signature(os.path.join(self.labels_root, video_name))
+            index = self._load_index(video_name)
+            boxes_path, index_path = self._paths(video_name)
+            if index is None or index.get('signature') != signature or not os.path.exists(boxes_path):
+                frames, offsets, boxes = parse_video_labels(os.path.join(self.labels_root, video_name))
+                # 先写临时文件再替换，避免中断时留下不完整的库文件
+                np.save(boxes_path + '.tmp.npy', boxes)
+                os.replace(boxes_path + '.tmp.npy', boxes_path)
+                index = {'signature': signature, 'frames': frames, 'offsets': offsets.tolist()}
+                with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(index, f)
+                os.replace(index_path + '.tmp', index_path)
+                rebuilt += 1
+            self._videos[video_name] = {
+                'frames': {frame: i for i, frame in enumerate(index['frames'])},
+                'frame_names': index['frames'],
+                'offsets': np.asarray(index['offsets'], dtype=np.int64),
+                'boxes': None,
+            }
+
+        # 删除已不存在的视频：只删除本标签库写入的文件（带 signature 的索引及其数组），
+        # store_dir 中的其他文件保持不动
+        for file_name in os.listdir(self.store_dir):
+            name, ext = os.path.splitext(file_name)
+            if ext != '.json' or name in self._videos:
+                continue
+            index = self._load_index(name)
+            if not isinstance(index, dict) or 'signature' not in index:
+                continue
+            boxes_path, index_path = self._paths(name)
+            if os.path.exists(boxes_path):
+                os.remove(boxes_path)
+            os.remove(index_path)
+
+        if self.verbose:
+            print(f"标签库: {self.store_dir}，共 {len(self._videos)} 个视频，重建 {rebuilt} 个")
+
+    def videos(self):
+        return sorted(self._videos.keys())
+
+    def frames(self, video_name):
+        """视频中有标签文件的帧名（不含 .txt，按文件名排序）"""
+        return list(self._videos[video_name]['frame_names'])
+
+    def get(self, video_name, frame_name):
+        """
+        返回一帧的标签数组 shape (n, 5)（内存映射切片，只读）
+        视频或帧不在库中时返回 None
+        """
+        video = self._videos.get(video_name)
+        if video is None:
+            return None
+        i = video['frames'].get(frame_name)
+        if i is None:
+            return None
+        if video['boxes'] is None:
+            if video['offsets'][-1] == 0:
+                # 空数组无法内存映射
+                video['boxes'] = np.zeros((0, 5), dtype=np.float64)
+            else:
+                video['boxes'] = np.load(self._paths(video_name)[0], mmap_mode='r')
+        return video['boxes'][video['offsets'][i]:video['offsets'][i + 1]]
+
+    def lookup(self, label_path):
+        """
+        按标签文件路径查询（路径需位于 labels_root/{video}/{frame}.txt）
+        不在库中时返回 None，调用方应回退到直接读取文件
+        """
+        label_path = os.path.abspath(label_path)
+        video_dir, file_name = os.path.split(label_path)
+        if os.path.dirname(video_dir) != self.labels_root:
+            return None
+        return self.get(os.path.basename(video_dir), os.path.splitext(file_name)[0])
+
+
+if __name__ == "__main__":
+    # 构建或增量更新标签库
+    LabelStore("data/tzb/Data/comp/labels")
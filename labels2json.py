@@ -1,9 +1,13 @@
 import os
 import json
+import struct
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
 YOLO_ROOT = "data/tzb"  # 根目录，下面有 images/ 和 labels/
 OUTPUT_JSON = "data/annotations/tzb_annotations.json"
+NUM_WORKERS = None  # 并行进程数，None 为CPU核数，0 为不使用多进程
 
 CATEGORY_MAP = {
     0: "drone",
@@ -14,71 +18,224 @@ CATEGORY_MAP = {
     5: "cyclist"
 }
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
 def list_videos(base_path):
     return sorted([d for d in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, d))])
 
-def convert_yolo_to_coco(images_root, labels_root):
-    image_id = 1
-    annotation_id = 1
-    coco_images = []
-    coco_annotations = []
+def read_image_size(img_path):
+    """只读取文件头获取图像尺寸 (width, height)，不支持的格式回退到PIL"""
+    with open(img_path, "rb") as f:
+        head = f.read(26)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            width, height = struct.unpack(">II", head[16:24])
+            return width, height
+        if head[:2] == b"BM":
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)
+        if head[:2] == b"\xff\xd8":
+            # 跳过各个段，直到遇到包含尺寸的SOF段
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                code = marker[1]
+                if code == 0xFF:
+                    f.seek(-1, os.SEEK_CUR)
+                    continue
+                if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                    continue
+                length = struct.unpack(">H", f.read(2))[0]
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    with Image.open(img_path) as img:
+        return img.size
+
+def video_signature(image_dir, label_dir):
+    """根据视频图像和标签文件的文件名、大小和修改时间计算签名"""
+    entries = []
+    for directory in (image_dir, label_dir):
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append(f"{directory}/{entry.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    entries.sort()
+    return hashlib.sha1("\n".join(entries).encode("utf-8")).hexdigest()
+
+def convert_video(images_root, labels_root, video_dir):
+    """
+    转换单个视频，返回紧凑的视频记录（不含 id，id 在合并时统一分配）：
+    - images: [[file_name, width, height], ...]
+    - annotations: [[图像在本视频中的序号, category_id, bbox, area], ...]
+    """
+    image_dir = os.path.join(images_root, video_dir)
+    label_dir = os.path.join(labels_root, video_dir)
+
+    img_files = sorted([
+        f for f in os.listdir(image_dir)
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    ])
+
+    images = []
+    annotations = []
+    for img_file in img_files:
+        img_path = os.path.join(image_dir, img_file)
+        label_file = os.path.splitext(img_file)[0] + ".txt"
+        label_path = os.path.join(label_dir, label_file)
+
+        try:
+            width, height = read_image_size(img_path)
+        except Exception:
+            print(f"无法读取图像: {img_path}")
+            continue
+
+        image_index = len(images)
+        images.append([f"{video_dir}/{img_file}", width, height])
+
+        if os.path.exists(label_path):
+            with open(label_path, "r") as lf:
+                for line in lf:
+                    parts = line.strip().split()
+                    if len(parts) != 5:
+                        continue
+                    cls_id, x_center, y_center, w, h = map(float, parts)
+                    x_center *= width
+                    y_center *= height
+                    w *= width
+                    h *= height
+                    x = x_center - w / 2
+                    y = y_center - h / 2
 
+                    annotations.append([
+                        image_index,
+                        int(cls_id),
+                        [round(x, 2), round(y, 2), round(w, 2), round(h, 2)],
+                        round(w * h, 2)
+                    ])
+
+    return {"images": images, "annotations": annotations}
+
+def _convert_video_job(job):
+    images_root, labels_root, video_dir, manifest_dir, signature = job
+    record = convert_video(images_root, labels_root, video_dir)
+    if manifest_dir:
+        manifest_path = os.path.join(manifest_dir, f"{video_dir}.json")
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"signature": signature, "record": record}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    return video_dir, record
+
+def load_manifest(manifest_dir, video_dir, signature):
+    """读取视频清单，签名一致时返回缓存的视频记录"""
+    manifest_path = os.path.join(manifest_dir, f"{video_dir}.json")
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("signature") != signature:
+        return None
+    return manifest["record"]
+
+def convert_yolo_to_coco_records(images_root, labels_root, manifest_dir=None, num_workers=None):
+    """
+    并行转换所有视频，返回按视频名排序的视频记录列表
+    提供 manifest_dir 时，图像和标签都未变化的视频直接复用上次的转换结果
+    """
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    records = {}
+    jobs = []
+    video_dirs = []
     for video_dir in list_videos(images_root):
         image_dir = os.path.join(images_root, video_dir)
         label_dir = os.path.join(labels_root, video_dir)
         if not os.path.exists(label_dir):
             print(f"标签目录不存在，跳过: {label_dir}")
             continue
+        video_dirs.append(video_dir)
 
-        img_files = sorted([
-            f for f in os.listdir(image_dir)
-            if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))
-        ])
+        signature = video_signature(image_dir, label_dir) if manifest_dir else None
+        record = load_manifest(manifest_dir, video_dir, signature) if manifest_dir else None
+        if record is not None:
+            records[video_dir] = record
+        else:
+            jobs.append((images_root, labels_root, video_dir, manifest_dir, signature))
 
-        for img_file in img_files:
-            img_path = os.path.join(image_dir, img_file)
-            label_file = os.path.splitext(img_file)[0] + ".txt"
-            label_path = os.path.join(label_dir, label_file)
+    print(f"共 {len(video_dirs)} 个视频，需要转换 {len(jobs)} 个，复用 {len(video_dirs) - len(jobs)} 个")
+    if num_workers == 0:
+        records.update(map(_convert_video_job, jobs))
+    elif jobs:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            records.update(executor.map(_convert_video_job, jobs))
 
-            try:
-                with Image.open(img_path) as img:
-                    width, height = img.size
-            except:
-                print(f"无法读取图像: {img_path}")
-                continue
+    return [records[video_dir] for video_dir in video_dirs]
 
-            coco_images.append({
+def iter_coco_items(records):
+    """按视频顺序分配 image_id / annotation_id（与串行转换的编号一致），逐条生成图像和标注"""
+    image_id = 1
+    annotation_id = 1
+    images = []
+    annotations = []
+    for record in records:
+        for file_name, width, height in record["images"]:
+            images.append({
                 "id": image_id,
-                "file_name": f"{video_dir}/{img_file}",
+                "file_name": file_name,
                 "width": width,
                 "height": height
             })
+            image_id += 1
+        first_image_id = image_id - len(record["images"])
+        for image_index, category_id, bbox, area in record["annotations"]:
+            annotations.append({
+                "id": annotation_id,
+                "image_id": first_image_id + image_index,
+                "category_id": category_id,
+                "bbox": bbox,
+                "area": area,
+                "iscrowd": 0
+            })
+            annotation_id += 1
+        yield images, annotations
+        images = []
+        annotations = []
 
-            if os.path.exists(label_path):
-                with open(label_path, "r") as lf:
-                    for line in lf:
-                        parts = line.strip().split()
-                        if len(parts) != 5:
-                            continue
-                        cls_id, x_center, y_center, w, h = map(float, parts)
-                        x_center *= width
-                        y_center *= height
-                        w *= width
-                        h *= height
-                        x = x_center - w / 2
-                        y = y_center - h / 2
-
-                        coco_annotations.append({
-                            "id": annotation_id,
-                            "image_id": image_id,
-                            "category_id": int(cls_id),
-                            "bbox": [round(x, 2), round(y, 2), round(w, 2), round(h, 2)],
-                            "area": round(w * h, 2),
-                            "iscrowd": 0
-                        })
-                        annotation_id += 1
+def write_coco_json(records, output_json):
+    """流式写出COCO格式JSON，不在内存中构建完整的字典"""
+    tmp_path = output_json + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write('{"images": [')
+        first = True
+        for images, _ in iter_coco_items(records):
+            for image in images:
+                f.write(("" if first else ", ") + json.dumps(image))
+                first = False
+        f.write('], "annotations": [')
+        first = True
+        for _, annotations in iter_coco_items(records):
+            for annotation in annotations:
+                f.write(("" if first else ", ") + json.dumps(annotation))
+                first = False
+        f.write('], "categories": ')
+        f.write(json.dumps([{"id": cid, "name": name} for cid, name in CATEGORY_MAP.items()]))
+        f.write('}')
+    os.replace(tmp_path, output_json)
 
-            image_id += 1
+def convert_yolo_to_coco(images_root, labels_root, manifest_dir=None, num_workers=None):
+    records = convert_yolo_to_coco_records(images_root, labels_root, manifest_dir, num_workers)
+    coco_images = []
+    coco_annotations = []
+    for images, annotations in iter_coco_items(records):
+        coco_images.extend(images)
+        coco_annotations.extend(annotations)
 
     return {
         "images": coco_images,
@@ -91,11 +248,11 @@ if __name__ == "__main__":
     labels_dir = os.path.join(YOLO_ROOT, "labels")
     output_dir = os.path.dirname(OUTPUT_JSON)
     os.makedirs(output_dir, exist_ok=True)
+    # 每个视频的转换清单，重新运行时只转换图像或标签发生变化的视频
+    manifest_dir = os.path.splitext(OUTPUT_JSON)[0] + "_manifest"
 
     print("转换中，请稍等...")
-    coco_dict = convert_yolo_to_coco(images_dir, labels_dir)
-
-    with open(OUTPUT_JSON, "w") as f:
-        json.dump(coco_dict, f, indent=2)
+    records = convert_yolo_to_coco_records(images_dir, labels_dir, manifest_dir, NUM_WORKERS)
+    write_coco_json(records, OUTPUT_JSON)
 
     print(f"转换完成，输出文件位于：{OUTPUT_JSON}")
@@ -11,6 +11,9 @@
 import argparse
 import datetime
 import json
+import importlib
+import inspect
+import math
 import random
 import time
 from pathlib import Path
@@ -23,6 +26,10 @@ import datasets
 import datasets.samplers as samplers
 from datasets import build_dataset, get_coco_api_from_dataset
 from models import build_model
+from util.checkpoint import CheckpointWriter, load_checkpoint
+
+# class names of the tzb annotations, in YOLO class id order
+TZB_CLASS_NAMES = ['drone', 'car', 'ship', 'bus', 'pedestrian', 'cyclist']
 
 
 def get_args_parser():
@@ -43,6 +50,34 @@ def get_args_parser():
     parser.add_argument('--num_ref_frames', default=3, type=int, help='number of reference frames')
 
     parser.add_argument('--sgd', action='store_true')
+    parser.add_argument('--fused_optimizer', default=False, action='store_true',
+                        help='use the fused (CUDA) or foreach implementation of AdamW / SGD')
+    parser.add_argument('--ddp_static_graph', default=False, action='store_true',
+                        help='DDP static_graph=True instead of find_unused_parameters=True')
+    parser.add_argument('--ddp_bucket_cap_mb', default=25, type=int, help='DDP gradient bucket size')
+    parser.add_argument('--deferred_metrics', default=False, action='store_true',
+                        help='keep training metrics on the device and sync them every print_freq steps')
+    parser.add_argument('--profile_stages', default=False, action='store_true',
+                        help='log per-stage time and peak memory of the training step (train_stage_* in log.txt)')
+    parser.add_argument('--profile_trace_steps', default=0, type=int,
+                        help='with --profile_stages, write a Chrome trace of this many steps to stage_trace.json')
+    parser.add_argument('--profile_trace_start', default=10, type=int,
+                        help='first (global) training step of the Chrome trace')
+    parser.add_argument('--autotune', default=False, action='store_true',
+                        help='probe training configurations on synthetic data and write the fastest one that '
+                             'fits the memory budget to autotune.json (see autotune.py)')
+    parser.add_argument('--autotune_batch_sizes', default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--autotune_ref_frames', default=None, type=int, nargs='+',
+                        help='num_ref_frames candidates (default: only --num_ref_frames, it changes accuracy)')
+    parser.add_argument('--autotune_queries', default=None, type=int, nargs='+',
+                        help='num_queries candidates (default: only --num_queries, it changes accuracy)')
+    parser.add_argument('--autotune_steps', default=5, type=int, help='timed training steps per probe')
+    parser.add_argument('--autotune_memory_mb', default=None, type=float,
+                        help='memory budget (default: 90%% of the GPU memory, or of the available RAM on CPU)')
+    parser.add_argument('--autotune_frame_size', default=None, type=int, nargs=2, metavar=('H', 'W'),
+                        help='synthetic frame size (default: the largest size after the dataset resize)')
+    parser.add_argument('--ddp_comm_timing', default=False, action='store_true',
+                        help='log per-step all-reduce time (time_comm) against step time (time_step)')
 
     # Variants of Deformable DETR
     parser.add_argument('--with_box_refine', default=False, action='store_true')
@@ -131,16 +166,191 @@ def get_args_parser():
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=42, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
+    parser.add_argument('--ckpt_keep_last', default=0, type=int,
+                        help='keep only the newest N checkpoint{epoch:04}.pth files (0 keeps all)')
+    parser.add_argument('--ckpt_keep_every', default=0, type=int,
+                        help='with --ckpt_keep_last, also keep the checkpoint of every N-th epoch')
+    parser.add_argument('--ckpt_sync', default=False, action='store_true',
+                        help='write checkpoints on the training thread instead of in the background')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--num_workers', default=0, type=int)
     parser.add_argument('--cache_mode', default=False, action='store_true', help='whether to cache images on memory')
+    parser.add_argument('--reduced_decode', default=False, action='store_true',
+                        help='decode JPEG frames at the reduced DCT scale closest to the resize target')
+    parser.add_argument('--bucket_batches', default=False, action='store_true',
+                        help='batch training clips of similar post-resize size together to reduce padding')
+    parser.add_argument('--bucket_granularity', default=32, type=int,
+                        help='size rounding (pixels) used to form the buckets of --bucket_batches')
+    parser.add_argument('--window_size', default=0, type=int,
+                        help='if > 0, train tzb_multi from resident windows of this many consecutive frames')
+    parser.add_argument('--samples_per_window', default=8, type=int,
+                        help='training samples (key frames) drawn from each loaded window')
+    parser.add_argument('--open_windows', default=4, type=int,
+                        help='windows kept resident at once to shuffle samples across videos')
+    parser.add_argument('--prefetch_depth', default=2, type=int,
+                        help='number of batches the multi-frame prefetcher keeps ready when no device stream is available')
+    parser.add_argument('--online_eval', default=False, action='store_true',
+                        help='with --test, compute the per-video detection metrics of evaluator.py during inference')
+    parser.add_argument('--online_eval_iou', default=0.3, type=float,
+                        help='IoU threshold of the online evaluator')
+    parser.add_argument('--online_eval_file', default='detection_evaluation_results_online.json', type=str,
+                        help='result file of the online evaluator, relative to --output_dir')
+    parser.add_argument('--no_pred_export', default=False, action='store_true',
+                        help='with --test, do not write the per-image output_{id}.txt prediction files')
+    parser.add_argument('--val_every', default=0, type=int,
+                        help='if > 0, validate on a class-stratified subset of the val set every this many epochs')
+    parser.add_argument('--val_fraction', default=0.05, type=float,
+                        help='largest fraction of the val frames used by --val_every')
+    parser.add_argument('--val_time_budget', default=0.1, type=float,
+                        help='shrink the --val_every subset so validation takes at most this fraction of the '
+                             'training epoch time (0 keeps the subset fixed)')
+    parser.add_argument('--watch_checkpoints', default=False, action='store_true',
+                        help='evaluation daemon: evaluate every new checkpoint{epoch:04}.pth in --output_dir '
+                             'and append the results to eval_log.txt')
+    parser.add_argument('--watch_interval', default=60, type=float,
+                        help='seconds between two scans of --output_dir in --watch_checkpoints mode')
+    parser.add_argument('--test_score_threshold', default=0.1, type=float,
+                        help='with --test, minimum score of the exported predictions')
+    parser.add_argument('--output_cache_dir', default='', type=str,
+                        help='with --test, cache the raw model outputs (fp16) here, keyed by checkpoint and dataset config')
+    parser.add_argument('--from_cache', default=False, action='store_true',
+                        help='with --test and --output_cache_dir, only re-run post-processing and export on cached outputs')
 
     return parser
 
 
+def freeze_for_temporal_finetune(model):
+    """Train only the temporal and dynamic modules when fine-tuning TransVOD++ from a checkpoint."""
+    for name, param in model.named_parameters():
+        if ('temp' in name):
+            param.requires_grad = True
+        elif ('dynamic' in name):
+            param.requires_grad = True
+        else:
+            param.requires_grad = False
+
+
+def watch_checkpoints(args, model, criterion, postprocessors, data_loader_val, base_ds, device, evaluate,
+                      **engine_kwargs):
+    """Evaluate the per-epoch checkpoints of a training run as they appear.
+
+    Runs as a separate process (e.g. ``--device cuda:1`` or ``--device cpu``)
+    next to training with the same ``--output_dir``. The model and the val
+    loader are built once and reused; each checkpoint is only loaded into the
+    model. A checkpoint is picked up once it has its final name and its
+    size and mtime did not change between two scans, so files still being
+    written (in place, or under a temporary name before the atomic rename)
+    are skipped. Results are appended to ``eval_log.txt`` as one JSON line per
+    epoch; epochs already in the log are not evaluated again, so the daemon
+    can be restarted. It exits after the checkpoint of the last epoch.
+    """
+    output_dir = Path(args.output_dir)
+    log_path = output_dir / 'eval_log.txt'
+    done = set()
+    if log_path.exists():
+        with log_path.open() as f:
+            done = set(json.loads(line)['epoch'] for line in f if line.strip())
+    last_seen = {}
+
+    print('Watching {} for checkpoints, {} epochs already evaluated'.format(output_dir, len(done)))
+    while True:
+        for path in sorted(output_dir.glob('checkpoint[0-9][0-9][0-9][0-9].pth')):
+            epoch = int(path.stem[len('checkpoint'):])
+            if epoch in done:
+                continue
+            stat = path.stat()
+            signature = (stat.st_size, stat.st_mtime)
+            if last_seen.get(path) != signature:
+                # first sighting or still growing: check again on the next scan
+                last_seen[path] = signature
+                continue
+            try:
+                checkpoint = load_checkpoint(path)
+            except Exception as e:
+                print('Could not load {} yet: {}'.format(path, e))
+                last_seen.pop(path)
+                continue
+            model.load_state_dict(checkpoint['model'], strict=False)
+            del checkpoint
+
+            eval_kwargs = dict(engine_kwargs)
+            if args.dataset_file == 'tzb_multi':
+                from evaluator import StreamingDetectionEvaluator
+                eval_kwargs['online_evaluator'] = StreamingDetectionEvaluator({
+                    'iou_threshold': args.online_eval_iou,
+                    'consistency_iou_threshold': args.online_eval_iou,
+                    'class_names': TZB_CLASS_NAMES,
+                })
+            start = time.time()
+            test_stats, _ = evaluate(model, criterion, postprocessors, data_loader_val, base_ds, device,
+                                     args.output_dir, **eval_kwargs)
+            log_stats = {**{f'test_{k}': v for k, v in test_stats.items()},
+                         'epoch': epoch,
+                         'checkpoint': path.name,
+                         'eval_time': time.time() - start}
+            with log_path.open("a") as f:
+                f.write(json.dumps(log_stats) + "\n")
+            done.add(epoch)
+            print('Evaluated {} (epoch {})'.format(path.name, epoch))
+
+        if args.epochs - 1 in done:
+            return
+        time.sleep(args.watch_interval)
+
+
+def make_online_evaluator(args):
+    from evaluator import StreamingDetectionEvaluator
+    return StreamingDetectionEvaluator({
+        'gt_root': args.tzb_path,
+        'iou_threshold': args.online_eval_iou,
+        'consistency_iou_threshold': args.online_eval_iou,
+        'class_names': TZB_CLASS_NAMES,
+        'output_file': str(Path(args.output_dir) / args.online_eval_file),
+    })
+
+
+def make_output_cache(args):
+    """OutputCache of ``args.output_cache_dir`` keyed by the checkpoint file and the dataset config."""
+    from util.output_cache import OutputCache, output_cache_key
+    dataset_module = importlib.import_module('datasets.' + args.dataset_file)
+    cache_config = {
+        'dataset_file': args.dataset_file,
+        'tzb_path': args.tzb_path,
+        'vid_path': args.vid_path,
+        'num_ref_frames': args.num_ref_frames,
+        'interval1': args.interval1,
+        'interval2': args.interval2,
+        'reduced_decode': args.reduced_decode,
+        'resize_scales': getattr(dataset_module, 'RESIZE_SCALES', None),
+        'resize_max_size': getattr(dataset_module, 'RESIZE_MAX_SIZE', None),
+    }
+    return OutputCache(args.output_cache_dir, output_cache_key(args.resume, cache_config), cache_config)
+
+
+def run_test_from_cache(args, device):
+    """--test --from_cache: post-processing and export of cached outputs, without model or datasets."""
+    from engine_multi import test_from_cache
+    from models.deformable_detr_multi import PostProcess
+    assert args.output_cache_dir, '--from_cache needs --output_cache_dir'
+    output_cache = make_output_cache(args)
+    assert output_cache.complete, \
+        'no complete output cache for this checkpoint and dataset config, run --test with --output_cache_dir first'
+    if args.dataset_file == 'tzb_multi':
+        # only the val annotations, for the image_id -> video lookups of the online evaluator
+        from pycocotools.coco import COCO
+        from datasets.tzb_multi import get_paths
+        base_ds = COCO(str(get_paths(Path(args.tzb_path))['val'][0][1]))
+    else:
+        base_ds = get_coco_api_from_dataset(build_dataset(image_set='val', args=args))
+    online_evaluator = make_online_evaluator(args) if args.online_eval else None
+    test_from_cache({'bbox': PostProcess()}, output_cache, base_ds, device, args.output_dir, args.batch_size,
+                    online_evaluator=online_evaluator, export_predictions=not args.no_pred_export,
+                    score_threshold=args.test_score_threshold)
+
+
 def main(args):
     # for k, v in vars(args).items():
     #     print(f"{k}: {v}")
@@ -150,9 +360,11 @@ def main(args):
     if args.dataset_file == "tzb_single" or args.dataset_file == "vid_single":
         from engine_single import evaluate, train_one_epoch
         import util.misc as utils
+        engine_kwargs = {}
     else:
         from engine_multi import evaluate, train_one_epoch, test
         import util.misc_multi as utils
+        engine_kwargs = {'prefetch_depth': args.prefetch_depth}
         # from engine_multi_mm import evaluate, train_one_epoch
         # import util.misc_mm as utils
     print(args.dataset_file)
@@ -171,6 +383,15 @@ def main(args):
     np.random.seed(seed)
     random.seed(seed)
 
+    if args.autotune:
+        from autotune import autotune
+        autotune(args)
+        return
+
+    if args.test and args.from_cache:
+        run_test_from_cache(args, device)
+        return
+
     model, criterion, postprocessors = build_model(args)
     model.to(device)
 
@@ -193,15 +414,47 @@ def main(args):
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
 
-    batch_sampler_train = torch.utils.data.BatchSampler(
-        sampler_train, args.batch_size, drop_last=True)
-
-    data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
-                                   collate_fn=utils.collate_fn, num_workers=args.num_workers,
-                                   pin_memory=True)
+    if args.window_size > 0:
+        assert args.dataset_file == 'tzb_multi', 'window loading is only implemented for tzb_multi'
+        from datasets.tzb_multi import WindowClipDataset
+        dataset_train_windows = WindowClipDataset(dataset_train, args.window_size, args.samples_per_window,
+                                                  args.open_windows, rank=utils.get_rank(),
+                                                  world_size=utils.get_world_size(), seed=args.seed)
+        data_loader_train = DataLoader(dataset_train_windows, args.batch_size, drop_last=True,
+                                       collate_fn=utils.collate_fn, num_workers=args.num_workers,
+                                       pin_memory=True)
+    else:
+        if args.bucket_batches:
+            assert hasattr(dataset_train, 'get_resized_size'), \
+                '--bucket_batches needs a dataset that provides get_resized_size (tzb_multi, vid_multi), ' \
+                'not {}'.format(args.dataset_file)
+            assert args.batch_size > 1, '--bucket_batches only changes batching with --batch_size > 1'
+            bucket_ids = samplers.compute_bucket_ids(dataset_train, args.bucket_granularity)
+            print('number of size buckets:', len(set(bucket_ids)))
+            batch_sampler_train = samplers.BucketBatchSampler(
+                sampler_train, bucket_ids, args.batch_size, drop_last=True)
+        else:
+            batch_sampler_train = torch.utils.data.BatchSampler(
+                sampler_train, args.batch_size, drop_last=True)
+        data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
+                                       collate_fn=utils.collate_fn, num_workers=args.num_workers,
+                                       pin_memory=True)
     data_loader_val = DataLoader(dataset_val, args.batch_size, sampler=sampler_val,
                                  drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers,
                                  pin_memory=True)
+    if args.val_every > 0:
+        # fixed, class-stratified frame order; the periodic validation runs on a prefix of it
+        # and keeps its loader workers alive between validations
+        val_order = samplers.stratified_order(dataset_val, seed=args.seed)
+        max_val_samples = max(int(math.ceil(args.val_fraction * len(val_order))), 1)
+        sampler_val_subset = samplers.SubsetSampler(val_order, max_val_samples,
+                                                    num_replicas=utils.get_world_size(), rank=utils.get_rank())
+        data_loader_val_subset = DataLoader(dataset_val, args.batch_size, sampler=sampler_val_subset,
+                                            drop_last=False, collate_fn=utils.collate_fn,
+                                            num_workers=args.num_workers, pin_memory=True,
+                                            persistent_workers=args.num_workers > 0)
+        print('periodic validation on {} of {} val frames every {} epochs'.format(
+            max_val_samples, len(val_order), args.val_every))
 
     # lr_backbone_names = ["backbone.0", "backbone.neck", "input_proj", "transformer.encoder"]
     def match_name_keywords(n, name_keywords):
@@ -215,6 +468,12 @@ def main(args):
     for n, p in model_without_ddp.named_parameters():
         print(n)
 
+    if args.resume and not args.eval and not args.coco_pretrain:
+        # fix the trainable set before building the optimizer and DDP,
+        # so both only cover the parameters that get gradients
+        freeze_for_temporal_finetune(model_without_ddp)
+        print('trainable params:', sum(p.numel() for p in model_without_ddp.parameters() if p.requires_grad))
+
     param_dicts = [
         {
             "params":
@@ -231,18 +490,36 @@ def main(args):
             "lr": args.lr * args.lr_linear_proj_mult,
         }
     ]
+    optimizer_class = torch.optim.SGD if args.sgd else torch.optim.AdamW
+    optimizer_kwargs = {}
+    if args.fused_optimizer:
+        optimizer_params = inspect.signature(optimizer_class).parameters
+        if 'fused' in optimizer_params and device.type == 'cuda':
+            optimizer_kwargs['fused'] = True
+        elif 'foreach' in optimizer_params:
+            optimizer_kwargs['foreach'] = True
     if args.sgd:
         optimizer = torch.optim.SGD(param_dicts, lr=args.lr, momentum=0.9,
-                                    weight_decay=args.weight_decay)
+                                    weight_decay=args.weight_decay, **optimizer_kwargs)
     else:
         optimizer = torch.optim.AdamW(param_dicts, lr=args.lr,
-                                      weight_decay=args.weight_decay)
+                                      weight_decay=args.weight_decay, **optimizer_kwargs)
     print(args.lr_drop_epochs)
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, args.lr_drop_epochs)
 
+    comm_timer = None
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
+        ddp_kwargs = {'bucket_cap_mb': args.ddp_bucket_cap_mb}
+        if args.ddp_static_graph:
+            ddp_kwargs['static_graph'] = True
+        else:
+            ddp_kwargs['find_unused_parameters'] = True
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], **ddp_kwargs)
         model_without_ddp = model.module
+        if args.ddp_comm_timing:
+            from util.ddp import CommTimer, timed_allreduce_hook
+            comm_timer = CommTimer(device)
+            model.register_comm_hook(comm_timer, timed_allreduce_hook)
 
     if args.dataset_file == "coco_panoptic":
         # We also evaluate AP during panoptic training, on original coco DS
@@ -252,7 +529,7 @@ def main(args):
         base_ds = get_coco_api_from_dataset(dataset_val)
 
     if args.frozen_weights is not None:
-        checkpoint = torch.load(args.frozen_weights, map_location='cpu')
+        checkpoint = load_checkpoint(args.frozen_weights)
         model_without_ddp.detr.load_state_dict(checkpoint['model'])
 
     output_dir = Path(args.output_dir)
@@ -261,7 +538,7 @@ def main(args):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.resume, map_location='cpu', check_hash=True)
         else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
+            checkpoint = load_checkpoint(args.resume)
 
         if args.eval:
             missing_keys, unexpected_keys = model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
@@ -292,15 +569,8 @@ def main(args):
                         print(f"Adjusted weight shape for single channel: {averaged_weight.shape}")
                 # --- 插入单通道预训练权重处理逻辑 END ---
             else:
-                # multi-frame (TransVOD++)
+                # multi-frame (TransVOD++), trainable set fixed by freeze_for_temporal_finetune
                 tmp_dict = checkpoint['model']
-                for name, param in model_without_ddp.named_parameters():
-                    if ('temp' in name):
-                        param.requires_grad = True
-                    elif ('dynamic' in name):
-                        param.requires_grad = True
-                    else:
-                        param.requires_grad = False
 
             missing_keys, unexpected_keys = model_without_ddp.load_state_dict(tmp_dict, strict=False)
 
@@ -310,40 +580,67 @@ def main(args):
         if len(unexpected_keys) > 0:
             print('Unexpected Keys: {}'.format(unexpected_keys))
 
+    if args.watch_checkpoints:
+        watch_checkpoints(args, model_without_ddp, criterion, postprocessors, data_loader_val, base_ds, device,
+                          evaluate, **engine_kwargs)
+        return
+
     if args.test:
-        test(model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir)
+        online_evaluator = make_online_evaluator(args) if args.online_eval else None
+        output_cache = make_output_cache(args) if args.output_cache_dir else None
+        test(model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir,
+             online_evaluator=online_evaluator, export_predictions=not args.no_pred_export,
+             output_cache=output_cache, score_threshold=args.test_score_threshold, **engine_kwargs)
         return 
 
     if args.eval:
         test_stats, coco_evaluator = evaluate(model, criterion, postprocessors,
-                                              data_loader_val, base_ds, device, args.output_dir)
+                                              data_loader_val, base_ds, device, args.output_dir, **engine_kwargs)
         if args.output_dir:
             utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
         return
 
+    checkpoint_writer = None
+    if args.output_dir:
+        checkpoint_writer = CheckpointWriter(args.output_dir, keep_last=args.ckpt_keep_last,
+                                             keep_every=args.ckpt_keep_every, async_write=not args.ckpt_sync)
+
+    train_kwargs = dict(engine_kwargs)
+    if comm_timer is not None:
+        train_kwargs['comm_timer'] = comm_timer
+    if args.deferred_metrics:
+        train_kwargs['deferred_metrics'] = True
+    if args.profile_stages:
+        from util import stage_profiler
+        trace_file = None
+        if args.profile_trace_steps > 0 and args.output_dir:
+            trace_file = str(output_dir / 'stage_trace.json')
+        train_kwargs['stage_profiler'] = stage_profiler.StageProfiler(
+            device, trace_file, args.profile_trace_start, args.profile_trace_steps)
+
     print("Start training")
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if args.window_size > 0:
+            dataset_train_windows.set_epoch(epoch)
+        elif args.distributed:
             sampler_train.set_epoch(epoch)
+        epoch_start = time.time()
         train_stats = train_one_epoch(
-            model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm)
+            model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, **train_kwargs)
+        train_time = time.time() - epoch_start
         lr_scheduler.step()
         print('args.output_dir', args.output_dir)
         if args.output_dir:
-            checkpoint_paths = [output_dir / 'checkpoint.pth']
             # extra checkpoint before LR drop and every 5 epochs
             # if (epoch + 1) % args.lr_drop == 0 or (epoch + 1) % 1 == 0:
-            if (epoch + 1) % 1 == 0:
-                checkpoint_paths.append(output_dir / f'checkpoint{epoch:04}.pth')
-            for checkpoint_path in checkpoint_paths:
-                utils.save_on_master({
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'epoch': epoch,
-                    'args': args,
-                }, checkpoint_path)
+            checkpoint_writer.save({
+                'model': model_without_ddp.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'args': args,
+            }, epoch, per_epoch=(epoch + 1) % 1 == 0)
 
         #test_stats, coco_evaluator = evaluate(
          #   model, criterion, postprocessors, data_loader_val, base_ds, device, args.output_dir
@@ -353,11 +650,35 @@ def main(args):
                      'epoch': epoch,
                      'n_parameters': n_parameters}
 
+        if args.val_every > 0 and (epoch + 1) % args.val_every == 0:
+            val_kwargs = dict(engine_kwargs)
+            if args.dataset_file == 'tzb_multi':
+                from evaluator import StreamingDetectionEvaluator
+                val_kwargs['online_evaluator'] = StreamingDetectionEvaluator({
+                    'iou_threshold': args.online_eval_iou,
+                    'consistency_iou_threshold': args.online_eval_iou,
+                    'class_names': TZB_CLASS_NAMES,
+                })
+            val_start = time.time()
+            val_stats, _ = evaluate(model, criterion, postprocessors, data_loader_val_subset, base_ds,
+                                    device, args.output_dir, **val_kwargs)
+            val_time = time.time() - val_start
+            log_stats.update({f'val_{k}': v for k, v in val_stats.items()})
+            log_stats.update(val_frames=sampler_val_subset.num_samples, val_time=val_time)
+
+            if args.val_time_budget > 0 and val_time > 0:
+                # resize the subset for the next validation to fit the time budget
+                scale = args.val_time_budget * train_time * args.val_every / val_time
+                sampler_val_subset.set_num_samples(
+                    min(sampler_val_subset.num_samples * scale, max_val_samples))
+
         if args.output_dir and utils.is_main_process():
             with (output_dir / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
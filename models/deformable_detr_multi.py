@@ -17,6 +17,7 @@ from torch import nn
 import math
 
 from util import box_ops
+from util import stage_profiler
 from util.misc_multi import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate,
                        is_dist_avail_and_initialized, inverse_sigmoid)
@@ -148,9 +149,12 @@ class DeformableDETR(nn.Module):
 
         # backbones: swin_transformer.py class Joiner:forward()
         # features: type list; len 1; features[0].tensors.shape torch.Size([15, 256, 75, 75])
+        stage_profiler.range_push('backbone')
         features, pos = self.backbone(samples)
+        stage_profiler.range_pop()
         # print('features[-1].tensors.shape', features[-1].tensors.shape)
 
+        stage_profiler.range_push('input_proj')
         srcs = []
         masks = []
         for l, feat in enumerate(features):
@@ -172,13 +176,16 @@ class DeformableDETR(nn.Module):
                 srcs.append(src)
                 masks.append(mask)
                 pos.append(pos_l)
+        stage_profiler.range_pop()
 
         query_embeds = None
         if not self.two_stage:
             query_embeds = self.query_embed.weight
         
         # call DeformableTransformer.forward() in deformable_transformer_multi.py
+        stage_profiler.range_push('transformer')
         hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact, final_hs, final_references_out, out = self.transformer(srcs, masks, pos, imgs_whwh_shape, query_embeds, self.class_embed[-1], self.bbox_embed[-1], self.temp_class_embed_list, self.temp_bbox_embed_list)
+        stage_profiler.range_pop()
         
 
         outputs_classes = []
@@ -355,7 +362,9 @@ class SetCriterion(nn.Module):
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs' and k != 'enc_outputs'}
 
         # Retrieve the matching between the outputs of the last layer and the targets
+        stage_profiler.range_push('matcher')
         indices = self.matcher(outputs_without_aux, targets)
+        stage_profiler.range_pop()
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
         num_boxes = sum(len(t["labels"]) for t in targets)
@@ -373,7 +382,9 @@ class SetCriterion(nn.Module):
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
+                stage_profiler.range_push('matcher')
                 indices = self.matcher(aux_outputs, targets)
+                stage_profiler.range_pop()
                 for loss in self.losses:
                     if loss == 'masks':
                         # Intermediate masks losses are too costly to compute, we ignore them.
@@ -391,7 +402,9 @@ class SetCriterion(nn.Module):
             bin_targets = copy.deepcopy(targets)
             for bt in bin_targets:
                 bt['labels'] = torch.zeros_like(bt['labels'])
+            stage_profiler.range_push('matcher')
             indices = self.matcher(enc_outputs, bin_targets)
+            stage_profiler.range_pop()
             for loss in self.losses:
                 if loss == 'masks':
                     # Intermediate masks losses are too costly to compute, we ignore them.
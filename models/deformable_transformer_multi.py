@@ -21,6 +21,7 @@ from util.misc import inverse_sigmoid
 from models.ops.modules import MSDeformAttn
 from mmcv import ops
 from util import box_ops
+from util import stage_profiler
 
 from mmdet.core import bbox2result, bbox2roi, bbox_xyxy_to_cxcywh
 from mmdet.core.bbox.samplers import PseudoSampler
@@ -228,7 +229,9 @@ class DeformableTransformer(nn.Module):
         # encoder
         # call DeformableTransformerEncoder.forward() in deformable_transformer_multi.py
         # memory torch.Size([15, 5625, 256])
+        stage_profiler.range_push('encoder')
         memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        stage_profiler.range_pop()
 
         # prepare input for decoder:
         bs, _, c = memory.shape
@@ -262,8 +265,10 @@ class DeformableTransformer(nn.Module):
             inter_references are intermediate reference points, will induct the cross attention in the next decoder layer or output as the central points of the predicted bbox
             inter_references.shape: torch.Size([6, 15, 100, 4]) -> [decoder_layer_nums, batch_size, num_queries, coordinate(x,y,w,h)]
         '''
+        stage_profiler.range_push('decoder')
         hs, inter_references = self.decoder(tgt, reference_points, memory,
                                             spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten)
+        stage_profiler.range_pop()
 
         inter_references_out = inter_references
         if self.two_stage:
@@ -277,6 +282,7 @@ class DeformableTransformer(nn.Module):
             
         self.TDAM = True
         if self.TDAM:
+            stage_profiler.range_push('tdam_roi_fusion')
             # memory
             memory_list = torch.chunk(memory, self.num_ref_frames+1,  dim=0)
             cur_memory = memory_list[0]
@@ -400,6 +406,9 @@ class DeformableTransformer(nn.Module):
                 ref_hs_concat = torch.cat((ref_hs_concat, ref_hs_each), dim=1)
             
 
+            stage_profiler.range_pop()
+
+            stage_profiler.range_push('temporal_decoders')
             topk_values, topk_indexes = torch.topk(ref_prob_concat.view(ref_hs_logits_concat.shape[0], -1), 80 * self.num_ref_frames, dim=1)
             topk_indexes = topk_indexes // ref_hs_logits_concat.shape[2]
             ref_hs_input1 = torch.gather(ref_hs_concat, 1, topk_indexes.unsqueeze(-1).repeat(1,1,ref_hs_concat.shape[-1]))
@@ -453,6 +462,7 @@ class DeformableTransformer(nn.Module):
                                             spatial_shapes[0:1], level_start_index[0:1], valid_ratios[0:1], None, None)
             # print("final_hs", final_hs.shape)
             # print("final_references", final_references_out.shape)
+            stage_profiler.range_pop()
             return hs[:,0:1,:,:], init_reference_out[0:1], inter_references_out[:,0:1,:,:], None, None, final_hs, final_references_out, out
 
             
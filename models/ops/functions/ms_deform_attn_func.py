@@ -15,7 +15,11 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 
-import MultiScaleDeformableAttention as MSDA
+try:
+    import MultiScaleDeformableAttention as MSDA
+except ImportError:
+    # CUDA extension not built (e.g. CPU-only machines), see MSDeformAttn.forward
+    MSDA = None
 
 
 class MSDeformAttnFunction(Function):
@@ -18,6 +18,7 @@ from torch import nn
 from torchvision.models._utils import IntermediateLayerGetter
 from typing import Dict, List
 from util.misc import NestedTensor, is_main_process
+from util import stage_profiler
 import torch.utils.checkpoint as checkpoint
 import numpy as np
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -701,6 +702,8 @@ class SwinTransformer(nn.Module):
         x_wavelet = x
         # wavelet transform to shape [15,128,150,150] 
 
+        stage_profiler.range_push('swin')
+
         # x_wavelet = self.wave_input_conv(x_wavelet)  # [15, 128, 150, 150]
 
         # after patch embedding, x is of shape [15(BS), 128(vector dim), 150(H), 150(W)]
@@ -727,16 +730,18 @@ class SwinTransformer(nn.Module):
                 out = x_out.view(-1, H, W, self.num_features[i]).permute(0, 3, 1, 2).contiguous()
                 outs.append(out)
         # outs: layer 1 is torch.Size([15, 256, 75, 75]), layer 2 is torch.Size([15, 512, 38, 38]), layer 3 is torch.Size([15, 1024, 19, 19])
+        stage_profiler.range_pop()
         
         # import ipdb; ipdb.set_trace()
         # wavelet forward
+        stage_profiler.range_push('wavelet')
         feat1, feat2, feat3 = self.wavelet_branch(x_wavelet) 
         # prune feat from wavelet branch to match the output size of swin transformer
-        feat1 = F.interpolate(feat1, size=(75, 75), mode='bilinear', align_corners=None)  # [15, 256, 75, 75]
-        feat2 = F.interpolate(feat2, size=(38, 38), mode='bilinear', align_corners=None)  # [15, 512, 38, 38]
-        feat3 = F.interpolate (feat3, size=(19, 19), mode='bilinear', align_corners=None)  # [15, 1024, 19, 19]
+        feat1 = F.interpolate(feat1, size=outs[0].shape[-2:], mode='bilinear', align_corners=None)  # [15, 256, 75, 75]
+        feat2 = F.interpolate(feat2, size=outs[1].shape[-2:], mode='bilinear', align_corners=None)  # [15, 512, 38, 38]
+        feat3 = F.interpolate (feat3, size=outs[2].shape[-2:], mode='bilinear', align_corners=None)  # [15, 1024, 19, 19]
+        stage_profiler.range_pop()
         
-        import ipdb; ipdb.set_trace()
         # fuse features from swin transformer and wavelet branch
         # TODO: try more effective fusion methods
         outs[0] = outs[0] + feat1
@@ -744,6 +749,7 @@ class SwinTransformer(nn.Module):
         outs[2] = outs[2] + feat3
 
         # Modified swin-based backbone via feature aggregation
+        stage_profiler.range_push('fpn_aggregation')
         rets = {str(u): v for (u,v) in enumerate(outs)}
         feat_fpn = self.fpn(rets)        
         bs, dim, size_h, size_w = feat_fpn['0'].shape
@@ -754,6 +760,7 @@ class SwinTransformer(nn.Module):
                 feat = F.interpolate(feat_fpn[k], size=(size_h, size_w), scale_factor=None, mode='bilinear', align_corners=None)
                 feat_aggregate = feat_aggregate + feat
         outs_agg.append(feat_aggregate) # torch.Size([1, 1024, 7, 9]
+        stage_profiler.range_pop()
 
         rets_agg = {str(u): v for (u,v) in enumerate(outs_agg)}
 
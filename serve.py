@@ -0,0 +1,420 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Long-running local inference server.
+
+The model is built and loaded once (--resume) and frames are posted per
+stream over HTTP, on --host/--port or on a Unix socket (--unix_socket):
+
+    POST   /streams/{stream_id}/frames   body: encoded image (JPEG, PNG, ...)
+    DELETE /streams/{stream_id}          drop the stream's reference frames
+    GET    /metrics                      queue depth, batch sizes, latencies
+    GET    /health
+
+Every stream keeps a ring buffer of its last preprocessed frames; the
+multi-frame model gets the posted frame as key frame and up to
+--num_ref_frames past frames (every --ref_stride-th) as references, the key
+frame being repeated while the buffer fills up. Pending frames of all
+streams go to one batcher thread. For the single-frame model it runs a
+batch, in one forward, as soon as it has --max_batch_size frames or the
+oldest frame waited --max_latency_ms. The multi-frame model fuses exactly
+one clip per forward (TDAM), so waiting for a batch would only add latency:
+its frames run one at a time, in arrival order, without a fill wait.
+At most --max_queue frames wait (more are refused with 503), and frames
+whose client already got a 504 are dropped instead of run.
+
+A frame's response is JSON with its YOLO-style lines, the same
+``class cx cy w h score`` lines test writes to output_{image_id}.txt.
+See serve_client.py for an end-to-end client.
+
+Unknown arguments are passed to the main.py parser, e.g. --dataset_file.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as F
+from PIL import Image
+
+from datasets.transforms_multi import get_size_with_aspect_ratio
+from datasets.tzb_multi import RESIZE_SCALES, RESIZE_MAX_SIZE
+from engine_multi import yolo_lines
+from main import get_args_parser as get_main_args_parser
+from models import build_model
+from util import misc, misc_multi
+from util.checkpoint import load_checkpoint
+
+MULTI_DATASETS = ('tzb_multi', 'vid_multi')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Serve the detector over a local HTTP or Unix-socket API.')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str, help='listen on this socket path instead')
+    parser.add_argument('--max_batch_size', default=8, type=int, help='frames per batch')
+    parser.add_argument('--max_latency_ms', default=20.0, type=float,
+                        help='longest time a frame waits for its batch to fill')
+    parser.add_argument('--ref_stride', default=1, type=int, help='frames between reference frames')
+    parser.add_argument('--request_timeout', default=30.0, type=float, help='seconds before a frame fails')
+    parser.add_argument('--max_queue', default=64, type=int, help='waiting frames before new ones are refused')
+    parser.add_argument('--latency_window', default=1000, type=int, help='frames the latency metrics cover')
+    return parser
+
+
+def preprocess(data):
+    """Encoded image -> normalized [H, W] tensor and its original (h, w), as the val transforms do."""
+    img = Image.open(io.BytesIO(data)).convert('L')
+    w, h = img.size
+    img = F.resize(img, get_size_with_aspect_ratio(img.size, max(RESIZE_SCALES), RESIZE_MAX_SIZE))
+    frame = F.normalize(F.to_tensor(img), [0.5], [0.5])
+    return frame[0], (h, w)
+
+
+class Stream(object):
+    """Ring buffer of a stream's last preprocessed frames."""
+
+    def __init__(self, num_ref_frames, ref_stride):
+        self.num_ref_frames = num_ref_frames
+        self.ref_stride = ref_stride
+        self.frames = deque(maxlen=max(num_ref_frames * ref_stride, 1))
+        self.next_frame_id = 0
+        self.lock = threading.Lock()
+
+    def add(self, frame):
+        """Frame id and clip ``[key] + refs`` of ``frame``; ``frame`` becomes a reference of later frames."""
+        with self.lock:
+            past = list(self.frames)[::-1][self.ref_stride - 1::self.ref_stride]
+            refs = [f for f in past if f.shape == frame.shape][:self.num_ref_frames]
+            refs += [frame] * (self.num_ref_frames - len(refs))
+            self.frames.append(frame)
+            frame_id = self.next_frame_id
+            self.next_frame_id += 1
+        return frame_id, torch.stack([frame] + refs)
+
+
+class Request(object):
+
+    def __init__(self, stream_id, frame_id, clip, orig_size, timeout):
+        self.stream_id = stream_id
+        self.frame_id = frame_id
+        self.clip = clip
+        self.orig_size = orig_size
+        self.submitted = time.perf_counter()
+        self.expires = self.submitted + timeout
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Metrics(object):
+    """Counters and a sliding window of per-frame latencies."""
+
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.errors = 0
+        self.rejected = 0
+        self.expired = 0
+        self.batches = 0
+        self.batch_sizes = {}
+        self.queue_wait = deque(maxlen=window)
+        self.inference = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+
+    def update(self, batch):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for r in batch:
+                self.frames += 1
+                self.errors += r.error is not None
+                self.queue_wait.append(r.started - r.submitted)
+                self.inference.append(r.finished - r.started)
+                self.total.append(r.finished - r.submitted)
+
+    def count(self, field, n=1):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    @staticmethod
+    def percentiles(values):
+        if not values:
+            return None
+        ts = np.asarray(values) * 1000
+        return {'mean': ts.mean(), 'p50': np.percentile(ts, 50), 'p90': np.percentile(ts, 90),
+                'p99': np.percentile(ts, 99), 'max': ts.max()}
+
+    def summary(self):
+        with self.lock:
+            return {
+                'frames': self.frames,
+                'errors': self.errors,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'batches': self.batches,
+                'mean_batch_size': self.frames / self.batches if self.batches else None,
+                'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'latency_ms': {'queue_wait': self.percentiles(self.queue_wait),
+                               'inference': self.percentiles(self.inference),
+                               'total': self.percentiles(self.total)},
+            }
+
+
+class Detector(object):
+    """Model, post-processing and the forward of one batch of requests."""
+
+    def __init__(self, args, device):
+        self.device = device
+        self.multi = args.dataset_file in MULTI_DATASETS
+        self.score_threshold = args.test_score_threshold
+        args.pretrained = None
+        model, _, postprocessors = build_model(args)
+        if args.resume:
+            model.load_state_dict(load_checkpoint(args.resume)['model'], strict=False)
+        model.to(device)
+        model.eval()
+        self.model = model
+        self.postprocess = postprocessors['bbox']
+
+    @torch.no_grad()
+    def __call__(self, batch):
+        if self.multi:
+            # TDAM fuses the frames of exactly one clip per forward
+            outputs = [self.model(misc_multi.nested_tensor_from_tensor_list([r.clip.to(self.device)]))
+                       for r in batch]
+            results = [self.postprocess(out, self.target_sizes([r]))[0] for out, r in zip(outputs, batch)]
+        else:
+            samples = misc.nested_tensor_from_tensor_list([r.clip[:1].to(self.device) for r in batch])
+            results = self.postprocess(self.model(samples), self.target_sizes(batch))
+        return [yolo_lines(result, self.score_threshold) for result in results]
+
+    def target_sizes(self, batch):
+        return torch.tensor([r.orig_size for r in batch], device=self.device)
+
+
+class Batcher(threading.Thread):
+    """Collects pending requests of all streams into batches for ``detector``."""
+
+    def __init__(self, detector, metrics, max_batch_size, max_latency_ms, max_queue):
+        super().__init__(daemon=True)
+        self.detector = detector
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_queue = max_queue
+        self.pending = deque()
+        self.cond = threading.Condition()
+
+    def submit(self, request):
+        """Queue ``request``; False if the queue is full."""
+        with self.cond:
+            if len(self.pending) >= self.max_queue:
+                return False
+            self.pending.append(request)
+            self.cond.notify()
+            return True
+
+    def _drop_expired(self):
+        # the clients of these requests already got a 504
+        now = time.perf_counter()
+        live = deque(r for r in self.pending if r.expires > now)
+        expired = len(self.pending) - len(live)
+        if expired:
+            self.pending = live
+            self.metrics.count('expired', expired)
+
+    def queue_depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def next_batch(self):
+        with self.cond:
+            self._drop_expired()
+            while not self.pending:
+                self.cond.wait()
+                self._drop_expired()
+            deadline = self.pending[0].submitted + self.max_latency
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            self._drop_expired()
+            return [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch_size))]
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                results = self.detector(batch)
+            except Exception as e:
+                results = [None] * len(batch)
+                for r in batch:
+                    r.error = '{}: {}'.format(type(e).__name__, e)
+            finished = time.perf_counter()
+            for r, result in zip(batch, results):
+                r.started, r.finished, r.result = started, finished, result
+            self.metrics.update(batch)
+            for r in batch:
+                r.done.set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    frames_path = re.compile(r'^/streams/([^/]+)/frames/?$')
+    stream_path = re.compile(r'^/streams/([^/]+)/?$')
+
+    def log_message(self, format, *args):
+        # client_address is empty on Unix sockets; request lines would flood the log anyway
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics_summary())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        match = self.frames_path.match(self.path)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if match is None:
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            status, payload = self.server.service.infer(match.group(1), data)
+        except Exception as e:
+            status, payload = 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+        self.send_json(status, payload)
+
+    def do_DELETE(self):
+        match = self.stream_path.match(self.path)
+        if match is None:
+            self.send_json(404, {'error': 'not found'})
+            return
+        removed = self.server.service.drop_stream(match.group(1))
+        self.send_json(200 if removed else 404, {'stream': match.group(1), 'removed': removed})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceService(object):
+    """Streams, batcher and metrics behind the HTTP handler."""
+
+    def __init__(self, detector, args):
+        self.num_ref_frames = args.num_ref_frames if detector.multi else 0
+        self.ref_stride = args.ref_stride
+        self.request_timeout = args.request_timeout
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        self.metrics = Metrics(args.latency_window)
+        # one clip per forward for the multi-frame model: no point waiting for a batch to fill
+        max_batch_size = 1 if detector.multi else args.max_batch_size
+        self.batcher = Batcher(detector, self.metrics, max_batch_size, args.max_latency_ms, args.max_queue)
+        self.batcher.start()
+
+    def stream(self, stream_id):
+        with self.streams_lock:
+            if stream_id not in self.streams:
+                self.streams[stream_id] = Stream(self.num_ref_frames, self.ref_stride)
+            return self.streams[stream_id]
+
+    def drop_stream(self, stream_id):
+        with self.streams_lock:
+            return self.streams.pop(stream_id, None) is not None
+
+    def infer(self, stream_id, data):
+        # decoding runs in the connection's thread, in parallel with the batcher
+        frame, orig_size = preprocess(data)
+        frame_id, clip = self.stream(stream_id).add(frame)
+        request = Request(stream_id, frame_id, clip, orig_size, self.request_timeout)
+        if not self.batcher.submit(request):
+            self.metrics.count('rejected')
+            return 503, {'stream': stream_id, 'frame_id': frame_id, 'error': 'queue full'}
+        if not request.done.wait(self.request_timeout):
+            return 504, {'stream': stream_id, 'frame_id': frame_id, 'error': 'timed out'}
+        if request.error is not None:
+            return 500, {'stream': stream_id, 'frame_id': frame_id, 'error': request.error}
+        return 200, {
+            'stream': stream_id,
+            'frame_id': frame_id,
+            'detections': request.result,
+            'latency_ms': {'queue_wait': (request.started - request.submitted) * 1000,
+                           'inference': (request.finished - request.started) * 1000,
+                           'total': (request.finished - request.submitted) * 1000},
+        }
+
+    def metrics_summary(self):
+        summary = self.metrics.summary()
+        summary['queue_depth'] = self.batcher.queue_depth()
+        with self.streams_lock:
+            summary['streams'] = {k: s.next_frame_id for k, s in self.streams.items()}
+        return summary
+
+
+def make_server(service, args):
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, Handler)
+        address = args.unix_socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        address = 'http://{}:{}'.format(*server.server_address[:2])
+    server.service = service
+    return server, address
+
+
+def main():
+    args, rest = get_args_parser().parse_known_args()
+    main_args = get_main_args_parser().parse_args(rest)
+    assert args.max_batch_size > 0 and args.ref_stride > 0 and args.max_queue > 0
+    for k, v in vars(args).items():
+        setattr(main_args, k, v)
+
+    detector = Detector(main_args, torch.device(main_args.device))
+    service = InferenceService(detector, main_args)
+    server, address = make_server(service, args)
+    print('Serving {} on {}'.format(main_args.dataset_file, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+End-to-end client of serve.py.
+
+Posts the frames of --streams streams concurrently (one thread per stream,
+frames in order) to the server and prints the per-stream detections,
+client-side latency percentiles and the server's /metrics. Frames are the
+sorted images of --image_dir, or synthetic frames (see synthetic_tzb.py)
+when it is omitted; with --output_dir the YOLO-style lines of every frame
+are written to {output_dir}/{stream}/output_{frame_id}.txt.
+
+    python serve.py --dataset_file tzb_multi --resume ckpt.pth &
+    python serve_client.py --streams 4 --frames 50
+"""
+import argparse
+import glob
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from synthetic_tzb import make_background, make_tracks
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Post frames to serve.py and report latencies.')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str, help='connect to this socket path instead')
+    parser.add_argument('--streams', default=2, type=int)
+    parser.add_argument('--frames', default=20, type=int, help='frames per stream')
+    parser.add_argument('--image_dir', default=None, type=str, help='frames to post; synthetic when omitted')
+    parser.add_argument('--resolution', default=(640, 512), type=int, nargs=2, help='synthetic frame W H')
+    parser.add_argument('--output_dir', default=None, type=str, help='write the YOLO-style lines per stream')
+    parser.add_argument('--timeout', default=60.0, type=float)
+    return parser
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket, args.timeout)
+    return http.client.HTTPConnection(args.host, args.port, timeout=args.timeout)
+
+
+def request(conn, method, path, body=None):
+    conn.request(method, path, body=body)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def synthetic_frames(num_frames, width, height, seed):
+    """JPEG bytes of a synthetic video."""
+    rng = np.random.RandomState(seed)
+    background = make_background(width, height, rng)
+    tracks = make_tracks(num_frames, width, height, 4, rng)
+    frames = []
+    for i in range(num_frames):
+        frame = background + rng.normal(0, 6, size=background.shape)
+        for _, boxes in tracks:
+            x, y, w, h = boxes[i]
+            frame[int(y):int(y) + int(h), int(x):int(x) + int(w)] += 90
+        buf = io.BytesIO()
+        Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8), mode='L').save(buf, format='JPEG')
+        frames.append(buf.getvalue())
+    return frames
+
+
+def directory_frames(image_dir, num_frames):
+    paths = sorted(p for p in glob.glob(os.path.join(image_dir, '*'))
+                   if p.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')))
+    assert paths, 'no images in {}'.format(image_dir)
+    frames = []
+    for i in range(num_frames):
+        with open(paths[i % len(paths)], 'rb') as f:
+            frames.append(f.read())
+    return frames
+
+
+def run_stream(args, stream_id, frames, results):
+    conn = connect(args)
+    latencies, responses = [], []
+    try:
+        for data in frames:
+            start = time.perf_counter()
+            status, payload = request(conn, 'POST', '/streams/{}/frames'.format(stream_id), data)
+            latencies.append(time.perf_counter() - start)
+            payload['status'] = status
+            responses.append(payload)
+        request(conn, 'DELETE', '/streams/{}'.format(stream_id))
+    finally:
+        conn.close()
+    results[stream_id] = (latencies, responses)
+
+
+def main():
+    args = get_args_parser().parse_args()
+    results = {}
+    threads = []
+    for k in range(args.streams):
+        if args.image_dir:
+            frames = directory_frames(args.image_dir, args.frames)
+        else:
+            frames = synthetic_frames(args.frames, *args.resolution, seed=k)
+        threads.append(threading.Thread(target=run_stream, args=(args, 'stream{}'.format(k), frames, results)))
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = []
+    for stream_id, (latencies, responses) in sorted(results.items()):
+        all_latencies += latencies
+        failed = [r for r in responses if r['status'] != 200]
+        num_dets = sum(len(r.get('detections', [])) for r in responses)
+        print('{}: {} frames, {} failed, {} detections'.format(stream_id, len(responses), len(failed), num_dets))
+        for r in failed[:3]:
+            print('  frame {}: {}'.format(r.get('frame_id'), r.get('error')))
+        if args.output_dir:
+            stream_dir = os.path.join(args.output_dir, stream_id)
+            os.makedirs(stream_dir, exist_ok=True)
+            for r in responses:
+                if r['status'] == 200:
+                    with open(os.path.join(stream_dir, 'output_{}.txt'.format(r['frame_id'])), 'w') as f:
+                        f.writelines(line + '\n' for line in r['detections'])
+
+    if all_latencies:
+        ts = np.asarray(all_latencies) * 1000
+        print('client latency: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms; {:.1f} frames/s'.format(
+            np.percentile(ts, 50), np.percentile(ts, 90), np.percentile(ts, 99), len(ts) / elapsed))
+    conn = connect(args)
+    try:
+        _, metrics = request(conn, 'GET', '/metrics')
+    finally:
+        conn.close()
+    print('server metrics:', json.dumps(metrics, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Write a synthetic TZB-style video dataset.
+
+Videos are grayscale JPEG frame sequences with a few small bright targets
+moving over a smooth, noisy background. The layout matches what
+datasets/tzb_multi.build reads from --tzb_path:
+
+    {root}/Data/synthetic/video{k}/frame{i}.jpg
+    {root}/annotations/tzb_train_pure.json
+    {root}/annotations/tzb_test.json
+
+The annotation files are COCO-video JSON (videos, images with video_id and
+frame_id, annotations with instance_id); image ids are consecutive inside a
+video, as the reference-frame sampling expects. Video lengths and
+resolutions are drawn from the given ranges / list, so loader benchmarks can
+run without the real data.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+# 1-based like the TZB annotations: exports write label - 1 and the evaluator subtracts 1
+CATEGORIES = [{"id": cid, "name": name} for cid, name in
+              enumerate(['drone', 'car', 'ship', 'bus', 'pedestrian', 'cyclist'], start=1)]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Write a synthetic TZB-style video dataset.')
+    parser.add_argument('--root', default='data/tzb_synthetic', type=str, help='dataset root (--tzb_path)')
+    parser.add_argument('--num_videos', default=8, type=int)
+    parser.add_argument('--min_frames', default=60, type=int, help='shortest video length')
+    parser.add_argument('--max_frames', default=120, type=int, help='longest video length')
+    parser.add_argument('--resolutions', default=['640x512'], nargs='+',
+                        help='WxH frame sizes, assigned to the videos in turn')
+    parser.add_argument('--max_objects', default=4, type=int, help='targets per video (at least 1)')
+    parser.add_argument('--val_videos', default=2, type=int, help='videos written to tzb_test.json')
+    parser.add_argument('--quality', default=90, type=int, help='JPEG quality')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser
+
+
+def parse_resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def make_background(width, height, rng):
+    yy, xx = np.mgrid[0:height, 0:width]
+    fx, fy = rng.uniform(40, 120, size=2)
+    return (110 + 50 * np.sin(xx / fx) * np.cos(yy / fy)).astype(np.float32)
+
+
+def make_tracks(num_frames, width, height, max_objects, rng):
+    """Per object: category and a (num_frames, 4) array of [x, y, w, h] boxes moving at constant speed."""
+    tracks = []
+    for _ in range(rng.randint(1, max_objects + 1)):
+        w, h = rng.randint(4, 21, size=2)
+        start = rng.uniform([0, 0], [width - w, height - h])
+        velocity = rng.uniform(-3, 3, size=2)
+        t = np.arange(num_frames)[:, None]
+        xy = start + velocity * t
+        # bounce off the frame borders
+        span = np.array([width - w, height - h], dtype=np.float64)
+        xy = np.abs((xy + span) % (2 * span) - span)
+        boxes = np.concatenate([xy, np.tile([w, h], (num_frames, 1))], axis=1)
+        tracks.append((int(rng.choice([c['id'] for c in CATEGORIES])), boxes))
+    return tracks
+
+
+def write_video(root, video_name, num_frames, width, height, max_objects, quality, rng):
+    """Write the frames of one video; return its images (file_name, w, h) and per-frame annotations."""
+    video_dir = os.path.join(root, 'Data', 'synthetic', video_name)
+    os.makedirs(video_dir, exist_ok=True)
+    background = make_background(width, height, rng)
+    tracks = make_tracks(num_frames, width, height, max_objects, rng)
+    digits = len(str(num_frames - 1))
+
+    images, annotations = [], []
+    for i in range(num_frames):
+        frame = background + rng.normal(0, 6, size=background.shape)
+        frame_anns = []
+        for instance, (category_id, boxes) in enumerate(tracks):
+            x, y, w, h = boxes[i]
+            x0, y0 = int(round(x)), int(round(y))
+            frame[y0:y0 + int(h), x0:x0 + int(w)] += 90
+            frame_anns.append((category_id, instance, [round(float(x0), 2), round(float(y0), 2), float(w), float(h)]))
+        file_name = os.path.join('synthetic', video_name, 'frame{}.jpg'.format(str(i).zfill(digits)))
+        Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8), mode='L').save(
+            os.path.join(root, 'Data', file_name), quality=quality)
+        images.append((file_name, width, height))
+        annotations.append(frame_anns)
+    return images, annotations
+
+
+def to_coco_video(videos):
+    """COCO-video dict of ``videos`` = [(name, images, annotations)], ids assigned in order."""
+    coco = {'videos': [], 'images': [], 'annotations': [], 'categories': CATEGORIES}
+    image_id = ann_id = instance_base = 1
+    for video_id, (name, images, annotations) in enumerate(videos, start=1):
+        coco['videos'].append({'id': video_id, 'name': name})
+        num_instances = 0
+        for frame_id, ((file_name, width, height), frame_anns) in enumerate(zip(images, annotations)):
+            coco['images'].append({'id': image_id, 'file_name': file_name, 'width': width, 'height': height,
+                                   'video_id': video_id, 'frame_id': frame_id})
+            for category_id, instance, bbox in frame_anns:
+                coco['annotations'].append({'id': ann_id, 'image_id': image_id, 'video_id': video_id,
+                                            'category_id': category_id, 'instance_id': instance_base + instance,
+                                            'bbox': bbox, 'area': bbox[2] * bbox[3], 'iscrowd': 0})
+                ann_id += 1
+                num_instances = max(num_instances, instance + 1)
+            image_id += 1
+        instance_base += num_instances
+    return coco
+
+
+def generate_dataset(root, num_videos=8, min_frames=60, max_frames=120, resolutions=((640, 512),),
+                     max_objects=4, val_videos=2, quality=90, seed=0):
+    """Write the dataset under ``root``; return the paths of the train and test annotation files."""
+    assert 0 <= val_videos < num_videos, 'need at least one training video'
+    rng = np.random.RandomState(seed)
+    videos = []
+    for k in range(num_videos):
+        num_frames = rng.randint(min_frames, max_frames + 1)
+        width, height = resolutions[k % len(resolutions)]
+        name = 'video{}'.format(k + 1)
+        images, annotations = write_video(root, name, num_frames, width, height, max_objects, quality, rng)
+        videos.append((name, images, annotations))
+
+    ann_dir = os.path.join(root, 'annotations')
+    os.makedirs(ann_dir, exist_ok=True)
+    paths = []
+    split = num_videos - val_videos
+    for file_name, subset in (('tzb_train_pure.json', videos[:split]), ('tzb_test.json', videos[split:] or videos)):
+        path = os.path.join(ann_dir, file_name)
+        with open(path, 'w') as f:
+            json.dump(to_coco_video(subset), f)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    args = get_args_parser().parse_args()
+    train_file, test_file = generate_dataset(
+        args.root, args.num_videos, args.min_frames, args.max_frames,
+        [parse_resolution(r) for r in args.resolutions], args.max_objects, args.val_videos,
+        args.quality, args.seed)
+    print('Wrote {} videos to {}'.format(args.num_videos, os.path.join(args.root, 'Data')))
+    print('Annotations: {}, {}'.format(train_file, test_file))
@@ -0,0 +1,157 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Checkpoint writing off the training thread, and lazy (mmap) checkpoint loading.
+"""
+import inspect
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+from util.misc import is_main_process
+
+_EPOCH_CHECKPOINT = re.compile(r'^checkpoint(\d{4})\.pth$')
+
+
+def to_host(obj):
+    """Copy of a (nested) state dict with every tensor detached and copied to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v) for v in obj)
+    return obj
+
+
+def save_checkpoint_file(state, path):
+    """torch.save to a temporary name, then rename, so readers never see a partial file."""
+    path = str(path)
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Load a checkpoint, memory-mapping the tensor storages when torch supports it.
+
+    With ``mmap=True`` (torch >= 2.1) only the pickled structure is read
+    up front; tensor data is paged in from the file as ``load_state_dict``
+    touches it. Older versions fall back to a full load.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except RuntimeError:
+            # legacy (non-zipfile) checkpoints cannot be mapped
+            pass
+    return torch.load(path, map_location=map_location)
+
+
+def link_or_copy(src, dst):
+    """Atomically point ``dst`` at the contents of ``src``: hard link if possible, else copy."""
+    src, dst = str(src), str(dst)
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+    """Writes training checkpoints from a background thread.
+
+    ``save`` snapshots the state to host memory on the calling thread and
+    returns; serialization and disk I/O happen on the writer thread. The
+    per-epoch file ``checkpoint{epoch:04}.pth`` is written once and
+    ``checkpoint.pth`` is hard-linked to it (copied where the filesystem has
+    no hard links), both through atomic renames. At most one snapshot is
+    pending, so a slow disk bounds host memory instead of queueing epochs.
+
+    Retention: ``keep_last`` > 0 keeps only the newest ``keep_last``
+    per-epoch files, except those with ``(epoch + 1) % keep_every == 0``
+    when ``keep_every`` > 0. ``checkpoint.pth`` is never removed.
+
+    Only the main process writes; on other ranks every method is a no-op.
+    """
+    def __init__(self, output_dir, keep_last=0, keep_every=0, async_write=True):
+        self.output_dir = str(output_dir)
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.async_write = async_write
+        self._error = None
+        self._queue = None
+        if async_write and is_main_process():
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+            self._thread.start()
+
+    def save(self, state, epoch, per_epoch=True):
+        """Save ``state`` as the latest checkpoint and, if ``per_epoch``, as ``checkpoint{epoch:04}.pth``."""
+        if not is_main_process():
+            return
+        self._raise_error()
+        job = (to_host(state), epoch, per_epoch)
+        if self._queue is None:
+            self._write(*job)
+        else:
+            self._queue.put(job)
+
+    def wait(self):
+        """Block until every pending checkpoint is on disk."""
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('checkpoint writer failed') from error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, epoch, per_epoch):
+        latest = os.path.join(self.output_dir, 'checkpoint.pth')
+        if per_epoch:
+            path = os.path.join(self.output_dir, 'checkpoint{:04}.pth'.format(epoch))
+            save_checkpoint_file(state, path)
+            link_or_copy(path, latest)
+            self._apply_retention()
+        else:
+            save_checkpoint_file(state, latest)
+
+    def _apply_retention(self):
+        if self.keep_last <= 0:
+            return
+        epochs = sorted(int(m.group(1)) for m in map(_EPOCH_CHECKPOINT.match, os.listdir(self.output_dir)) if m)
+        for epoch in epochs[:-self.keep_last]:
+            if self.keep_every > 0 and (epoch + 1) % self.keep_every == 0:
+                continue
+            os.remove(os.path.join(self.output_dir, 'checkpoint{:04}.pth'.format(epoch)))
@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Timing of the DDP gradient all-reduces against the whole training step.
+"""
+import time
+
+import torch
+import torch.distributed as dist
+
+
+class CommTimer(object):
+    """Per-step communication and step time of a DDP model.
+
+    Register with ``model.register_comm_hook(timer, timed_allreduce_hook)``
+    and bracket every training step with ``start_step`` / ``stop_step``.
+    On CUDA both are measured with events, so the hook does not add host
+    syncs; ``stop_step`` waits for the step to finish, so only enable it
+    while measuring. ``time_comm`` is the summed duration of the bucket
+    all-reduces (they overlap with backward compute), ``time_step`` the
+    wall time of forward, backward and optimizer step.
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self._comm_events = []
+        self._comm_time = 0.0
+        self._step_start = None
+
+    def _mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def _elapsed(start, end):
+        if isinstance(start, float):
+            return end - start
+        return start.elapsed_time(end) / 1000
+
+    def start_step(self):
+        self._step_start = self._mark()
+
+    def stop_step(self):
+        """Wait for the step and return ``{'time_step': s, 'time_comm': s}``."""
+        end = self._mark()
+        if self.cuda:
+            end.synchronize()
+        comm_time = self._comm_time + sum(self._elapsed(s, e) for s, e in self._comm_events)
+        stats = {'time_step': self._elapsed(self._step_start, end), 'time_comm': comm_time}
+        self._comm_events = []
+        self._comm_time = 0.0
+        return stats
+
+
+def timed_allreduce_hook(timer, bucket):
+    """Same averaging all-reduce as the DDP default, with its duration recorded in ``timer``."""
+    tensor = bucket.buffer() if hasattr(bucket, 'buffer') else bucket.get_tensor()
+    tensor.div_(dist.get_world_size())
+    start = timer._mark()
+    fut = dist.all_reduce(tensor, async_op=True).get_future()
+
+    def done(fut):
+        end = timer._mark()
+        if timer.cuda:
+            timer._comm_events.append((start, end))
+        else:
+            timer._comm_time += end - start
+        return fut.value()[0]
+
+    return fut.then(done)
@@ -0,0 +1,67 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Peak memory of a code region, on CUDA (allocator) or CPU (process RSS).
+"""
+import resource
+
+import torch
+
+
+def _read_status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(device):
+    """Start a new peak measurement.
+
+    On CPU this resets the kernel's RSS high-water mark (Linux, via
+    /proc/self/clear_refs); where that is not possible the peak stays the
+    maximum since process start.
+    """
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb(device):
+    """Peak allocated CUDA memory, or peak process RSS on CPU, since the last reset (MB)."""
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) / 1024.0 / 1024.0
+    peak_kb = _read_status_kb('VmHWM')
+    if peak_kb is None:
+        # ru_maxrss is in KB on Linux
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_kb / 1024.0
+
+
+def available_memory_mb(device):
+    """Total CUDA memory of ``device``, or the memory available to new allocations on CPU (MB)."""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory / 1024.0 / 1024.0
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
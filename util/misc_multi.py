@@ -62,6 +62,10 @@ from torch import Tensor
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
+
+    Tensor values are kept on their device and only copied to the host when
+    a statistic is read (or by ``MetricLogger.flush`` for all meters at once),
+    so updating a meter does not stall the device queue.
     """
 
     def __init__(self, window_size=20, fmt=None):
@@ -71,16 +75,30 @@ class SmoothedValue(object):
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
+        self.pending = []
 
     def update(self, value, n=1):
+        if isinstance(value, torch.Tensor):
+            self.pending.append((value.detach(), n))
+            return
         self.deque.append(value)
         self.count += n
         self.total += value * n
 
+    def flush(self):
+        """Move the pending device values to the host (one sync)."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        values = torch.stack([v.reshape(()).to(torch.float64) for v, _ in pending]).tolist()
+        for value, (_, n) in zip(values, pending):
+            self.update(value, n)
+
     def synchronize_between_processes(self):
         """
         Warning: does not synchronize the deque!
         """
+        self.flush()
         if not is_dist_avail_and_initialized():
             return
         t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
@@ -92,24 +110,29 @@ class SmoothedValue(object):
 
     @property
     def median(self):
+        self.flush()
         d = torch.tensor(list(self.deque))
         return d.median().item()
 
     @property
     def avg(self):
+        self.flush()
         d = torch.tensor(list(self.deque), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
+        self.flush()
         return self.total / self.count
 
     @property
     def max(self):
+        self.flush()
         return max(self.deque)
 
     @property
     def value(self):
+        self.flush()
         return self.deque[-1]
 
     def __str__(self):
@@ -191,18 +214,72 @@ def reduce_dict(input_dict, average=True):
     return reduced_dict
 
 
+class NonFiniteWatchdog(object):
+    """Checks losses for NaN / inf without syncing every training step.
+
+    ``update`` folds the step of a non-finite value into a device-side
+    "first bad step" tensor, with no host copy. ``check`` is collective: it
+    takes the minimum over all processes and blocks on the result, so every
+    process sees the same bad step at the same call and they stop together.
+    Call it at the same steps on all processes (e.g. every print_freq steps).
+    """
+    NONE = 2 ** 62
+
+    def __init__(self):
+        self._first_bad = None
+
+    def update(self, value, step):
+        flag = (~torch.isfinite(value.detach())).any()
+        if self._first_bad is None:
+            self._first_bad = torch.full((), self.NONE, dtype=torch.int64, device=flag.device)
+        bad_step = torch.where(flag, torch.full_like(self._first_bad, step), self._first_bad)
+        torch.minimum(self._first_bad, bad_step, out=self._first_bad)
+
+    def check(self):
+        """Return the first step with a non-finite value on any process, or None."""
+        first_bad = self._first_bad
+        if first_bad is None:
+            first_bad = torch.full((), self.NONE, dtype=torch.int64)
+        if is_dist_avail_and_initialized():
+            first_bad = first_bad.to(dist_device(), copy=True)
+            dist.all_reduce(first_bad, op=dist.ReduceOp.MIN)
+        step = first_bad.item()
+        return None if step == self.NONE else step
+
+
 class MetricLogger(object):
-    def __init__(self, delimiter="\t"):
+    """
+    With ``reduce=True`` tensor values are averaged over all processes when
+    they are flushed (every ``print_freq`` steps in ``log_every``), replacing
+    a per-step ``reduce_dict`` of the logged values.
+    """
+    def __init__(self, delimiter="\t", reduce=False):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.reduce = reduce
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
+    def flush(self):
+        """Copy the pending tensor values of all meters to the host in one transfer."""
+        names = sorted(k for k, meter in self.meters.items() if meter.pending)
+        if not names:
+            return
+        pending = [(k, v, n) for k in names for v, n in self.meters[k].pending]
+        device = pending[0][1].device
+        values = torch.stack([v.reshape(()).to(device, torch.float64) for _, v, _ in pending])
+        if self.reduce and get_world_size() > 1:
+            # every process logs the same meters in the same order
+            dist.all_reduce(values)
+            values /= get_world_size()
+        for k in names:
+            self.meters[k].pending = []
+        for (k, _, n), value in zip(pending, values.tolist()):
+            self.meters[k].update(value, n)
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -220,6 +297,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.flush()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -260,6 +338,7 @@ class MetricLogger(object):
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                self.flush()
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -305,6 +384,7 @@ def collate_fn(batch):
     # import pdb; pdb.set_trace()
     batch = list(zip(*batch))
     batch[0] = nested_tensor_from_tensor_list(batch[0])
+    batch[1] = PackedTargets.pack(batch[1])
     return tuple(batch)
 
 
@@ -375,6 +455,10 @@ class NestedTensor(object):
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        mask = self.mask.pin_memory() if self.mask is not None else None
+        return NestedTensor(self.tensors.pin_memory(), mask)
+
     def record_stream(self, *args, **kwargs):
         self.tensors.record_stream(*args, **kwargs)
         if self.mask is not None:
@@ -387,6 +471,65 @@ class NestedTensor(object):
         return str(self.tensors)
 
 
+class PackedTargets(object):
+    """Targets of a batch packed into one contiguous byte buffer.
+
+    Every tensor of every target dict is stored at an 8-byte aligned offset of
+    ``buffer``; ``layout`` keeps, per target, the (key, offset, nbytes, dtype,
+    shape) entries needed to find it again. The whole batch therefore moves to
+    the device with a single copy, and ``unpack`` returns the usual list of
+    target dicts as zero-copy views into the buffer.
+    """
+    ALIGN = 8
+
+    def __init__(self, buffer, layout):
+        self.buffer = buffer
+        self.layout = layout
+
+    @classmethod
+    def pack(cls, targets):
+        layout = []
+        total = 0
+        for t in targets:
+            entries = []
+            for k, v in t.items():
+                nbytes = v.numel() * v.element_size()
+                entries.append((k, total, nbytes, v.dtype, tuple(v.shape)))
+                total += (nbytes + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+            layout.append(entries)
+        buffer = torch.zeros((total,), dtype=torch.uint8)
+        for t, entries in zip(targets, layout):
+            for k, offset, nbytes, _, _ in entries:
+                if nbytes > 0:
+                    buffer[offset: offset + nbytes].copy_(t[k].contiguous().view(-1).view(torch.uint8))
+        return cls(buffer, layout)
+
+    def to(self, device, non_blocking=False):
+        # type: (Device) -> PackedTargets # noqa
+        return PackedTargets(self.buffer.to(device, non_blocking=non_blocking), self.layout)
+
+    def pin_memory(self):
+        return PackedTargets(self.buffer.pin_memory(), self.layout)
+
+    def record_stream(self, *args, **kwargs):
+        self.buffer.record_stream(*args, **kwargs)
+
+    def unpack(self):
+        targets = []
+        for entries in self.layout:
+            t = {}
+            for k, offset, nbytes, dtype, shape in entries:
+                t[k] = self.buffer[offset: offset + nbytes].view(dtype).view(shape)
+            targets.append(t)
+        return targets
+
+    def __len__(self):
+        return len(self.layout)
+
+    def __repr__(self):
+        return 'PackedTargets(num_targets={}, nbytes={})'.format(len(self.layout), self.buffer.numel())
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -410,6 +553,13 @@ def is_dist_avail_and_initialized():
     return True
 
 
+def dist_device():
+    """Device for tensors of collectives: the current CUDA device under NCCL, else the CPU."""
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def get_world_size():
     if not is_dist_avail_and_initialized():
         return 1
@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Cache of raw model outputs for re-running post-processing without the model.
+"""
+import hashlib
+import json
+import os
+
+import torch
+
+from util.misc import all_gather, get_rank, get_world_size, is_main_process, is_dist_avail_and_initialized
+
+
+def file_digest(path, chunk_size=1 << 24):
+    """SHA-1 of a file's contents, read in chunks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def output_cache_key(checkpoint, config):
+    """Key of a cache entry: checkpoint contents plus the dataset / transform config."""
+    h = hashlib.sha1()
+    h.update((file_digest(checkpoint) if os.path.isfile(checkpoint) else str(checkpoint)).encode())
+    h.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+class OutputCache(object):
+    """Raw ``pred_logits`` / ``pred_boxes`` of a test run, stored per image_id in fp16.
+
+    Every rank writes its images to its own shard files under
+    ``cache_root/key``; ``start`` clears the entry before a run writes it and
+    the main process marks it complete, with the list of shards, once all
+    ranks are done. Together with the outputs each image keeps the target
+    fields needed after the model (``image_id``, ``orig_size``, ``labels``,
+    ``boxes``), so a cached run can be post-processed and exported without
+    loading a single frame.
+    """
+    def __init__(self, cache_root, key, config=None, shard_size=1000):
+        self.cache_dir = os.path.join(cache_root, key)
+        self.config = config
+        self.shard_size = shard_size
+        self._entries = []
+        self._num_shards = 0
+        self._shards = []
+
+    @property
+    def complete(self):
+        return os.path.exists(os.path.join(self.cache_dir, 'complete.json'))
+
+    def start(self):
+        """Clear the entry before a run writes it, so an interrupted run never looks complete."""
+        if is_main_process() and os.path.isdir(self.cache_dir):
+            for f in os.listdir(self.cache_dir):
+                if f == 'complete.json' or f.endswith(('.pt', '.tmp')):
+                    os.remove(os.path.join(self.cache_dir, f))
+        if is_dist_avail_and_initialized():
+            torch.distributed.barrier()
+        self._entries = []
+        self._num_shards = 0
+        self._shards = []
+
+    def add(self, outputs, targets):
+        """Store the outputs of one batch."""
+        logits = outputs['pred_logits'].detach().half().cpu()
+        boxes = outputs['pred_boxes'].detach().half().cpu()
+        for i, t in enumerate(targets):
+            self._entries.append({
+                'pred_logits': logits[i].clone(),
+                'pred_boxes': boxes[i].clone(),
+                'target': {k: t[k].detach().cpu() for k in ('image_id', 'orig_size', 'labels', 'boxes') if k in t},
+            })
+        if len(self._entries) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._entries:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = 'rank{}_{:05d}.pt'.format(get_rank(), self._num_shards)
+        path = os.path.join(self.cache_dir, name)
+        torch.save(self._entries, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self._entries = []
+        self._num_shards += 1
+        self._shards.append(name)
+
+    def finalize(self):
+        """Write the remaining entries and mark the cache entry complete."""
+        self.flush()
+        shards = sorted(name for names in all_gather(self._shards) for name in names)
+        if is_main_process():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, 'complete.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'config': self.config, 'world_size': get_world_size(), 'shards': shards}, f, default=str)
+            os.replace(path + '.tmp', path)
+        if is_dist_avail_and_initialized():
+            torch.distributed.barrier()
+
+    def batches(self, batch_size, device):
+        """Yield ``(outputs, targets)`` batches from the cache, shards split across ranks."""
+        with open(os.path.join(self.cache_dir, 'complete.json')) as f:
+            shards = json.load(f)['shards']
+        shards = shards[get_rank()::get_world_size()]
+        for shard in shards:
+            entries = torch.load(os.path.join(self.cache_dir, shard), map_location='cpu')
+            for start in range(0, len(entries), batch_size):
+                batch = entries[start:start + batch_size]
+                outputs = {
+                    'pred_logits': torch.stack([e['pred_logits'] for e in batch]).to(device).float(),
+                    'pred_boxes': torch.stack([e['pred_boxes'] for e in batch]).to(device).float(),
+                }
+                targets = [{k: v.to(device) for k, v in e['target'].items()} for e in batch]
+                yield outputs, targets
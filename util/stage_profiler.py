@@ -0,0 +1,143 @@
+# ------------------------------------------------------------------------
+# TransVOD++
+# Copyright (c) 2022 Shanghai Jiao Tong University. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Per-stage wall time and peak memory of the training step.
+
+The model code marks its stages with ``range_push(name)`` / ``range_pop()``
+(same pairing as ``torch.cuda.nvtx``). Unless a ``StageProfiler`` is
+enabled these are a global lookup and a return, so the marks stay in place
+for normal runs.
+"""
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+from util.misc import get_rank
+
+_profiler = None
+
+MB = 1024.0 * 1024.0
+
+
+def enable(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def range_push(name):
+    if _profiler is not None:
+        _profiler.push(name)
+
+
+def range_pop():
+    if _profiler is not None:
+        _profiler.pop()
+
+
+class StageProfiler(object):
+    """Accumulates time and peak memory per stage, keyed by the nesting path
+    (e.g. ``model/transformer/encoder``).
+
+    On CUDA every stage boundary synchronizes the device so the time is
+    attributed to the stage that launched the work, and the peak memory
+    statistics are reset per stage (the ``max mem`` printed by the metric
+    logger is then per stage as well). Stages also show up as NVTX ranges.
+
+    If ``trace_file`` is given, steps ``trace_start`` to
+    ``trace_start + trace_steps - 1`` (counted over the whole run) are
+    written there as a Chrome trace (chrome://tracing, Perfetto).
+    """
+    def __init__(self, device, trace_file=None, trace_start=10, trace_steps=0):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.trace_file = trace_file
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self._stack = []
+        self._times = defaultdict(float)
+        self._peaks = defaultdict(int)
+        self._steps = 0
+        self._global_step = 0
+        self._origin = time.perf_counter()
+        self._trace = []
+
+    def now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def push(self, name):
+        start = self.now()
+        if self.cuda:
+            self._fold_peak()
+            torch.cuda.reset_peak_memory_stats()
+            torch.cuda.nvtx.range_push(name)
+        self._stack.append([name, start, 0])
+
+    def pop(self):
+        name, start, peak = self._stack.pop()
+        end = self.now()
+        if self.cuda:
+            torch.cuda.nvtx.range_pop()
+            peak = max(peak, torch.cuda.max_memory_allocated())
+        self.add(name, start, end, peak)
+
+    def _fold_peak(self):
+        # the peak reached so far belongs to every enclosing stage
+        if self._stack:
+            self._stack[-1][2] = max(self._stack[-1][2], torch.cuda.max_memory_allocated())
+
+    def add(self, name, start, end, peak=0):
+        """Record a stage timed outside ``push`` / ``pop`` (e.g. waiting for data)."""
+        key = '/'.join([s[0] for s in self._stack] + [name])
+        self._times[key] += end - start
+        self._peaks[key] = max(self._peaks[key], peak)
+        if self._stack:
+            self._stack[-1][2] = max(self._stack[-1][2], peak)
+        if self.trace_file and self.trace_start <= self._global_step < self.trace_start + self.trace_steps:
+            self._trace.append({
+                'name': name, 'cat': key, 'ph': 'X', 'pid': get_rank(), 'tid': 0,
+                'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+                'args': {'step': self._global_step, 'peak_mb': peak / MB},
+            })
+
+    def step(self):
+        """Mark the end of a training step."""
+        self._steps += 1
+        self._global_step += 1
+        if self.trace_file and self._global_step == self.trace_start + self.trace_steps:
+            self.write_trace()
+
+    def write_trace(self):
+        path = self.trace_file
+        if get_rank() > 0:
+            root, ext = os.path.splitext(path)
+            path = '{}.rank{}{}'.format(root, get_rank(), ext)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'traceEvents': self._trace, 'displayTimeUnit': 'ms'}, f)
+        os.replace(path + '.tmp', path)
+        self._trace = []
+        print('Wrote stage trace to {}'.format(path))
+
+    def summary(self):
+        """Mean time per step (s) and peak memory (MB) of every stage since the last call."""
+        stats = {}
+        for key in sorted(self._times):
+            stats['stage_{}_time'.format(key)] = self._times[key] / max(self._steps, 1)
+            if self.cuda:
+                stats['stage_{}_mem'.format(key)] = self._peaks[key] / MB
+        self._times.clear()
+        self._peaks.clear()
+        self._steps = 0
+        return stats
@@ -1,11 +1,13 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import argparse
+import json
 import os
 import os.path as osp
+import shutil
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-import mmcv
 from tqdm import tqdm
 
 CLASSES = ('airplane', 'antelope', 'bear', 'bicycle', 'bird', 'bus', 'car',
@@ -41,13 +43,27 @@ def parse_args():
         '--output',
         help='directory to save coco formatted label file',
     )
+    parser.add_argument(
+        '-j',
+        '--num-workers',
+        type=int,
+        default=None,
+        help='number of processes parsing videos (default: all cores, '
+        '0: parse in the main process)',
+    )
     return parser.parse_args()
 
 
+def list_from_file(filename):
+    """Read a text file into a list of lines without trailing newlines."""
+    with open(filename, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
 def parse_train_list(ann_dir):
     """Parse the txt file of ImageNet VID train dataset."""
     img_list = osp.join(ann_dir, 'Lists/VID_train_15frames.txt')
-    img_list = mmcv.list_from_file(img_list)
+    img_list = list_from_file(img_list)
     train_infos = defaultdict(list)
     for info in img_list:
         info = info.split(' ')
@@ -62,7 +78,7 @@ def parse_train_list(ann_dir):
 def parse_val_list(ann_dir):
     """Parse the txt file of ImageNet VID val dataset."""
     img_list = osp.join(ann_dir, 'Lists/VID_val_videos.txt')
-    img_list = mmcv.list_from_file(img_list)
+    img_list = list_from_file(img_list)
     val_infos = defaultdict(list)
     for info in img_list:
         info = info.split(' ')
@@ -70,15 +86,96 @@ def parse_val_list(ann_dir):
     return val_infos
 
 
-def convert_vid(VID, ann_dir, save_dir, mode='train'):
+def parse_video(job):
+    """Parse the XML annotations of one video into a compact record.
+
+    Runs in a worker process. Ids are not assigned here; instances are
+    numbered locally in order of first appearance so that the merge step
+    can map them to global ids deterministically.
+
+    Args:
+        job (tuple): ``(xml_dir, vid_name, num_frames)``.
+
+    Returns:
+        dict: ``images`` as ``(frame_id, width, height)`` tuples,
+        ``annotations`` as ``(frame_id, category_id, local_instance_id,
+        x1, y1, w, h, occluded, generated)`` tuples, ``num_instances`` and
+        the list of ``no_objects`` XML files.
+    """
+    xml_dir, vid_name, num_frames = job
+    instance_id_maps = dict()
+    images = []
+    annotations = []
+    no_objects = []
+    for frame_id in range(num_frames):
+        img_prefix = osp.join(vid_name, '%06d' % frame_id)
+        xml_name = osp.join(xml_dir, f'{img_prefix}.xml')
+        root = ET.parse(xml_name).getroot()
+        size = root.find('size')
+        images.append((frame_id, int(size.find('width').text),
+                       int(size.find('height').text)))
+        objects = root.findall('object')
+        if objects == []:
+            no_objects.append(xml_name)
+            continue
+        for obj in objects:
+            name = obj.find('name').text
+            if name not in cats_id_maps:
+                continue
+            bnd_box = obj.find('bndbox')
+            x1, y1, x2, y2 = [
+                int(bnd_box.find('xmin').text),
+                int(bnd_box.find('ymin').text),
+                int(bnd_box.find('xmax').text),
+                int(bnd_box.find('ymax').text)
+            ]
+            track_id = obj.find('trackid').text
+            if track_id not in instance_id_maps:
+                instance_id_maps[track_id] = len(instance_id_maps)
+            annotations.append(
+                (frame_id, cats_id_maps[name], instance_id_maps[track_id],
+                 x1, y1, x2 - x1, y2 - y1,
+                 obj.find('occluded').text == '1',
+                 obj.find('generated').text == '1'))
+    return dict(
+        images=images,
+        annotations=annotations,
+        num_instances=len(instance_id_maps),
+        no_objects=no_objects)
+
+
+class _JsonListWriter:
+    """Write the items of one JSON list to an open file one at a time."""
+
+    def __init__(self, f, key, first_key=False):
+        self.f = f
+        self.first = True
+        f.write(('' if first_key else ', ') + json.dumps(key) + ': [')
+
+    def write(self, item):
+        self.f.write(('' if self.first else ', ') + json.dumps(item))
+        self.first = False
+
+    def close(self):
+        self.f.write(']')
+
+
+def convert_vid(categories, ann_dir, save_dir, mode='train', num_workers=None):
     """Convert ImageNet VID dataset in COCO style.
 
+    Videos are parsed in a process pool; ids for videos, images,
+    annotations and instances are assigned in video-list order while the
+    results are merged, so the output is identical for any number of
+    workers. The JSON file is streamed instead of built in memory.
+
     Args:
-        VID (dict): The converted COCO style annotations.
+        categories (list[dict]): The COCO style categories.
         ann_dir (str): The path of ImageNet VID dataset.
-        save_dir (str): The path to save `VID`.
+        save_dir (str): The path to save the converted annotations.
         mode (str): Convert train dataset or validation dataset. Options are
             'train', 'val'. Default: 'train'.
+        num_workers (int, optional): Number of worker processes. ``None``
+            uses all cores, ``0`` parses in the main process.
     """
     assert mode in ['train', 'val']
     records = dict(
@@ -88,92 +185,92 @@ def convert_vid(VID, ann_dir, save_dir, mode='train'):
         global_instance_id=1,
         num_vid_train_frames=0,
         num_no_objects=0)
-    obj_num_classes = dict()
+    obj_num_classes = defaultdict(int)
     xml_dir = osp.join(ann_dir, 'Annotations/VID/')
     if mode == 'train':
         vid_infos = parse_train_list(ann_dir)
     else:
         vid_infos = parse_val_list(ann_dir)
-    for vid_info in tqdm(vid_infos):
-        instance_id_maps = dict()
-        vid_train_frames = vid_infos[vid_info].get('vid_train_frames', [])
-        records['num_vid_train_frames'] += len(vid_train_frames)
-        video = dict(
-            id=records['vid_id'],
-            name=vid_info,
-            vid_train_frames=vid_train_frames)
-        VID['videos'].append(video)
-        num_frames = vid_infos[vid_info]['num_frames']
-        for frame_id in range(num_frames):
-            is_vid_train_frame = True if frame_id in vid_train_frames \
-                else False
-            img_prefix = osp.join(vid_info, '%06d' % frame_id)
-            xml_name = osp.join(xml_dir, f'{img_prefix}.xml')
-            # parse XML annotation file
-            tree = ET.parse(xml_name)
-            root = tree.getroot()
-            size = root.find('size')
-            width = int(size.find('width').text)
-            height = int(size.find('height').text)
-            image = dict(
-                file_name=f'{img_prefix}.JPEG',
-                height=height,
-                width=width,
-                id=records['img_id'],
-                frame_id=frame_id,
-                video_id=records['vid_id'],
-                is_vid_train_frame=is_vid_train_frame)
-            VID['images'].append(image)
-            if root.findall('object') == []:
-                print(xml_name, 'has no objects.')
-                records['num_no_objects'] += 1
-                records['img_id'] += 1
-                continue
-            for obj in root.findall('object'):
-                name = obj.find('name').text
-                if name not in cats_id_maps:
-                    continue
-                category_id = cats_id_maps[name]
-                bnd_box = obj.find('bndbox')
-                x1, y1, x2, y2 = [
-                    int(bnd_box.find('xmin').text),
-                    int(bnd_box.find('ymin').text),
-                    int(bnd_box.find('xmax').text),
-                    int(bnd_box.find('ymax').text)
-                ]
-                w = x2 - x1
-                h = y2 - y1
-                track_id = obj.find('trackid').text
-                if track_id in instance_id_maps:
-                    instance_id = instance_id_maps[track_id]
-                else:
-                    instance_id = records['global_instance_id']
-                    records['global_instance_id'] += 1
-                    instance_id_maps[track_id] = instance_id
-                occluded = obj.find('occluded').text
-                generated = obj.find('generated').text
-                ann = dict(
-                    id=records['ann_id'],
-                    video_id=records['vid_id'],
-                    image_id=records['img_id'],
-                    category_id=category_id,
-                    instance_id=instance_id,
-                    bbox=[x1, y1, w, h],
-                    area=w * h,
-                    iscrowd=False,
-                    occluded=occluded == '1',
-                    generated=generated == '1')
-                if category_id not in obj_num_classes:
-                    obj_num_classes[category_id] = 1
-                else:
-                    obj_num_classes[category_id] += 1
-                VID['annotations'].append(ann)
-                records['ann_id'] += 1
-            records['img_id'] += 1
-        records['vid_id'] += 1
+    vid_names = list(vid_infos)
+    jobs = [(xml_dir, name, vid_infos[name]['num_frames']) for name in vid_names]
+
     if not osp.isdir(save_dir):
         os.makedirs(save_dir)
-    mmcv.dump(VID, osp.join(save_dir, f'imagenet_vid_{mode}.json'))
+    out_file = osp.join(save_dir, f'imagenet_vid_{mode}.json')
+    # videos and images are streamed to the output file while the
+    # annotations go to a side file that is appended at the end
+    ann_file = out_file + '.annotations.tmp'
+
+    if num_workers == 0:
+        executor = None
+        results = map(parse_video, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(parse_video, jobs, chunksize=4)
+
+    try:
+        with open(out_file + '.tmp', 'w') as f, open(ann_file, 'w') as af:
+            f.write('{"categories": ' + json.dumps(categories))
+            video_records = []
+            images = _JsonListWriter(f, 'images')
+            annotations = _JsonListWriter(af, 'annotations')
+            for vid_name, video in tqdm(zip(vid_names, results), total=len(jobs)):
+                vid_id = records['vid_id']
+                vid_train_frames = vid_infos[vid_name].get('vid_train_frames', [])
+                records['num_vid_train_frames'] += len(vid_train_frames)
+                video_records.append(dict(
+                    id=vid_id, name=vid_name, vid_train_frames=vid_train_frames))
+                train_frames = set(vid_train_frames)
+
+                first_img_id = records['img_id']
+                for frame_id, width, height in video['images']:
+                    images.write(dict(
+                        file_name=f"{osp.join(vid_name, '%06d' % frame_id)}.JPEG",
+                        height=height,
+                        width=width,
+                        id=first_img_id + frame_id,
+                        frame_id=frame_id,
+                        video_id=vid_id,
+                        is_vid_train_frame=frame_id in train_frames))
+                for xml_name in video['no_objects']:
+                    print(xml_name, 'has no objects.')
+                records['num_no_objects'] += len(video['no_objects'])
+
+                first_instance_id = records['global_instance_id']
+                for (frame_id, category_id, instance, x1, y1, w, h,
+                     occluded, generated) in video['annotations']:
+                    annotations.write(dict(
+                        id=records['ann_id'],
+                        video_id=vid_id,
+                        image_id=first_img_id + frame_id,
+                        category_id=category_id,
+                        instance_id=first_instance_id + instance,
+                        bbox=[x1, y1, w, h],
+                        area=w * h,
+                        iscrowd=False,
+                        occluded=occluded,
+                        generated=generated))
+                    obj_num_classes[category_id] += 1
+                    records['ann_id'] += 1
+
+                records['global_instance_id'] += video['num_instances']
+                records['img_id'] += len(video['images'])
+                records['vid_id'] += 1
+            images.close()
+            annotations.close()
+
+            f.write(', "videos": ' + json.dumps(video_records))
+            af.flush()
+            with open(ann_file, 'r') as af_read:
+                shutil.copyfileobj(af_read, f)
+            f.write('}')
+        os.replace(out_file + '.tmp', out_file)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if osp.exists(ann_file):
+            os.remove(ann_file)
+
     print(f'-----ImageNet VID {mode}------')
     print(f'{records["vid_id"]- 1} videos')
     print(f'{records["img_id"]- 1} images')
@@ -194,13 +291,9 @@ def main():
         categories.append(
             dict(id=k, name=v, encode_name=CLASSES_ENCODES[k - 1]))
 
-    VID_train = defaultdict(list)
-    VID_train['categories'] = categories
-    convert_vid(VID_train, args.input, args.output, 'train')
-
-    VID_val = defaultdict(list)
-    VID_val['categories'] = categories
-    convert_vid(VID_val, args.input, args.output, 'val')
+    convert_vid(categories, args.input, args.output, 'train',
+                args.num_workers)
+    convert_vid(categories, args.input, args.output, 'val', args.num_workers)
 
 
 if __name__ == '__main__':